@@ -124,8 +124,15 @@ class ClientConfiguration:
     def worker_threads(self):
         # default value between 1 and 20, based on cpu_count
         default_value = min(max([1, multiprocessing.cpu_count() - 1]), 20)
+        if self.adaptive_worker_threads:
+            # the default value is only the starting point when the thread count is adjusted automatically
+            return default_value
         return self._args.workerThreads or default_value
 
+    @property
+    def adaptive_worker_threads(self):
+        return self._args.workerThreads == 'auto'
+
     @property
     def batch_size(self):
         return self._args.batch
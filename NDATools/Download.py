@@ -1,30 +1,48 @@
+import contextlib
 import copy
 import csv
-import gzip
+import http.client
+import math
 import os.path
 import pathlib
 import platform
-import shutil
 import tempfile
 import threading
 import time
 import traceback
 import uuid
+from collections import deque
+from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor, wait
 from queue import Queue
-from shutil import copyfile
 from threading import Thread
+from urllib.parse import parse_qs
 
+import numpy as np
+import botocore.exceptions
 import pandas as pd
-from boto3.s3.transfer import TransferConfig
+import urllib3
 from requests import HTTPError
 from tqdm import tqdm
 
 import NDATools
 from NDATools.AltEndpointSSLAdapter import AltEndpointSSLAdapter
+from NDATools.DownloadCache import DownloadCache, link_or_copy
+from NDATools.DownloadIO import BufferPool, DiskWriter, PendingWrites, ResponseBodyReader, readinto_buffer, \
+    preallocate_file, StreamingChecksum, ChecksumMismatchError, GzipStreamReader, get_comparable_e_tag, \
+    StallDetector, TransferStalledError, combine_part_digests
+from NDATools.DownloadProgress import DownloadProgressJournal
+from NDATools.Metrics import DownloadMetrics, MetricsReporter, metrics_registry
+from NDATools.PackageMetadata import PackageMetadata
+from NDATools.Polling import poll, Backoff, PollTimeoutError, RetryLater, parse_retry_after
 from NDATools.Utils import *
 
 logger = logging.getLogger(__name__)
 
+KB = 1024
+MB = KB * KB
+GB = KB ** 3
+
 
 class ThreadPool:
     """ Pool of threads consuming tasks from a queue """
@@ -67,6 +85,400 @@ class ThreadPool:
         self.tasks.join()
 
 
+class LaneThreadPool:
+    """
+    Pool of threads consuming tasks from two lanes - one for large files and one for small files. Each worker
+    prefers the tasks in its own lane but takes tasks from the other lane when its own lane is empty, so that large
+    files can be started early on a few dedicated threads while small files fill the remaining threads, and all
+    threads stay busy until the end of the run. One of the active slots is always kept for small files, so that
+    large files never hold every slot while small files wait.
+    """
+    LARGE = 'large'
+    SMALL = 'small'
+
+    class Worker(Thread):
+        """ Thread executing tasks from the pool, preferring tasks from the given lane """
+
+        def __init__(self, pool, lane):
+            Thread.__init__(self)
+            self.pool = pool
+            self.lane = lane
+            self.daemon = True
+            self.start()
+
+        def run(self):
+            while True:
+                func, args, task_lane = self.pool.next_task(self.lane)
+                try:
+                    func(*args)
+                except Exception as e:
+                    # An exception happened in this thread
+                    logger.info(str(e))
+                    logger.info(traceback.print_exc())
+                finally:
+                    # Mark this task as done, whether an exception happened or not
+                    self.pool.task_done(task_lane)
+
+    def __init__(self, num_threads, large_lane_threads, queue_size=None, active_threads=None):
+        self.queue_size = queue_size or num_threads * 100
+        self.lanes = {LaneThreadPool.LARGE: deque(), LaneThreadPool.SMALL: deque()}
+        self.condition = threading.Condition()
+        self.unfinished_tasks = 0
+        # number of workers allowed to run tasks at the same time. the remaining workers stay parked
+        self.active_limit = active_threads or num_threads
+        self.active_tasks = 0
+        self.active_large_tasks = 0
+        large_lane_threads = min(large_lane_threads, num_threads - 1)
+        for i in range(num_threads):
+            LaneThreadPool.Worker(self, LaneThreadPool.LARGE if i < large_lane_threads else LaneThreadPool.SMALL)
+
+    def map(self, func, args_list, lane=SMALL):
+        """ Add a list of tasks to the given lane. Blocks while the lane is full """
+        for args in args_list:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.lanes[lane]) < self.queue_size)
+                self.lanes[lane].append((func, args))
+                self.unfinished_tasks += 1
+                self.condition.notify_all()
+
+    def get_task_lane(self, lane):
+        """ Returns the lane a worker of the given lane can take a task from now, or None if it has to wait """
+        if self.active_tasks >= self.active_limit:
+            return None
+        other_lane = LaneThreadPool.SMALL if lane == LaneThreadPool.LARGE else LaneThreadPool.LARGE
+        for task_lane in (lane, other_lane):
+            if not self.lanes[task_lane]:
+                continue
+            if task_lane == LaneThreadPool.LARGE:
+                # keep a slot for small files. with a single slot, large files only start while no small file waits
+                if self.active_limit > 1:
+                    large_limit = self.active_limit - 1
+                else:
+                    large_limit = 0 if self.lanes[LaneThreadPool.SMALL] else 1
+                if self.active_large_tasks >= large_limit:
+                    continue
+            return task_lane
+        return None
+
+    def next_task(self, lane):
+        """ Waits for a task the worker may run. Returns the function, its arguments and the lane of the task """
+        with self.condition:
+            self.condition.wait_for(lambda: self.get_task_lane(lane) is not None)
+            task_lane = self.get_task_lane(lane)
+            func, args = self.lanes[task_lane].popleft()
+            self.active_tasks += 1
+            if task_lane == LaneThreadPool.LARGE:
+                self.active_large_tasks += 1
+            self.condition.notify_all()
+            return func, args, task_lane
+
+    def task_done(self, lane=SMALL):
+        with self.condition:
+            self.unfinished_tasks -= 1
+            self.active_tasks -= 1
+            if lane == LaneThreadPool.LARGE:
+                self.active_large_tasks -= 1
+            self.condition.notify_all()
+
+    def set_active_limit(self, active_threads):
+        """ Change the number of workers that may run tasks at the same time """
+        with self.condition:
+            self.active_limit = active_threads
+            self.condition.notify_all()
+
+    def get_stats(self):
+        """ Returns the number of queued tasks, running tasks and worker threads that may run tasks """
+        with self.condition:
+            return {'queued': len(self.lanes[LaneThreadPool.LARGE]) + len(self.lanes[LaneThreadPool.SMALL]),
+                    'active': self.active_tasks, 'threads': self.active_limit}
+
+    def wait_completion(self):
+        """ Wait for completion of all the tasks in both lanes """
+        with self.condition:
+            self.condition.wait_for(lambda: self.unfinished_tasks == 0)
+
+
+class AdaptiveConcurrencyController(Thread):
+    """
+    Adjusts the number of active threads in a LaneThreadPool while a download runs. Every interval the aggregate
+    throughput and the number of errors are sampled. The thread count is increased by one while throughput keeps
+    improving (additive increase), and halved when errors or throttling responses are seen (multiplicative decrease).
+    """
+
+    def __init__(self, pool, sample_func, initial_threads, min_threads, max_threads, interval_seconds=10):
+        Thread.__init__(self)
+        self.pool = pool
+        # returns a (bytes transferred, errors, throttled requests) tuple of running totals
+        self.sample_func = sample_func
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.interval_seconds = interval_seconds
+        self.active_threads = min(max(initial_threads, min_threads), max_threads)
+        self.last_throughput = 0
+        self.last_sample = None
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+        self.pool.set_active_limit(self.active_threads)
+
+    def run(self):
+        self.last_sample = self.sample_func()
+        while not self.shutdown_flag.wait(self.interval_seconds):
+            self.adjust()
+
+    def adjust(self):
+        sample = self.sample_func()
+        transferred_bytes, errors, throttles = [new - old for new, old in zip(sample, self.last_sample)]
+        self.last_sample = sample
+        throughput = transferred_bytes / self.interval_seconds
+        previous_threads = self.active_threads
+        if errors or throttles:
+            self.active_threads = max(self.min_threads, self.active_threads // 2)
+            reason = '{} errors and {} throttled requests'.format(errors, throttles)
+        elif throughput >= self.last_throughput:
+            self.active_threads = min(self.max_threads, self.active_threads + 1)
+            reason = 'download rate is improving'
+        else:
+            self.active_threads = max(self.min_threads, self.active_threads - 1)
+            reason = 'download rate dropped'
+        self.last_throughput = throughput
+        if self.active_threads != previous_threads:
+            logger.info('Adjusting worker threads from {} to {} ({}, {}/s)'.format(
+                previous_threads, self.active_threads, reason, human_size(throughput)))
+            self.pool.set_active_limit(self.active_threads)
+        else:
+            logger.debug('Keeping {} worker threads ({}, {}/s)'.format(self.active_threads, reason,
+                                                                      human_size(throughput)))
+
+    def stop(self):
+        self.shutdown_flag.set()
+        logger.info('Worker thread count settled at {}'.format(self.active_threads))
+
+
+def get_presigned_url_expiration(presigned_url):
+    """ Returns the time a presigned url expires, or None if the url does not contain an expiration """
+    query = {k.lower(): v[0] for k, v in parse_qs(urlparse(presigned_url).query).items()}
+    try:
+        if 'x-amz-date' in query and 'x-amz-expires' in query:
+            # signature version 4
+            signed_at = datetime.datetime.strptime(query['x-amz-date'], '%Y%m%dT%H%M%SZ')
+            return signed_at.replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(
+                seconds=int(query['x-amz-expires']))
+        elif 'expires' in query:
+            # signature version 2
+            return datetime.datetime.fromtimestamp(int(query['expires']), tz=datetime.timezone.utc)
+    except ValueError:
+        pass
+    return None
+
+
+def is_presigned_url_expiring(presigned_url, margin_seconds=60):
+    expiration = get_presigned_url_expiration(presigned_url)
+    if expiration is None:
+        return False
+    return expiration - datetime.timedelta(seconds=margin_seconds) <= datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_temp_credentials_expiration(credentials):
+    """ Returns the expiration_date of temporary s3 credentials, or None if they do not have one """
+    try:
+        expiration = datetime.datetime.fromisoformat(credentials['expiration_date'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+    return expiration
+
+
+def is_temp_credentials_expiring(credentials, margin_seconds=60):
+    """ Returns True if temporary s3 credentials have an expiration_date that is less than margin_seconds away """
+    expiration = get_temp_credentials_expiration(credentials)
+    if expiration is None:
+        return False
+    return expiration - datetime.timedelta(seconds=margin_seconds) <= datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_url_expiration(url):
+    """ Returns the time a presigned url or temporary s3 credentials expire, or None if it is not known """
+    if isinstance(url, dict):
+        return get_temp_credentials_expiration(url)
+    if url:
+        return get_presigned_url_expiration(url)
+    return None
+
+
+def get_shard_numbers(df, shard_count, shard_by='id'):
+    """
+    Returns the shard (from 1 to shard_count) of each row of df. Shards only depend on the files in df, so every
+    machine running with the same arguments splits a package the same way.
+
+    With shard_by='id' the shard is a hash of the package_file_id. With shard_by='size' the files are sorted from
+    largest to smallest and dealt out to the shards in a snake order (1..N, N..1, ...), so that each shard gets about
+    the same number of bytes.
+    """
+    file_ids = df['package_file_id'].astype('int64')
+    if shard_by == 'size':
+        files = pd.DataFrame({'package_file_id': file_ids,
+                              'file_size': pd.to_numeric(df['file_size'], errors='coerce').fillna(0)})
+        # repeated rows of the metadata file must end up in the same shard
+        files = files.drop_duplicates(subset=['package_file_id']) \
+            .sort_values(['file_size', 'package_file_id'], ascending=[False, True], kind='stable')
+        position = np.arange(len(files))
+        offset = position % shard_count
+        shards = np.where((position // shard_count) % 2 == 0, offset, shard_count - 1 - offset) + 1
+        return file_ids.map(pd.Series(shards, index=files['package_file_id'].to_numpy())).to_numpy()
+    hashes = pd.util.hash_array(file_ids.to_numpy())
+    return (hashes % np.uint64(shard_count)).astype('int64') + 1
+
+
+def is_transient_download_error(e):
+    """
+    Returns True for errors that are worth retrying in the same run - dropped connections, timeouts, throttling and
+    server errors - as opposed to errors that will happen again, such as a missing file or a full disk
+    """
+    if isinstance(e, HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or e.response.status_code == 429)
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError, ConnectionError, TimeoutError, TransferStalledError)):
+        return True
+    # response bodies are read from the urllib3 or http.client response, which raise their own errors for dropped
+    # connections
+    if isinstance(e, (urllib3.exceptions.HTTPError, http.client.HTTPException)):
+        return True
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    if isinstance(e, botocore.exceptions.ClientError):
+        status_code = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return status_code >= 500 or e.response.get('Error', {}).get('Code') in (
+            'SlowDown', 'Throttling', 'RequestTimeout', 'InternalError', 'ServiceUnavailable')
+    return False
+
+
+class PresignedUrlPrefetcher(Thread):
+    """
+    Requests presigned urls (or temporary credentials, for copies to an s3 destination) in the background, several
+    batches ahead of the download workers, so that url generation overlaps with file transfers. The batch size grows
+    while the service responds quickly and shrinks when it slows down, but never past the number of files that can be
+    handed out before their urls expire. Batches never mix files from different lanes.
+    """
+
+    def __init__(self, files, get_presigned_urls, min_batch_size=50, max_batch_size=5000, lookahead_batches=4,
+                 target_seconds=5, get_url_function=None, refresh_margin_seconds=300):
+        Thread.__init__(self)
+        # iterable of (lane, package_file) tuples
+        self.files = files
+        # function returning a dict of package_file_id to presigned url. None if the files do not need urls
+        self.get_presigned_urls = get_presigned_urls
+        # when files of different lanes need urls from different functions (e.g. a download of several packages,
+        # where the lane is a tuple including the package) this returns the function to use for a lane
+        self.get_url_function = get_url_function
+        self.batch_size = min_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_seconds = target_seconds
+        self.lookahead_batches = lookahead_batches
+        self.prefetched = Queue(lookahead_batches)
+        # urls that expire within this many seconds are requested again before the batch is handed out
+        self.refresh_margin_seconds = refresh_margin_seconds
+        # seconds a url is valid for when it is received, taken from the most recent batch
+        self.url_lifetime = None
+        # number of files handed out by batches() since the first batch was, used to estimate the consumption rate
+        self.handed_out_files = 0
+        self.first_handed_out = None
+        self.error = None
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+
+    def run(self):
+        try:
+            batch = []
+            batch_lane = None
+            for lane, package_file in self.files:
+                if self.shutdown_flag.is_set():
+                    return
+                if batch and (lane != batch_lane or len(batch) >= self.batch_size):
+                    self.fetch(batch_lane, batch)
+                    batch = []
+                batch_lane = lane
+                batch.append(package_file)
+            if batch:
+                self.fetch(batch_lane, batch)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.prefetched.put(None)
+
+    def fetch(self, lane, package_files):
+        get_presigned_urls = self.get_url_function(lane) if self.get_url_function else self.get_presigned_urls
+        if get_presigned_urls is None:
+            self.prefetched.put((lane, [(f, None) for f in package_files]))
+            return
+        start = time.time()
+        urls = get_presigned_urls([f['package_file_id'] for f in package_files])
+        elapsed = time.time() - start
+        expiration = get_url_expiration(next(iter(urls.values()), None))
+        if expiration is not None:
+            self.url_lifetime = (expiration - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        if elapsed < self.target_seconds / 2:
+            self.batch_size = min(self.get_max_batch_size(), self.batch_size * 2)
+        elif elapsed > self.target_seconds:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        else:
+            self.batch_size = min(self.get_max_batch_size(), self.batch_size)
+        logger.debug('Retrieved {} presigned urls in {:.2f}s. Next batch size is {}'.format(len(urls), elapsed,
+                                                                                          self.batch_size))
+        self.prefetched.put((lane, [(f, urls[f['package_file_id']]) for f in package_files
+                                    if f['package_file_id'] in urls]))
+
+    def get_max_batch_size(self):
+        """
+        Returns the largest batch size for which every prefetched url is handed out within half of its lifetime, at
+        the rate files have been handed out so far
+        """
+        if self.url_lifetime is None or not self.handed_out_files:
+            return self.max_batch_size
+        files_per_second = self.handed_out_files / max(time.time() - self.first_handed_out, 1)
+        # the batch being fetched waits behind the lookahead batches already in the queue
+        batch_size = int(files_per_second * self.url_lifetime / 2 / (self.lookahead_batches + 1))
+        return max(self.min_batch_size, min(self.max_batch_size, batch_size))
+
+    def refresh_expiring_urls(self, lane, package_files):
+        """ Requests new urls for the files of a batch whose urls expired while the batch waited in the queue """
+        refresh_before = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=self.refresh_margin_seconds)
+        expiring = [f for f, url in package_files if (get_url_expiration(url) or refresh_before) < refresh_before]
+        if not expiring:
+            return package_files
+        logger.debug('Requesting new urls for {} files whose urls expire soon'.format(len(expiring)))
+        get_presigned_urls = self.get_url_function(lane) if self.get_url_function else self.get_presigned_urls
+        urls = get_presigned_urls([f['package_file_id'] for f in expiring])
+        metrics_registry.inc('nda_credential_refreshes_total', len(urls),
+                             kind='s3_credentials' if isinstance(package_files[0][1], dict) else 'presigned_url')
+        return [(f, urls.get(f['package_file_id'], url)) for f, url in package_files]
+
+    def batches(self):
+        """ Yields (lane, [(package_file, presigned_url)...]) tuples in the order they were fetched """
+        while True:
+            batch = self.prefetched.get()
+            if batch is None:
+                break
+            lane, package_files = batch
+            if self.first_handed_out is None:
+                self.first_handed_out = time.time()
+            yield lane, self.refresh_expiring_urls(lane, package_files)
+            self.handed_out_files += len(package_files)
+        if self.error:
+            raise self.error
+
+
+def get_known_file_size(file_size):
+    """ Returns the file size from the package metadata as an int, or None if the size is not known """
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        return None
+    return file_size if file_size >= 0 else None
+
+
 class DownloadRequest:
 
     def __init__(self, package_file, presigned_url, package_id, download_dir):
@@ -85,11 +497,101 @@ class DownloadRequest:
             os.path.join(NDATools.NDA_TOOLS_DOWNLOADS_FOLDER, str(package_id)))
         self.nda_s3_url = None
         self.exists = False
-        self.expected_file_size = package_file['file_size']
+        # None when the package metadata does not have the size of the file
+        self.expected_file_size = get_known_file_size(package_file['file_size'])
         self.actual_file_size = 0
-        self.e_tag = None,
+        self.e_tag = None
+        # digest of the downloaded bytes, in the same format as an s3 ETag
+        self.checksum = None
+        # 'verified', 'mismatch' or 'unverified' (when there is nothing to compare the checksum with), see
+        # verify_checksum. files that do not match a multipart ETag are kept, with a status of 'mismatch'
+        self.checksum_status = None
         self.download_complete_time = None
         self.partial_download_abs_path = self.completed_download_abs_path + '.partial'
+        # records which byte ranges of the .partial file are complete when a file is downloaded in parts
+        self.partial_download_parts_abs_path = self.partial_download_abs_path + '.parts'
+
+
+class DownloadJob:
+    """
+    The files of one package that are left to download in a run, along with the journal recording its progress and
+    the file listing the s3 links of the files that failed
+    """
+
+    def __init__(self, download, progress_journal, failed_s3_links_file, completed_file_ids, duplicate_files,
+                 large_files_df, small_files_df):
+        self.download = download
+        self.progress_journal = progress_journal
+        self.failed_s3_links_file = failed_s3_links_file
+        self.completed_file_ids = completed_file_ids
+        # dict of the package_file_id of a file being downloaded to the other files with the same s3 object
+        self.duplicate_files = duplicate_files
+        self.lanes = {LaneThreadPool.LARGE: large_files_df, LaneThreadPool.SMALL: small_files_df}
+        self.success_files = set()
+        self.request_count = 0
+
+    def generate_download_files(self, lane):
+        for package_files in self.download.generate_download_batch_file_ids(self.completed_file_ids,
+                                                                            self.lanes[lane]):
+            yield from package_files
+
+    def get_url_function(self):
+        # files copied to the user's own s3 bucket need temporary credentials instead of presigned urls
+        if self.download.custom_user_s3_endpoint:
+            return self.download.get_temp_creds_for_files
+        return self.download.get_presigned_urls
+
+    def write_to_download_progress_journal(self, download_record):
+        # if file-size =0, there could have been an error. Dont add to the journal
+        if int(download_record.actual_file_size) > 0:
+            self.progress_journal.record(vars(download_record))
+
+    def download_file(self, package_file, temp_credentials=None, on_downloaded=None):
+        download = self.download
+        if download.custom_user_s3_endpoint:
+            # credentials that expire while the file waits in the queue are requested again by download_to_s3
+            download_record = download.download_from_s3link(package_file, None, temp_credentials=temp_credentials,
+                                                            failed_s3_links_file=self.failed_s3_links_file)
+        else:
+            # urls can expire while the file waits in the queue. only hand out urls that are still valid
+            if temp_credentials and is_presigned_url_expiring(temp_credentials):
+                logger.debug('Presigned url for file {} has expired. Requesting a new url'.format(
+                    package_file['package_file_id']))
+                metrics_registry.inc('nda_credential_refreshes_total', kind='presigned_url')
+                temp_credentials = download.get_presigned_urls([package_file['package_file_id']])[
+                    package_file['package_file_id']]
+            # check if  these exist, and if not, get and set:
+            download_record = download.download_from_s3link(package_file, temp_credentials,
+                                                            failed_s3_links_file=self.failed_s3_links_file)
+        # dont add bytes if file-existed and didnt need to be downloaded
+        if download_record.download_complete_time:
+            if download.custom_user_s3_endpoint:
+                # bytes are counted as they are received for local downloads. s3 copies are counted when complete
+                download.record_transferred_bytes(int(download_record.actual_file_size),
+                                                  download_record.package_file_id)
+        self.success_files.add(package_file['package_file_id'])
+        if on_downloaded:
+            on_downloaded()
+
+        self.write_to_download_progress_journal(download_record)
+
+        if download_record.exists:
+            for duplicate_file in self.duplicate_files.pop(package_file['package_file_id'], []):
+                self.write_to_download_progress_journal(
+                    download.link_duplicate_file(download_record, duplicate_file, self.failed_s3_links_file))
+                self.success_files.add(duplicate_file['package_file_id'])
+
+    def finish(self):
+        self.failed_s3_links_file.flush()
+        self.failed_s3_links_file.close()
+        # keep the csv report up to date for anything that reads it
+        self.progress_journal.export_csv(self.download.get_download_progress_report_path())
+        self.progress_journal.close()
+
+        # dont generate a file if there were no failures
+        if not self.download.package_file_download_errors:
+            logger.info('No failures detected. Removing file {}'.format(self.failed_s3_links_file.name))
+            os.remove(self.failed_s3_links_file.name)
 
 
 class Download(Protocol):
@@ -118,6 +620,9 @@ class Download(Protocol):
         self.package_id = args.package
         self.data_structure = args.datastructure
         self.thread_num = download_config.worker_threads
+        # with '-wt auto' the pool is sized to the upper bound and the number of active threads changes while running
+        self.adaptive_threads = download_config.adaptive_worker_threads
+        self.max_thread_num = max(self.thread_num, 64) if self.adaptive_threads else self.thread_num
         self.regex_file_filter = args.file_regex
         if self.s3_links_file:
             self.download_mode = 'text'
@@ -136,6 +641,30 @@ class Download(Protocol):
                 'Important - You can configure the thread count setting using the --workerThreads argument to maximize your download speed.\n')
         # for copying files directly to another s3 bucket
         self.custom_user_s3_endpoint = args.s3_destination
+        # files at or above the threshold are downloaded as byte ranges in parallel. 0 disables multipart downloads
+        self.multipart_threshold = args.multipart_threshold * MB
+        self.multipart_chunksize = args.multipart_chunksize * MB
+        # number of threads that write downloaded data to disk. 0 writes from the download threads
+        self.writer_thread_num = args.writer_threads
+        # objects of 5GB or more are copied to the -s3 destination in parts of this size, several at a time
+        self.s3_copy_part_size = args.s3_copy_part_size * MB
+        self.s3_copy_concurrency = args.s3_copy_concurrency
+        # files are shared with downloads of other packages through the cache, when one is configured
+        self.download_cache = DownloadCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+        self.keep_metadata_gz = args.keep_metadata_gz
+        # throughput, in-flight and per-file timings of the run. saved as json at the end with --metrics-json
+        self.metrics = DownloadMetrics()
+        self.metrics_json_path = args.metrics_json
+        # files that fail with a transient error are retried this many times in the same run, resuming from the
+        # bytes that were already downloaded
+        self.download_retries = args.retries
+        self.retry_backoff = Backoff(initial=2, maximum=60, multiplier=2)
+        # transfers much slower than the rest of the run are cancelled and retried. 0 disables the check
+        self.slow_transfer_ratio = args.slow_transfer_ratio
+        self.stall_detector = None
+        # with --shard i/N only the i-th of N parts of the files is downloaded, so a package can be split across machines
+        self.shard = args.shard
+        self.shard_by = args.shard_by
 
         # non-configurable default instance variables
         self.download_queue = Queue()
@@ -154,7 +683,9 @@ class Download(Protocol):
             's3_destination': self.custom_user_s3_endpoint,
             'data_structure': self.data_structure,
             's3_links_file': self.s3_links_file,
-            'regex': self.regex_file_filter
+            'regex': self.regex_file_filter,
+            'shard': '{}/{}'.format(*self.shard) if self.shard else None,
+            'shard_by': self.shard_by if self.shard else None
         }
         self.download_job_progress_report_column_defs = {
             'package_file_id': None,
@@ -164,10 +695,38 @@ class Download(Protocol):
             'expected_file_size': None,
             'actual_file_size': 0,
             'e_tag': None,
+            'checksum': None,
+            'checksum_status': None,
             'download_complete_time': None
         }
         self.download_progress_report_file_path = self.initialize_verification_files()
         self.default_download_batch_size = 50
+        # files at or above this size are scheduled first, on the large-file lane of the download pool
+        self.large_file_threshold = 100 * MB
+        self.large_file_lane_threads = max(1, self.max_thread_num // 4)
+        # running totals used to adjust the thread count when running with '-wt auto'
+        self.transfer_stats_lock = threading.Lock()
+        self.transferred_bytes = 0
+        self.transfer_errors = 0
+        self.transfer_throttles = 0
+        # a single session is shared by every download thread so that keep-alive connections to s3 are reused
+        # across files instead of paying for a new TCP+TLS handshake per file. adapters are mounted per host
+        self._http_session = None
+        self._http_session_hosts = set()
+        self._http_session_lock = threading.Lock()
+        # byte ranges of large files are fetched on their own pool so download workers can wait on them
+        self._part_executor = None
+        self._part_executor_lock = threading.Lock()
+        # s3 clients used to copy files to an -s3 destination, keyed by the temporary credentials they were created with
+        self._boto3_session = None
+        self._s3_clients = {}
+        self._s3_client_lock = threading.Lock()
+        # response bodies are read into reusable buffers instead of allocating a new chunk for every read.
+        # download workers and part threads each hold one buffer at a time, the rest can be queued for disk writers
+        self.download_chunk_size = 5 * MB
+        self.buffer_pool = BufferPool(self.download_chunk_size, 2 * self.max_thread_num + 4 * self.writer_thread_num)
+        self._disk_writers = None
+        self._disk_writer_lock = threading.Lock()
         self.metadata_file_path = os.path.join(self.package_metadata_directory,
                                                NDATools.NDA_TOOLS_PACKAGE_FILE_METADATA_TEMPLATE % self.package_id)
 
@@ -188,9 +747,11 @@ class Download(Protocol):
         if self.verify_flg and '--verify' not in exclude_arg_list:
             download_cmd += ' --verify'
         if self.thread_num and '--workerThreads' not in exclude_arg_list:
-            download_cmd += ' -wt {}'.format(self.thread_num)
+            download_cmd += ' -wt {}'.format('auto' if self.adaptive_threads else self.thread_num)
         if self.custom_user_s3_endpoint and '--s3-destination' not in exclude_arg_list:
             download_cmd += ' -s3 {}'.format(self.custom_user_s3_endpoint)
+        if self.shard and '--shard' not in exclude_arg_list:
+            download_cmd += ' --shard {}/{} --shard-by {}'.format(*self.shard, self.shard_by)
 
         return download_cmd
 
@@ -209,7 +770,46 @@ class Download(Protocol):
         logger.info('')
         return package_resource
 
-    def start(self):
+    def start(self, other_downloads=()):
+        """
+        Downloads the files of the package. Downloads of other packages given in other_downloads are run at the same
+        time, sharing the download threads, http connections and presigned url pipeline of this download, while each
+        package keeps its own directory and download progress
+        """
+        for other_download in other_downloads:
+            other_download.share_transfer_resources(self)
+        jobs = []
+        for download in [self, *other_downloads]:
+            job = download.prepare_download()
+            if job is not None:
+                jobs.append(job)
+        if not jobs:
+            logger.info('')
+            logger.info('Exiting Program...')
+            return
+        self.run_download_jobs(jobs, [self, *other_downloads])
+
+    def share_transfer_resources(self, owner):
+        """
+        Uses the http session, part and disk writer threads, buffers, s3 clients, cache and metrics of owner (a
+        Download of another package) instead of creating its own
+        """
+        if self.download_cache and self.download_cache is not owner.download_cache:
+            self.download_cache.close()
+        self.download_cache = owner.download_cache
+        self.buffer_pool = owner.buffer_pool
+        self.metrics = owner.metrics
+        self.get_http_session = owner.get_http_session
+        self.get_part_executor = owner.get_part_executor
+        self.get_disk_writer = owner.get_disk_writer
+        self.get_s3_client = owner.get_s3_client
+        self.stall_detector = owner.stall_detector
+
+    def prepare_download(self):
+        """
+        Gets the list of files in the download, and returns a DownloadJob with the files which have not been
+        downloaded yet, or None if every file has been downloaded
+        """
         package_resource = self.get_and_display_package_info()
 
         # self.save_package_file_metadata()
@@ -230,50 +830,25 @@ class Download(Protocol):
             df = self.get_all_files_in_package()
         else:
             df = self.query_files_by_s3_path(self.inline_s3_links)
-
-        if self.regex_file_filter:
-            df = df[df.download_alias.str.contains(self.regex_file_filter)]
+        df = self.select_shard(df)
 
         logger.info('')
 
-        success_files = set()
-        download_request_count = 0
-        download_start_date = datetime.datetime.now()
-
-        download_progress_report = open(self.download_progress_report_file_path, 'a', newline='')
-        download_progress_report_writer = csv.DictWriter(download_progress_report,
-                                                         fieldnames=self.download_job_progress_report_column_defs,
-                                                         extrasaction='ignore')
-        failed_s3_links_file = tempfile.NamedTemporaryFile(mode='a',
-                                                           delete=False,
-                                                           prefix='failed_s3_links_file_{}'.format(
-                                                               time.strftime("%Y%m%dT%H%M%S")),
-                                                           suffix='.csv',
-                                                           dir=NDATools.NDA_TOOLS_DOWNLOADCMD_LOGS_FOLDER
-                                                           )
-
-        message = 'S3 links for files that failed to download will be written out to {}. You can attempt to download these files later by running: ' \
-            .format(failed_s3_links_file.name)
-        message += '\n\t{} -t "{}"' \
-            .format(self.build_rerun_download_cmd(['--text', '--datastructure']), failed_s3_links_file.name)
-        logger.info(message)
-        logger.info('')
-        # time.sleep(1.5)
+        progress_journal = self.get_download_progress_journal()
 
         tmp = df[df['download_alias'] != f'package_file_metadata_{self.package_id}.txt.gz']
         file_ct_all = tmp['download_alias'].unique().size
         file_ct_remaining = file_ct_all
-        file_sz = tmp['file_size'].sum()
+        file_sz = tmp['file_size'].clip(lower=0).sum()
         tmp = {}
 
         # remove files that have already been completed
-        completed_files = self.get_completed_files_in_download()
-        tmp = {int(f['package_file_id']): int(f['actual_file_size']) for f in completed_files}
+        tmp = progress_journal.get_completed_file_sizes()
 
         completed_file_sz = sum(tmp.values())
         completed_file_ids = set(tmp.keys())
         completed_file_ct = len(completed_file_ids)
-        completed_files = tmp = None  # remove large structures from memory
+        tmp = None  # remove large structures from memory
         skipping_message = ''
 
         if completed_file_ct > 0:
@@ -281,11 +856,8 @@ class Download(Protocol):
                 skipping_message = 'Skipping {} files which have already been downloaded in {}\n'.format(
                     completed_file_ct, self.download_directory)
             else:
-                download_progress_report_path = os.path.join(self.package_metadata_directory,
-                                                             '.download-progress', self.download_job_uuid,
-                                                             'download-progress-report.csv')
                 skipping_message = 'Skipping {} files which have already been downloaded according to log file {}.\n'.format(
-                    completed_file_ct, download_progress_report_path)
+                    completed_file_ct, progress_journal.db_path)
             file_ct_remaining = file_ct_all - completed_file_ct
             file_sz -= completed_file_sz
 
@@ -298,9 +870,23 @@ class Download(Protocol):
                     logger.info('No file was found that matched the regex pattern {}'.format(self.regex_file_filter))
             else:
                 logger.info('All files have been downloaded')
-            logger.info('')
-            logger.info('Exiting Program...')
-            return
+            progress_journal.close()
+            return None
+
+        failed_s3_links_file = tempfile.NamedTemporaryFile(mode='a',
+                                                           delete=False,
+                                                           prefix='failed_s3_links_file_{}'.format(
+                                                               time.strftime("%Y%m%dT%H%M%S")),
+                                                           suffix='.csv',
+                                                           dir=NDATools.NDA_TOOLS_DOWNLOADCMD_LOGS_FOLDER
+                                                           )
+
+        message = 'S3 links for files that failed to download will be written out to {}. You can attempt to download these files later by running: ' \
+            .format(failed_s3_links_file.name)
+        message += '\n\t{} -t "{}"' \
+            .format(self.build_rerun_download_cmd(['--text', '--datastructure', '--shard']), failed_s3_links_file.name)
+        logger.info(message)
+        logger.info('')
 
         message = '{}Beginning download of {}{} files{} to {} using {} threads'.format(
             skipping_message,
@@ -308,136 +894,320 @@ class Download(Protocol):
             file_ct_remaining if skipping_message else file_ct_all,
             f' matching {self.regex_file_filter}' if self.regex_file_filter else '',
             self.custom_user_s3_endpoint or self.download_directory,
-            self.thread_num)
+            'between 1 and {} (adjusted automatically)'.format(self.max_thread_num) if self.adaptive_threads
+            else self.thread_num)
 
         logger.info('')
         logger.info(message)
 
-        # These are all arrays just so that the print_download_progress_report method can update the variables inside them
-        trailing_50_file_bytes = []
-        trailing_50_timestamp = [datetime.datetime.now()]
-
-        download_progress_flush_date = [datetime.datetime.now()]
-
-        def write_to_download_progress_report_file(download_record):
-            # if file-size =0, there could have been an error. Dont add to file
-            newRecord = vars(download_record)
-            if type(newRecord['actual_file_size']) is tuple:
-                check = newRecord['actual_file_size'][0] > 0
-            else:
-                check = newRecord['actual_file_size'] > 0
-            if check:
-                download_progress_report_writer.writerow(newRecord)
-                if (datetime.datetime.now() - download_progress_flush_date[0]).seconds > 10:
-                    download_progress_report.flush()
-                    download_progress_flush_date[0] = datetime.datetime.now()
-                else:
-                    pass
+        # files that point at the same s3 object are downloaded once and linked to their other locations
+        duplicate_files = {}
+        if not self.custom_user_s3_endpoint:
+            df, duplicate_files = self.group_duplicate_files(df, completed_file_ids)
+            duplicate_file_ct = sum(len(files) for files in duplicate_files.values())
+            if duplicate_file_ct:
+                logger.info('{} files have the same s3 object as another file in the download. Each object will be '
+                            'downloaded once and linked to its other locations'.format(duplicate_file_ct))
+
+        large_files_df, small_files_df = self.split_download_lanes(df)
+        if not large_files_df.empty and self.max_thread_num > 1:
+            logger.info('Scheduling files larger than {} first, on {} of the {} threads'.format(
+                human_size(self.large_file_threshold), min(self.large_file_lane_threads, self.max_thread_num - 1),
+                self.max_thread_num))
+        return DownloadJob(self, progress_journal, failed_s3_links_file, completed_file_ids, duplicate_files,
+                           large_files_df, small_files_df)
+
+    def run_download_jobs(self, jobs, downloads):
+        """
+        Downloads the files of the jobs on a single thread pool. Presigned urls for all of the jobs are requested by
+        one prefetcher per lane, in batches that never mix files of different packages
+        """
+        download_start_date = datetime.datetime.now()
 
-        def print_download_progress_report(num_downloaded):
+        def to_bits_per_second(bytes_per_second):
+            speed = human_size(int(8 * bytes_per_second))
+            if speed[-1:] == 'B':
+                return speed.replace('B', 'bps')
+            return speed.replace('bytes', 'bps')
 
-            byte_total = sum(trailing_50_file_bytes)
+        def print_download_progress_report():
+            metrics = self.metrics.snapshot()
             download_progress_message = 'Download Progress Report [{}]: \n    {}/{} queued files downloaded so far. ' \
-                .format(datetime.datetime.now().strftime('%b %d %Y %H:%M:%S'), num_downloaded, download_request_count)
-            download_progress_message += '\n    Last 50 files contained ~ {} and finished in {} (Hours:Minutes:Seconds). ' \
-                .format(human_size(byte_total),
-                        str(datetime.datetime.now() - trailing_50_timestamp[0]).split('.')[0])
-
-            seconds_last_50_files = (datetime.datetime.now() - trailing_50_timestamp[0]).seconds
-            if seconds_last_50_files == 0:
-                seconds_last_50_files = 1  # avoid a 'division by 0' error
-
-            # convert download speed to bits per second
-            avg_speed_bps = human_size((8 * byte_total) // seconds_last_50_files)
-            if avg_speed_bps[-1:] == 'B':
-                avg_speed_bps = avg_speed_bps.replace('B', 'bps')
-            else:
-                avg_speed_bps = avg_speed_bps.replace('bytes', 'bps')
-
-            download_progress_message += '\n    Avg download rate (in bits per second) for the last 50 files is ~ {}.' \
-                .format(avg_speed_bps)
-
+                .format(datetime.datetime.now().strftime('%b %d %Y %H:%M:%S'),
+                        sum(len(job.success_files) for job in jobs), sum(job.request_count for job in jobs))
+            download_progress_message += '\n    {} downloaded. Download rate (in bits per second) is ~ {} ' \
+                                         '(average ~ {}).'.format(human_size(metrics['bytes_transferred']),
+                                                                  to_bits_per_second(
+                                                                      metrics['throughput_bytes_per_second']),
+                                                                  to_bits_per_second(
+                                                                      metrics['average_bytes_per_second']))
+            download_progress_message += '\n    {} files in progress with ~ {} left to download, {} files waiting in ' \
+                                         'the queue, {} idle threads.'.format(metrics['files_in_flight'],
+                                                                             human_size(metrics['bytes_in_flight']),
+                                                                             metrics.get('queue_depth', 0),
+                                                                             metrics.get('idle_workers', 0))
             download_progress_message += '\n    Download has been in progress for {} (Hours:Minutes:Seconds).\n' \
                 .format(str(datetime.datetime.now() - download_start_date).split('.')[0])
 
             download_progress_message = '\n' + download_progress_message + '\n'
             logger.info(download_progress_message)
-            trailing_50_file_bytes.clear()
-            trailing_50_timestamp[0] = datetime.datetime.now()
-
-        def download(package_file, temp_credentials=None):
-            # check if  these exist, and if not, get and set:
-            download_record = self.download_from_s3link(package_file, temp_credentials,
-                                                        failed_s3_links_file=failed_s3_links_file)
-            # dont add bytes if file-existed and didnt need to be downloaded
-            if download_record.download_complete_time:
-                trailing_50_file_bytes.append(download_record.actual_file_size)
-            success_files.add(package_file['package_file_id'])
-            num_downloaded = len(success_files)
-
-            if num_downloaded % 50 == 0:
-                print_download_progress_report(num_downloaded)
-
-            download_progress_file_writer_pool.map(write_to_download_progress_report_file, [[download_record]])
-
-        download_pool = ThreadPool(self.thread_num, self.thread_num * 6)
-        download_progress_file_writer_pool = ThreadPool(1, 1000)
-
-        for package_files in self.generate_download_batch_file_ids(completed_file_ids, df):
-            if len(package_files) > 0:
-                additional_file_ct = len(package_files)
-                download_request_count += additional_file_ct
-                logger.info('Adding {} files to download queue. Queue contains {} files\n'.format(additional_file_ct,
-                                                                                                  download_request_count))
-                pkfiles = {f['package_file_id']: f for f in package_files}
-                if self.custom_user_s3_endpoint:
-                    # we dont need presigned urls if the user is transferring to their own s3 bucket
-                    file_id_to_cred_list = {f['package_file_id']: None for f in package_files}
-                else:
-                    file_id_to_cred_list = self.get_presigned_urls(list(pkfiles.keys()))
-                download_pool.map(download, [[pkfiles[file_id], file_credentials] for file_id, file_credentials in
-                                             file_id_to_cred_list.items()])
+            progress_reporter.reported()
+
+        def file_downloaded():
+            if sum(len(job.success_files) for job in jobs) % 50 == 0:
+                print_download_progress_report()
+
+        def get_transfer_stats():
+            # the thread count is adjusted for the combined throughput and errors of every package
+            return tuple(map(sum, zip(*(download.get_transfer_stats() for download in downloads))))
+
+        # reports are printed every 50 files, and every minute while no files finish (e.g. during large files)
+        progress_reporter = MetricsReporter(print_download_progress_report, interval_seconds=60)
+
+        download_pool = LaneThreadPool(self.max_thread_num, self.large_file_lane_threads, self.thread_num * 6,
+                                       active_threads=self.thread_num)
+        self.metrics.set_pool(download_pool)
+        progress_reporter.start()
+        stall_detector = None
+        if self.slow_transfer_ratio:
+            # once no files are waiting for a thread, the slowest transfers decide when the run finishes
+            stall_detector = StallDetector(self.slow_transfer_ratio,
+                                           is_run_ending=lambda: download_pool.get_stats()['queued'] == 0)
+            stall_detector.start()
+        for download in downloads:
+            download.stall_detector = stall_detector
+        metrics_registry.add_collector(self.collect_metrics)
+        concurrency_controller = None
+        if self.adaptive_threads:
+            concurrency_controller = AdaptiveConcurrencyController(download_pool, get_transfer_stats,
+                                                                   self.thread_num, 1, self.max_thread_num)
+            concurrency_controller.start()
+
+        request_count_lock = threading.Lock()
+
+        def generate_download_files(lane):
+            for job in jobs:
+                for package_file in job.generate_download_files(lane):
+                    yield (job, lane), package_file
+
+        def feed_lane(lane):
+            # each lane has its own feeder, so that a full lane only blocks its own feeder. otherwise small files
+            # would not be queued until every large file had been queued
+            # large files take long enough to download that bigger batches would only leave urls to expire
+            url_prefetcher = PresignedUrlPrefetcher(generate_download_files(lane), None,
+                                                    min_batch_size=self.default_download_batch_size,
+                                                    max_batch_size=self.default_download_batch_size
+                                                    if lane == LaneThreadPool.LARGE else 5000,
+                                                    get_url_function=lambda key: key[0].get_url_function())
+            url_prefetcher.start()
+            for (job, _), package_files in url_prefetcher.batches():
+                with request_count_lock:
+                    job.request_count += len(package_files)
+                    queued_count = sum(j.request_count for j in jobs)
+                logger.info('Adding {} files to download queue. Queue contains {} files\n'.format(
+                    len(package_files), queued_count))
+                download_pool.map(job.download_file, [[package_file, presigned_url, file_downloaded]
+                                                      for package_file, presigned_url in package_files], lane)
+
+        with ThreadPoolExecutor(max_workers=2) as feeders:
+            for feeder in [feeders.submit(feed_lane, lane) for lane in (LaneThreadPool.LARGE, LaneThreadPool.SMALL)]:
+                feeder.result()
 
         download_pool.wait_completion()
-        download_progress_file_writer_pool.wait_completion()
-        failed_s3_links_file.flush()
-        failed_s3_links_file.close()
-        download_progress_report.flush()
-        download_progress_report.close()
-
-        # dont generate a file if there were no failures
-        if not self.package_file_download_errors:
-            logger.info('No failures detected. Removing file {}'.format(failed_s3_links_file.name))
-            os.remove(failed_s3_links_file.name)
+        if concurrency_controller:
+            concurrency_controller.stop()
+        progress_reporter.stop()
+        if stall_detector:
+            stall_detector.stop()
+        for download in downloads:
+            download.stall_detector = None
+        metrics_registry.remove_collector(self.collect_metrics)
+        if self.metrics_json_path:
+            self.metrics.export_json(self.metrics_json_path)
+            logger.info('Download metrics saved to {}'.format(self.metrics_json_path))
+        self.close_part_executor()
+        self.close_disk_writers()
+        self.close_http_session()
+        if self.download_cache:
+            self.download_cache.close()
+        for job in jobs:
+            job.finish()
 
         logger.info('')
 
         logger.info('Finished processing all download requests @ {}.'.format(datetime.datetime.now()))
-        logger.info('     Total download requests: {}'.format(download_request_count))
+        if len(jobs) > 1:
+            for job in jobs:
+                logger.info('     Package {}: {} download requests, {} errors'.format(
+                    job.download.package_id, job.request_count, len(job.download.package_file_download_errors)))
+        logger.info('     Total download requests: {}'.format(sum(job.request_count for job in jobs)))
 
-        download_error_count = len(self.package_file_download_errors)
+        download_error_count = sum(len(job.download.package_file_download_errors) for job in jobs)
         logger.info('     Total errors encountered: {}'.format(download_error_count))
 
-        if download_error_count > 0:
-            logger.info('     Failed to download {} files. See {} for more details'.format(download_error_count,
-                                                                                           failed_s3_links_file.name))
+        for job in jobs:
+            if job.download.package_file_download_errors:
+                logger.info('     Failed to download {} files. See {} for more details'.format(
+                    len(job.download.package_file_download_errors), job.failed_s3_links_file.name))
 
         logger.info('')
         logger.info(' Exiting Program...')
 
-    def download_local(self, download_request, err_if_exists=False):
-        # completed_download = os.path.normpath(os.path.join(self.download_directory, download_request.package_file_relative_path))
-        downloaded = False
-        resume_header = None
+    def get_http_session(self, presigned_url):
+        """
+        Returns the session shared by all download threads. The first request to a host mounts a connection pool
+        for that host, sized to the number of worker threads and part downloads, so connections are kept alive and
+        reused for every file in the run.
+        """
+        # the download workers and the threads of the part executor can all have a request open at the same time
+        pool_maxsize = self.max_thread_num * (2 if self.multipart_threshold else 1)
 
         # check if we are downloading from alt endpoint where bucket name contains dots.
         def get_http_adapter(s3_link):
             bucket, path = deconstruct_s3_url(s3_link)
-            config = {'max_retries': 10}
+            config = {'max_retries': 10, 'pool_connections': 1, 'pool_maxsize': pool_maxsize}
             if ('.' in bucket):
                 return AltEndpointSSLAdapter(**config)
             return HTTPAdapter(**config)
 
+        url = urlparse(presigned_url)
+        prefix = '{}://{}/'.format(url.scheme, url.netloc)
+        with self._http_session_lock:
+            if self._http_session is None:
+                self._http_session = requests.session()
+            if prefix not in self._http_session_hosts:
+                self._http_session.mount(prefix, get_http_adapter(presigned_url))
+                self._http_session_hosts.add(prefix)
+            return self._http_session
+
+    def close_http_session(self):
+        with self._http_session_lock:
+            if self._http_session is not None:
+                self._http_session.close()
+            self._http_session = None
+            self._http_session_hosts.clear()
+
+    def record_transferred_bytes(self, byte_count, file_id=None):
+        with self.transfer_stats_lock:
+            self.transferred_bytes += byte_count
+        self.metrics.record_bytes(byte_count, file_id)
+        metrics_registry.inc('nda_download_bytes_total', byte_count)
+
+    def collect_metrics(self):
+        """ Gauges exported with --metrics-file while the download runs """
+        snapshot = self.metrics.snapshot()
+        return {'nda_download_throughput_bytes_per_second': snapshot['throughput_bytes_per_second'],
+                'nda_download_files_in_flight': snapshot['files_in_flight'],
+                'nda_download_queue_depth': snapshot.get('queue_depth', 0)}
+
+    def get_transfer_stats(self):
+        with self.transfer_stats_lock:
+            return self.transferred_bytes, self.transfer_errors, self.transfer_throttles
+
+    def get_part_executor(self):
+        with self._part_executor_lock:
+            if self._part_executor is None:
+                self._part_executor = ThreadPoolExecutor(max_workers=self.max_thread_num,
+                                                         thread_name_prefix='download-part')
+            return self._part_executor
+
+    def close_part_executor(self):
+        with self._part_executor_lock:
+            if self._part_executor is not None:
+                self._part_executor.shutdown()
+            self._part_executor = None
+
+    def get_disk_writer(self):
+        """ Returns the next disk writer thread, or None when writes are made from the download threads """
+        if not self.writer_thread_num:
+            return None
+        with self._disk_writer_lock:
+            if self._disk_writers is None:
+                self._disk_writers = [DiskWriter(self.buffer_pool) for _ in range(self.writer_thread_num)]
+                self._disk_writer_cycle = cycle(self._disk_writers)
+            return next(self._disk_writer_cycle)
+
+    def close_disk_writers(self):
+        with self._disk_writer_lock:
+            for writer in self._disk_writers or []:
+                writer.shutdown_flag.set()
+            self._disk_writers = None
+
+    def write_response(self, response, download_file, checksum=None, file_id=None):
+        """
+        Reads the response body into buffers from the buffer pool and writes them to download_file, either directly
+        or through a disk writer thread. Returns once all of the data is written to the file. If a checksum is given,
+        it is updated with each buffer before the buffer is written. file_id is the package file the bytes are
+        counted against in the download metrics.
+        """
+        body = ResponseBodyReader(response)
+        writer = self.get_disk_writer()
+        pending_writes = PendingWrites(download_file) if writer else None
+        stall_detector = self.stall_detector
+        transfer = stall_detector.watch(response, body) if stall_detector else None
+        written = 0
+        try:
+            while not (pending_writes and pending_writes.error):
+                buffer = self.buffer_pool.acquire()
+                queued = False
+                try:
+                    length = readinto_buffer(body, buffer)
+                    if not length:
+                        break
+                    if checksum:
+                        checksum.update(memoryview(buffer)[:length])
+                    if writer:
+                        writer.submit(pending_writes, buffer, length)
+                        queued = True
+                    else:
+                        download_file.write(memoryview(buffer)[:length])
+                finally:
+                    if not queued:
+                        self.buffer_pool.release(buffer)
+                written += length
+                self.record_transferred_bytes(length, file_id)
+                bandwidth_limiter.consume(length)
+        except Exception as e:
+            if transfer and transfer.cancelled:
+                raise TransferStalledError('Transfer of file {} was too slow'.format(file_id)) from e
+            raise
+        finally:
+            if pending_writes:
+                pending_writes.wait()
+            if transfer:
+                stall_detector.unwatch(transfer)
+        if transfer and transfer.cancelled:
+            # the connection was shut down, which can look like the end of the body
+            raise TransferStalledError('Transfer of file {} was too slow'.format(file_id))
+        return written
+
+    def is_multipart_download(self, download_request):
+        if os.path.isfile(download_request.partial_download_parts_abs_path):
+            return True
+        if not self.multipart_threshold or os.path.isfile(download_request.partial_download_abs_path):
+            # a .partial file without a parts file was started as a single stream. keep resuming it that way
+            return False
+        try:
+            return int(download_request.expected_file_size) >= self.multipart_threshold
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def is_preallocated_partial_file(download_request):
+        """
+        Returns True if the .partial file is already the size of the whole file. Resuming it would ask for a range
+        past the end of the file, which s3 rejects. Such a file is left by a download in parts that was interrupted
+        before its parts file was written
+        """
+        try:
+            expected_file_size = int(download_request.expected_file_size)
+        except (TypeError, ValueError):
+            return False
+        return 0 < expected_file_size <= os.path.getsize(download_request.partial_download_abs_path)
+
+    def download_local(self, download_request, err_if_exists=False):
+        # completed_download = os.path.normpath(os.path.join(self.download_directory, download_request.package_file_relative_path))
+
         # use this instead of exists_ok in order to work with python v.2
         def mk_dir_ignore_err(dir):
             try:
@@ -465,41 +1235,234 @@ class Download(Protocol):
             download_request.exists = True
             return download_request
 
+        mk_dir_ignore_err(os.path.dirname(download_request.partial_download_abs_path))
+        if self.is_multipart_download(download_request):
+            downloaded_size = self.download_local_in_parts(download_request)
+        else:
+            downloaded_size = self.download_local_single_stream(download_request)
+        # TODO - this doesnt work when using s3fs...add ticket to make it easy to download using s3fs
+        os.rename(download_request.partial_download_abs_path, download_request.completed_download_abs_path)
+        if os.path.isfile(download_request.partial_download_parts_abs_path):
+            os.remove(download_request.partial_download_parts_abs_path)
+        logger.info('Completed download {}'.format(download_request.completed_download_abs_path))
+        download_request.actual_file_size = downloaded_size
+        bucket, key = deconstruct_s3_url(download_request.presigned_url)
+        download_request.nda_s3_url = 's3://{}/{}'.format(bucket, key)
+
+    def download_local_single_stream(self, download_request):
+        downloaded = False
+        resume_header = None
         downloaded_size = 0
-        if os.path.isfile(download_request.partial_download_abs_path):
+        if os.path.isfile(download_request.partial_download_abs_path) and \
+                not self.is_preallocated_partial_file(download_request):
             downloaded = True
             downloaded_size = os.path.getsize(download_request.partial_download_abs_path)
             resume_header = {'Range': 'bytes={}-'.format(downloaded_size)}
             logger.info('Resuming download: {}'.
                         format(download_request.partial_download_abs_path))
         else:
-            mk_dir_ignore_err(os.path.dirname(download_request.partial_download_abs_path))
             logger.info('Starting download: {}'.format(download_request.partial_download_abs_path))
             # downloading to local machine
-        with requests.session() as s:
-            s.mount(download_request.presigned_url, get_http_adapter(download_request.presigned_url))
-            if resume_header:
-                s.headers.update(resume_header)
-            with open(download_request.partial_download_abs_path, "ab" if downloaded else "wb") as download_file:
-                with s.get(download_request.presigned_url, stream=True) as response:
-                    response.raise_for_status()
-                    for chunk in response.iter_content(chunk_size=1024 * 1024 * 5):  # iterate 5MB chunks
-                        if chunk:
-                            downloaded_size += download_file.write(chunk)
-        # TODO - this doesnt work when using s3fs...add ticket to make it easy to download using s3fs
-        os.rename(download_request.partial_download_abs_path, download_request.completed_download_abs_path)
-        logger.info('Completed download {}'.format(download_request.completed_download_abs_path))
-        download_request.actual_file_size = downloaded_size
-        bucket, key = deconstruct_s3_url(download_request.presigned_url)
-        download_request.nda_s3_url = 's3://{}/{}'.format(bucket, key)
+        s = self.get_http_session(download_request.presigned_url)
+        with open(download_request.partial_download_abs_path, "ab" if downloaded else "wb") as download_file:
+            with s.get(download_request.presigned_url, stream=True, headers=resume_header) as response:
+                response.raise_for_status()
+                if downloaded and response.status_code != 206:
+                    # the whole file was sent instead of the requested range. start over
+                    logger.info('Restarting download: {}'.format(download_request.partial_download_abs_path))
+                    download_file.truncate(0)
+                    downloaded = False
+                    downloaded_size = 0
+                download_request.e_tag = (response.headers.get('ETag') or '').strip('"') or None
+                e_tag = get_comparable_e_tag(response.headers)
+                checksum = StreamingChecksum(e_tag, download_request.expected_file_size)
+                if downloaded:
+                    # the bytes from the earlier run are read back once so that the checksum covers the whole file
+                    buffer = self.buffer_pool.acquire()
+                    try:
+                        checksum.update_from_file(download_request.partial_download_abs_path, downloaded_size, buffer)
+                    finally:
+                        self.buffer_pool.release(buffer)
+                downloaded_size += self.write_response(response, download_file, checksum,
+                                                       download_request.package_file_id)
+        try:
+            expected_file_size = int(download_request.expected_file_size)
+        except (TypeError, ValueError):
+            expected_file_size = None
+        if expected_file_size is not None and 0 <= expected_file_size != downloaded_size:
+            if downloaded_size < expected_file_size:
+                # the .partial file is kept, so the download resumes from where the connection was lost
+                raise http.client.IncompleteRead(b'', expected_file_size - downloaded_size)
+            os.remove(download_request.partial_download_abs_path)
+            raise Exception('Received {} bytes for {} but expected {}. The file will be downloaded again the next time '
+                            'the command is run'.format(downloaded_size, download_request.completed_download_abs_path,
+                                                        expected_file_size))
+        self.verify_checksum(download_request, e_tag, checksum.hexdigest(), checksum.part_size_certain)
+        return downloaded_size
+
+    def verify_checksum(self, download_request, e_tag, checksum, part_size_certain=True):
+        """
+        Compares checksum, computed while downloading, with the ETag returned by s3 and records the result in
+        download_request.checksum_status. A file that does not match an MD5 ETag is removed, so that it is downloaded
+        again the next time the command is run. The ETag of a file uploaded in parts also depends on the part size used
+        for the upload, so those files are kept and the mismatch is only recorded.
+        """
+        download_request.checksum = checksum
+        if not e_tag or not checksum:
+            download_request.checksum_status = 'unverified'
+            return
+        if checksum == e_tag:
+            download_request.checksum_status = 'verified'
+            return
+        if '-' in e_tag:
+            if part_size_certain:
+                download_request.checksum_status = 'mismatch'
+                logger.warning('Checksum of {} ({}) does not match the multipart ETag reported by s3 ({}). The file is '
+                               'kept, since the part size used to upload it may differ'
+                               .format(download_request.completed_download_abs_path, checksum, e_tag))
+            else:
+                download_request.checksum_status = 'unverified'
+                logger.warning('Could not verify the checksum of {}. The part size used to upload the file is unknown'
+                               .format(download_request.completed_download_abs_path))
+            return
+        download_request.checksum_status = 'mismatch'
+        os.remove(download_request.partial_download_abs_path)
+        message = 'Checksum of {} ({}) does not match the ETag reported by s3 ({}). The file will be downloaded ' \
+                  'again the next time the command is run'.format(download_request.completed_download_abs_path,
+                                                                  checksum, e_tag)
+        logger.error(message)
+        raise ChecksumMismatchError(message)
+
+    def download_local_in_parts(self, download_request):
+        """
+        Downloads the file as byte ranges that are fetched concurrently and written into their position in a
+        preallocated .partial file. Completed ranges are recorded in a .parts file next to the .partial file, so an
+        interrupted download only re-fetches the ranges that were not finished.
 
-    def download_to_s3(self, download_request):
+        When the object was uploaded in parts and each range covers whole upload parts, the MD5s of the upload parts
+        are computed as the ranges arrive and combined into the ETag of the object. Otherwise the file is unverified.
+        """
+        partial_path = download_request.partial_download_abs_path
+        parts_path = download_request.partial_download_parts_abs_path
+        file_size = int(download_request.expected_file_size)
+        part_state = None
+
+        def save_part_state():
+            tmp_path = parts_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(part_state, completed_parts=sorted(completed_parts)), f)
+            os.replace(tmp_path, parts_path)
+
+        if os.path.isfile(parts_path) and os.path.isfile(partial_path):
+            with open(parts_path, 'r') as f:
+                part_state = json.load(f)
+            if part_state['file_size'] != file_size or os.path.getsize(partial_path) != file_size:
+                logger.info('Restarting download (file has changed since it was started): {}'.format(partial_path))
+                part_state = None
+            else:
+                logger.info('Resuming download: {}'.format(partial_path))
+        if part_state is None:
+            part_state = {'file_size': file_size, 'part_size': self.multipart_chunksize, 'completed_parts': [],
+                          'part_digests': {}}
+            completed_parts = set()
+            logger.info('Starting download in parts: {}'.format(partial_path))
+            # the parts file is written first. a .partial file left without one would be resumed as a single stream
+            save_part_state()
+            with open(partial_path, 'wb') as download_file:
+                preallocate_file(download_file, file_size)
+
+        part_size = part_state['part_size']
+        completed_parts = set(part_state['completed_parts'])
+        # hex MD5s of the upload parts in each range, by range number. missing for parts files of earlier versions
+        part_digests = part_state.setdefault('part_digests', {})
+        part_state_lock = threading.Lock()
+        s = self.get_http_session(download_request.presigned_url)
+
+        def download_part(part_number):
+            start = part_number * part_size
+            end = min(start + part_size, file_size) - 1
+            with s.get(download_request.presigned_url, stream=True,
+                       headers={'Range': 'bytes={}-{}'.format(start, end)}) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise Exception('Server did not return a byte range for {}'.format(partial_path))
+                # every range has to come from the same version of the object
+                e_tag = (response.headers.get('ETag') or '').strip('"') or None
+                with part_state_lock:
+                    if part_state.get('e_tag') is None:
+                        part_state['e_tag'] = e_tag
+                        part_state['checksum_e_tag'] = get_comparable_e_tag(response.headers)
+                    elif e_tag and e_tag != part_state['e_tag']:
+                        message = 'File {} changed on s3 while it was being downloaded. The download will start ' \
+                                  'over the next time the command is run'.format(partial_path)
+                        logger.error(message)
+                        raise ChecksumMismatchError(message)
+                checksum = StreamingChecksum(part_state.get('checksum_e_tag'), file_size)
+                # the upload parts of a range can only be checksummed if the range starts at the start of a part
+                if not checksum.part_size or not checksum.part_size_certain or part_size % checksum.part_size:
+                    checksum = None
+                with open(partial_path, 'r+b') as download_file:
+                    download_file.seek(start)
+                    written = self.write_response(response, download_file, checksum,
+                                                  file_id=download_request.package_file_id)
+            if written != end - start + 1:
+                raise Exception('Expected {} bytes for part {} of {} but received {}'
+                                .format(end - start + 1, part_number, partial_path, written))
+            with part_state_lock:
+                completed_parts.add(part_number)
+                if checksum:
+                    part_digests[str(part_number)] = [digest.hex() for digest in checksum.digests()]
+                save_part_state()
+
+        part_count = math.ceil(file_size / part_size)
+        executor = self.get_part_executor()
+        futures = [executor.submit(download_part, part_number) for part_number in range(part_count)
+                   if part_number not in completed_parts]
+        # let every range finish before reporting an error so that the parts file reflects all completed ranges
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception()]
+        if any(isinstance(e, ChecksumMismatchError) for e in errors):
+            os.remove(partial_path)
+            os.remove(parts_path)
+        if errors:
+            raise errors[0]
+        download_request.e_tag = part_state.get('e_tag')
+        checksum = None
+        if all(str(part_number) in part_digests for part_number in range(part_count)):
+            checksum = combine_part_digests([bytes.fromhex(digest) for part_number in range(part_count)
+                                             for digest in part_digests[str(part_number)]])
+        # only multipart ETags are compared, so a mismatch never removes the file
+        self.verify_checksum(download_request, part_state.get('checksum_e_tag'), checksum)
+        return file_size
+
+    def get_s3_client(self, credentials):
+        """
+        Returns an s3 client for the temporary credentials. Clients are created from a single boto3 session and
+        reused for as long as the service keeps handing out the same credentials
+        """
+        key = (credentials['access_key'], credentials['secret_key'], credentials['session_token'])
+        with self._s3_client_lock:
+            s3_client = self._s3_clients.pop(key, None)
+            if s3_client is None:
+                if self._boto3_session is None:
+                    self._boto3_session = boto3.session.Session(region_name='us-east-1')
+                s3_client = self._boto3_session.client('s3', aws_access_key_id=credentials['access_key'],
+                                                       aws_secret_access_key=credentials['secret_key'],
+                                                       aws_session_token=credentials['session_token'])
+            # keep the most recently used clients. dicts keep insertion order, so the first key is the oldest
+            self._s3_clients[key] = s3_client
+            if len(self._s3_clients) > 2 * self.max_thread_num:
+                del self._s3_clients[next(iter(self._s3_clients))]
+            return s3_client
+
+    def download_to_s3(self, download_request, temp_credentials=None):
         # downloading directly to s3 bucket
-        # get cred for file
-        response = self.get_temp_creds_for_file(download_request.package_file_id, self.custom_user_s3_endpoint)
-        ak = response['access_key']
-        sk = response['secret_key']
-        sess_token = response['session_token']
+        # get cred for file, unless they were fetched ahead of time and are still valid
+        response = temp_credentials
+        if not response or is_temp_credentials_expiring(response):
+            if response:
+                metrics_registry.inc('nda_credential_refreshes_total', kind='s3_credentials')
+            response = self.get_temp_creds_for_file(download_request.package_file_id, self.custom_user_s3_endpoint)
         source_uri = response['source_uri']
         dest_uri = response['destination_uri']
 
@@ -511,44 +1474,146 @@ class Download(Protocol):
         logger.info('Starting download: s3://{}/{}'.format(dest_bucket, dest_path))
 
         # boto3 copy
-        sess = boto3.session.Session(aws_access_key_id=ak,
-                                     aws_secret_access_key=sk,
-                                     aws_session_token=sess_token,
-                                     region_name='us-east-1')
-
-        s3_client = sess.client('s3')
-        response = s3_client.head_object(Bucket=src_bucket, Key=src_path)
-        download_request.actual_file_size = response['ContentLength']
-        download_request.e_tag = response['ETag'].replace('"', '')
+        s3_client = self.get_s3_client(response)
+        if download_request.expected_file_size is not None:
+            # the package metadata already has the size of the file
+            download_request.actual_file_size = download_request.expected_file_size
+        else:
+            response = s3_client.head_object(Bucket=src_bucket, Key=src_path)
+            download_request.actual_file_size = response['ContentLength']
+            download_request.e_tag = response['ETag'].replace('"', '')
 
-        s3 = sess.resource('s3')
         copy_source = {
             'Bucket': src_bucket,
             'Key': src_path
         }
 
-        def print_upload_part_info(bytes):
-            logger.info('Transferred {} for {}'.format(human_size(bytes), download_request.nda_s3_url))
-
-        KB = 1024
-        MB = KB * KB
-        GB = KB ** 3
+        # objects larger than 5GB cannot be copied with a single request
         LARGE_OBJECT_THRESHOLD = 5 * GB
-        args = {
-            'ExtraArgs': {'ACL': 'bucket-owner-full-control'}
-        }
-
         if int(download_request.actual_file_size) >= LARGE_OBJECT_THRESHOLD:
             logger.info('Transferring large object {} ({}) in multiple parts'
                         .format(download_request.nda_s3_url,
                                 human_size(int(download_request.actual_file_size))))
-            config = TransferConfig(multipart_threshold=LARGE_OBJECT_THRESHOLD, multipart_chunksize=1 * GB)
-            args['Config'] = config
-            args['Callback'] = print_upload_part_info
+            self.copy_to_s3_in_parts(s3_client, download_request, copy_source, dest_bucket, dest_path)
+        else:
+            # a single CopyObject request, instead of the managed copy that looks the object up with head_object first
+            response = s3_client.copy_object(CopySource=copy_source, Bucket=dest_bucket, Key=dest_path,
+                                             ACL='bucket-owner-full-control')
+            download_request.e_tag = response['CopyObjectResult']['ETag'].replace('"', '')
 
-        s3.meta.client.copy(copy_source, dest_bucket, dest_path, **args)
+    def get_s3_copy_state_path(self, download_request):
+        return os.path.join(self.package_metadata_directory, '.download-progress', self.download_job_uuid,
+                            's3-copies', '{}.json'.format(download_request.package_file_id))
+
+    def copy_to_s3_in_parts(self, s3_client, download_request, copy_source, dest_bucket, dest_path):
+        """
+        Copies the object to the s3 destination as a multipart upload whose parts are copied concurrently with
+        UploadPartCopy. The upload id and the completed parts are saved to a state file after every part, so a copy
+        that is interrupted continues from the parts that were already copied the next time the command is run.
+        """
+        state_path = self.get_s3_copy_state_path(download_request)
+        file_size = int(download_request.actual_file_size)
+        state = None
+        if os.path.isfile(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state['file_size'] != file_size or state['source'] != copy_source \
+                    or state['destination'] != [dest_bucket, dest_path]:
+                state = None
+            else:
+                logger.info('Resuming copy of {} ({} parts already copied)'.format(download_request.nda_s3_url,
+                                                                                len(state['parts'])))
+        if state is None:
+            # s3 allows at most 10,000 parts of up to 5GB
+            part_size = min(max(self.s3_copy_part_size, math.ceil(file_size / 10000)), 5 * GB)
+            upload = s3_client.create_multipart_upload(Bucket=dest_bucket, Key=dest_path,
+                                                       ACL='bucket-owner-full-control')
+            state = {'upload_id': upload['UploadId'], 'file_size': file_size, 'part_size': part_size,
+                     'source': copy_source, 'destination': [dest_bucket, dest_path], 'parts': {}}
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+
+        state_lock = threading.Lock()
+
+        def save_state():
+            tmp_path = state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, state_path)
+
+        save_state()
+        part_size = state['part_size']
+        part_count = math.ceil(file_size / part_size)
+
+        def copy_part(part_number):
+            start = (part_number - 1) * part_size
+            end = min(start + part_size, file_size) - 1
+            response = s3_client.upload_part_copy(Bucket=dest_bucket, Key=dest_path, CopySource=copy_source,
+                                                  CopySourceRange='bytes={}-{}'.format(start, end),
+                                                  PartNumber=part_number, UploadId=state['upload_id'])
+            with state_lock:
+                state['parts'][str(part_number)] = response['CopyPartResult']['ETag']
+                save_state()
+                logger.info('Transferred {} of {} for {}'.format(
+                    human_size(min(len(state['parts']) * part_size, file_size)), human_size(file_size),
+                    download_request.nda_s3_url))
+
+        with ThreadPoolExecutor(max_workers=self.s3_copy_concurrency,
+                                thread_name_prefix='s3-copy-part') as executor:
+            futures = [executor.submit(copy_part, part_number) for part_number in range(1, part_count + 1)
+                       if str(part_number) not in state['parts']]
+            # let every part finish before reporting an error so that the state file has all of the completed parts
+            wait(futures)
+        errors = [future.exception() for future in futures if future.exception()]
+        if any('NoSuchUpload' in str(e) for e in errors):
+            # the upload was aborted or expired on the destination. the copy starts over the next time
+            os.remove(state_path)
+        if errors:
+            raise errors[0]
+
+        parts = [{'ETag': state['parts'][str(n)], 'PartNumber': n} for n in range(1, part_count + 1)]
+        try:
+            s3_client.complete_multipart_upload(Bucket=dest_bucket, Key=dest_path, UploadId=state['upload_id'],
+                                                MultipartUpload={'Parts': parts})
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                raise
+            # the upload may have been completed by an earlier run that stopped before removing the state file
+            if not self.is_s3_copy_complete(s3_client, dest_bucket, dest_path, file_size):
+                os.remove(state_path)
+                raise
+            logger.info('Copy of {} was completed by an earlier run'.format(download_request.nda_s3_url))
+        os.remove(state_path)
+
+    @staticmethod
+    def is_s3_copy_complete(s3_client, dest_bucket, dest_path, file_size):
+        """ Returns True if the destination object exists and has the size of the file being copied """
+        try:
+            response = s3_client.head_object(Bucket=dest_bucket, Key=dest_path)
+        except botocore.exceptions.ClientError:
+            return False
+        return int(response['ContentLength']) == file_size
+
+    def record_download_error(self, e):
+        """ Counts a failed transfer in the metrics and the stats used to adjust the thread count """
+        # client errors such as 404 and 403 are not a sign that the download is running too many threads
+        status_code = e.response.status_code if isinstance(e, HTTPError) else None
+        with self.transfer_stats_lock:
+            if status_code in (429, 503) or 'SlowDown' in str(e):
+                self.transfer_throttles += 1
+                error_kind = 'throttled'
+            elif isinstance(e, ChecksumMismatchError):
+                error_kind = 'checksum'
+            elif status_code is None or status_code >= 500:
+                self.transfer_errors += 1
+                error_kind = 'server' if status_code else 'connection'
+            else:
+                error_kind = 'client'
+        metrics_registry.inc('nda_download_errors_total', kind=error_kind)
 
     def handle_download_exception(self, download_request, e, failed_s3_links_file=None):
+        self.metrics.file_finished(download_request.package_file_id, success=False)
+        self.record_download_error(e)
+        metrics_registry.inc('nda_download_files_total', result='failed')
 
         self.write_to_failed_download_link_file(failed_s3_links_file, s3_link=download_request.presigned_url,
                                                 source_uri=download_request.nda_s3_url)
@@ -573,33 +1638,86 @@ class Download(Protocol):
         return download_request
 
     def download_from_s3link(self, package_file, presigned_url, download_local=None, err_if_exists=False,
-                             failed_s3_links_file=None, download_dir=None):
+                             failed_s3_links_file=None, download_dir=None, temp_credentials=None):
         if download_local is None:
             download_local = False if self.custom_user_s3_endpoint else True
         if not download_dir:
             download_dir = self.download_directory
 
         download_request = DownloadRequest(package_file, presigned_url, self.package_id, download_dir)
+        self.metrics.file_started(download_request.package_file_id, download_request.expected_file_size)
+        attempt = 0
+        while True:
+            try:
+                if download_local:
+                    if not self.get_from_download_cache(download_request, package_file):
+                        self.download_local(download_request, err_if_exists)
+                        self.add_to_download_cache(download_request, package_file)
+                else:
+                    self.download_to_s3(download_request, temp_credentials)
+                download_request.exists = True
+                download_request.download_complete_time = time.strftime("%Y%m%dT%H%M%S")
+                self.metrics.file_finished(download_request.package_file_id)
+                metrics_registry.inc('nda_download_files_total', result='completed')
+                return download_request
+            except HTTPError as e:
+                # if we are using expired credentials, regenerate and resume the download
+                if download_local and e.response.status_code == 403 and 'Request has expired' in e.response.text \
+                        and attempt < self.download_retries:
+                    logger.warning(
+                        f'Temporary credentials have expired for file {download_request.package_file_id}. Regenerating credentials and restarting download')
+                    metrics_registry.inc('nda_credential_refreshes_total', kind='presigned_url')
+                    metrics_registry.inc('nda_download_retries_total', reason='expired_url')
+                    # a new url fixes the error, so the next attempt starts right away
+                    attempt += 1
+                    download_request.presigned_url = self.get_temp_creds_for_file(download_request.package_file_id)
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            if attempt >= self.download_retries or not is_transient_download_error(error):
+                return self.handle_download_exception(download_request, error, failed_s3_links_file)
+            # the next attempt resumes from the .partial file (or the completed parts of a multipart transfer)
+            delay = self.retry_backoff.get_delay(attempt)
+            attempt += 1
+            self.record_download_error(error)
+            metrics_registry.inc('nda_download_retries_total',
+                                 reason='stalled' if isinstance(error, TransferStalledError) else 'transient_error')
+            logger.warning('Download of {} failed ({}). Retrying in {:.0f} seconds (attempt {} of {})'.format(
+                download_request.nda_s3_url or download_request.package_file_id, error, delay, attempt,
+                self.download_retries))
+            time.sleep(delay)
+
+    def get_from_download_cache(self, download_request, package_file):
+        """ Creates the file from the download cache. Returns False if the file has to be downloaded """
+        nda_s3_url = package_file.get('nda_s3_url')
+        if not self.download_cache or not nda_s3_url or download_request.expected_file_size is None \
+                or os.path.isfile(download_request.completed_download_abs_path):
+            return False
+        os.makedirs(os.path.dirname(download_request.completed_download_abs_path), exist_ok=True)
+        cached_file = self.download_cache.get(nda_s3_url, download_request.expected_file_size,
+                                              download_request.completed_download_abs_path)
+        if not cached_file:
+            return False
+        logger.info('Using cached copy of {} for {}'.format(nda_s3_url, download_request.completed_download_abs_path))
+        download_request.nda_s3_url = nda_s3_url
+        download_request.actual_file_size = cached_file['size']
+        download_request.e_tag = cached_file['e_tag']
+        download_request.checksum = cached_file['checksum']
+        return True
+
+    def add_to_download_cache(self, download_request, package_file):
+        nda_s3_url = package_file.get('nda_s3_url')
+        # only files of the expected size are cached, so that a partial or changed file is never handed out
+        if not self.download_cache or not nda_s3_url or download_request.expected_file_size is None or \
+                int(download_request.actual_file_size) != int(download_request.expected_file_size):
+            return
         try:
-            if download_local:
-                self.download_local(download_request, err_if_exists)
-            else:
-                self.download_to_s3(download_request)
-            download_request.exists = True
-            download_request.download_complete_time = time.strftime("%Y%m%dT%H%M%S")
-            return download_request
-        except HTTPError as e:
-            # if we are using expired credentials, regenerate and resume the download
-            if download_local and e.response.status_code == 403 and 'Request has expired' in e.response.text:
-                logger.warning(
-                    f'Temporary credentials have expired for file {download_request.package_file_id}. Regenerating credentials and restarting download')
-                presigned_url = self.get_temp_creds_for_file(download_request.package_file_id)
-                return self.download_from_s3link(package_file, presigned_url, download_local, err_if_exists,
-                                                 failed_s3_links_file)
-            else:
-                return self.handle_download_exception(download_request, e, failed_s3_links_file)
-        except Exception as e:
-            return self.handle_download_exception(download_request, e, failed_s3_links_file)
+            self.download_cache.add(nda_s3_url, download_request.expected_file_size,
+                                    download_request.completed_download_abs_path, download_request.e_tag,
+                                    download_request.checksum)
+        except OSError as e:
+            logger.warning('Could not add {} to the download cache: {}'.format(nda_s3_url, e))
 
     def write_to_failed_download_link_file(self, failed_s3_links_file, s3_link, source_uri):
         src_bucket, src_path = deconstruct_s3_url(s3_link if s3_link else source_uri)
@@ -611,20 +1729,94 @@ class Download(Protocol):
                 failed_s3_links_file.write(s3_address + "\n")
                 failed_s3_links_file.flush()
 
-    def generate_download_batch_file_ids(self, completed_file_ids, df):
-        batch = []
-        size = 0
-        for _, row in df.iterrows():
-            if row['package_file_id'] not in completed_file_ids:
-                batch.append(row)
-                size += 1
-                if size % self.default_download_batch_size == 0:
-                    yield batch
-                    batch = []
-                    size = 0
-        yield batch
+    def split_download_lanes(self, df):
+        """
+        Splits the files into large files, ordered largest first so that they are started early in the run, and
+        small files, which keep the order of the package metadata file
+        """
+        is_large = pd.to_numeric(df['file_size'], errors='coerce').fillna(0) >= self.large_file_threshold
+        return df[is_large].sort_values('file_size', ascending=False), df[~is_large]
+
+    def group_duplicate_files(self, df, completed_file_ids):
+        """
+        Groups the files that have not been downloaded yet by nda_s3_url, so that each s3 object is downloaded once.
+        Returns the files to download, and a dict from the package_file_id of a file being downloaded to the records
+        of the other files with the same nda_s3_url
+        """
+        remaining = df[~df['package_file_id'].isin(completed_file_ids)]
+        # the metadata file can repeat rows. a repeated id or location only needs to be written once
+        remaining = remaining.drop_duplicates(subset=['package_file_id']).drop_duplicates(subset=['download_alias'])
+        is_duplicate = remaining['nda_s3_url'].notna() & remaining.duplicated(subset=['nda_s3_url'], keep='first')
+        to_download = remaining[~is_duplicate]
+        duplicates = remaining[is_duplicate]
+        if duplicates.empty:
+            return to_download, {}
+        download_ids = to_download[to_download['nda_s3_url'].isin(duplicates['nda_s3_url'])] \
+            .set_index('nda_s3_url')['package_file_id']
+        duplicate_files = {}
+        for record in duplicates.to_dict('records'):
+            duplicate_files.setdefault(int(download_ids[record['nda_s3_url']]), []).append(record)
+        return to_download, duplicate_files
+
+    def link_duplicate_file(self, download_request, package_file, failed_s3_links_file=None):
+        """
+        Creates the file for package_file from the downloaded file with the same s3 object. A hard link is used so
+        that no extra disk space is needed, falling back to a copy on filesystems that do not support hard links
+        """
+        duplicate_request = DownloadRequest(package_file, download_request.presigned_url, self.package_id,
+                                            self.download_directory)
+        duplicate_request.nda_s3_url = download_request.nda_s3_url
+        source = download_request.completed_download_abs_path
+        target = duplicate_request.completed_download_abs_path
+        try:
+            if not os.path.isfile(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                link_or_copy(source, target)
+                logger.info('Linked {} to {}'.format(target, source))
+            duplicate_request.actual_file_size = os.path.getsize(target)
+            duplicate_request.e_tag = download_request.e_tag
+            duplicate_request.checksum = download_request.checksum
+            duplicate_request.checksum_status = download_request.checksum_status
+            duplicate_request.exists = True
+            duplicate_request.download_complete_time = time.strftime("%Y%m%dT%H%M%S")
+        except OSError as e:
+            logger.error('Could not create {} from {}: {}'.format(target, source, e))
+            self.write_to_failed_download_link_file(failed_s3_links_file, s3_link=None,
+                                                    source_uri=duplicate_request.nda_s3_url)
+        return duplicate_request
+
+    def select_shard(self, df):
+        """ Returns the files of df that belong to the shard given with --shard, or all of them without --shard """
+        if not self.shard:
+            return df
+        shard, shard_count = self.shard
+        df = df[get_shard_numbers(df, shard_count, self.shard_by) == shard]
+        logger.info('Shard {} of {} (split by {}) contains {} files, totaling {}'.format(
+            shard, shard_count, 'file size' if self.shard_by == 'size' else 'package_file_id', len(df),
+            human_size(pd.to_numeric(df['file_size'], errors='coerce').fillna(0).clip(lower=0).sum())))
+        return df
+
+    def generate_download_batch_file_ids(self, completed_file_ids, df, chunk_size=10000):
+        """
+        Yields batches of the files which have not been downloaded yet. Completed files are removed with a single
+        vectorized anti-join, and each batch is a list of plain dicts (one per file) instead of pandas Series.
+        """
+        remaining = df[~df['package_file_id'].isin(completed_file_ids)]
+        # convert to records a chunk at a time so the whole package is never held as python objects
+        for chunk_start in range(0, len(remaining), chunk_size):
+            records = remaining.iloc[chunk_start:chunk_start + chunk_size].to_dict('records')
+            for batch_start in range(0, len(records), self.default_download_batch_size):
+                yield records[batch_start:batch_start + self.default_download_batch_size]
 
     def find_matching_download_job(self, download_job_manifest_path):
+        jobs = self.find_download_jobs(download_job_manifest_path)
+        return jobs[0] if jobs else None
+
+    def find_download_jobs(self, download_job_manifest_path, any_shard=False):
+        """
+        Returns the jobs in the manifest that were run with the same arguments as this download. With any_shard=True
+        the jobs of every shard of the download are returned, including the job run without --shard
+        """
         def is_job_match(possible_match):
             must_match = [
                 'data_structure',
@@ -634,11 +1826,13 @@ class Download(Protocol):
                 'package_id',
                 'regex'
             ]
+            if not any_shard:
+                must_match += ['shard', 'shard_by']
 
             def test_match(key):
                 # None gets converted to empty string.
                 # Convert it back if empty string is detected so that None values can be compared using == operator
-                val1 = possible_match[key] or None
+                val1 = possible_match.get(key) or None
                 # values from download_job_manifest_column_defs will never be None, instead they will be an empty string ''
                 val2 = self.download_job_manifest_column_defs[key]
                 if key == 'download_directory':
@@ -657,23 +1851,15 @@ class Download(Protocol):
 
             return all(map(test_match, must_match))
 
-        # FIND MATCHING JOB RECORD IF IT EXISTS
+        # FIND MATCHING JOB RECORDS IF THEY EXIST
         with open(download_job_manifest_path, newline='') as csvfile:
             job_reader = csv.DictReader(csvfile)
-            for job in job_reader:
-                if is_job_match(job):
-                    return job
-        return None
+            return [job for job in job_reader if is_job_match(job)]
 
     def initialize_verification_files(self):
 
         download_job_manifest_columns = self.download_job_manifest_column_defs.keys()
 
-        def initialize_download_progress_file(fp):
-            with open(fp, 'a', newline='') as file:
-                writer = csv.DictWriter(file, fieldnames=self.download_job_progress_report_column_defs)
-                writer.writeheader()
-
         def add_entry_to_job_manifest(fp):
             self.download_job_uuid = self.download_job_manifest_column_defs['uuid'] = str(uuid.uuid4())
             with open(fp, 'a', newline='') as file:
@@ -685,6 +1871,18 @@ class Download(Protocol):
                 writer = csv.DictWriter(file, fieldnames=download_job_manifest_columns)
                 writer.writeheader()
 
+        def upgrade_job_manifest_file(fp):
+            # manifests written by an earlier version are missing the columns that have been added since
+            with open(fp, newline='') as file:
+                reader = csv.DictReader(file)
+                if not set(download_job_manifest_columns) - set(reader.fieldnames or []):
+                    return
+                jobs = list(reader)
+            with open(fp, 'w', newline='') as file:
+                writer = csv.DictWriter(file, fieldnames=download_job_manifest_columns, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(jobs)
+
         if not os.path.exists(self.package_metadata_directory):
             os.mkdir(self.package_metadata_directory)
 
@@ -695,6 +1893,8 @@ class Download(Protocol):
         download_job_manifest_path = os.path.join(DOWNLOAD_PROGRESS_FOLDER, 'download-job-manifest.csv')
         if not os.path.exists(download_job_manifest_path):
             initialize_job_manifest_file(download_job_manifest_path)
+        else:
+            upgrade_job_manifest_file(download_job_manifest_path)
 
         job_record = self.find_matching_download_job(download_job_manifest_path)
         if job_record is not None:
@@ -707,10 +1907,8 @@ class Download(Protocol):
         if not os.path.exists(DOWNLOAD_JOB_UUID_DIR):
             os.mkdir(DOWNLOAD_JOB_UUID_DIR)
 
-        download_progress_report_file = os.path.join(DOWNLOAD_JOB_UUID_DIR, 'download-progress-report.csv')
-        if not os.path.exists(download_progress_report_file):
-            initialize_download_progress_file(download_progress_report_file)
-        return download_progress_report_file
+        # progress is recorded in the download progress journal, and exported to this file at the end of each run
+        return os.path.join(DOWNLOAD_JOB_UUID_DIR, 'download-progress-report.csv')
 
     '''        
             Steps -
@@ -749,18 +1947,6 @@ class Download(Protocol):
             logger.info(err_mess_template.format(fpath))
             exit_error()
 
-        def get_download_progress_report_path():
-            return os.path.join(self.package_metadata_directory, '.download-progress',
-                                self.download_job_uuid, 'download-progress-report.csv')
-
-        def parse_download_progress_report_for_files(download_progress_report_path):
-            files = []
-            if os.path.exists(download_progress_report_path):
-                with open(download_progress_report_path, newline='') as csvfile:
-                    file_reader = csv.DictReader(csvfile)
-                    files = [f for f in file_reader]
-            return files
-
         def get_complete_file_list():
             if self.download_mode in ['text', 'datastructure']:
                 if self.download_mode == 'datastructure':
@@ -781,9 +1967,8 @@ class Download(Protocol):
                 for link in s3_links:
                     retry_file.write(link + '\n')
 
-        def add_files_to_report(download_progress_report_path, verification_report_path, probably_missing_files_list,
-                                df):
-            copyfile(download_progress_report_path, verification_report_path)
+        def add_files_to_report(progress_journal, verification_report_path, probably_missing_files_list, df):
+            progress_journal.export_csv(verification_report_path)
 
             all_records = []
             missing_file_records = df[df.package_file_id.isin(probably_missing_files_list)].to_dict('records')
@@ -797,6 +1982,9 @@ class Download(Protocol):
                 if file_info['download_alias'] == (pathlib.Path(self.metadata_file_path).name + '.gz'):
                     download_path = os.path.join(self.package_metadata_directory,
                                                  file_info['download_alias'])
+                    if not os.path.exists(download_path):
+                        # the .gz is only kept with --keep-metadata-gz, otherwise just the decompressed file is saved
+                        download_path = self.metadata_file_path
                 else:
                     download_path = os.path.join(self.download_directory,
                                                  file_info['download_alias'])
@@ -825,15 +2013,18 @@ class Download(Protocol):
 
         logger.info('{}'.format(self.build_rerun_download_cmd(['--verify'])))
         logger.info('')
-        pr_path = get_download_progress_report_path()
+        progress_journal = self.get_download_progress_journal()
+        self.merge_shard_progress(progress_journal)
+        pr_path = progress_journal.db_path
         logger.info('Getting expected file list for download...')
         df = get_complete_file_list()
         df = df.rename(columns={c: c.lower() for c in df.columns})
+        df = self.select_shard(df)
         complete_file_set = set(df['package_file_id'].values)
         # Sometimes there are dupes in the qft table. eliminate to get accurate file count
 
         accurate_file_ct = df['download_alias'].unique().size
-        file_sz = human_size(df['file_size'].sum())
+        file_sz = human_size(df['file_size'].clip(lower=0).sum())
 
         logger.info(
             '{} files are expected to have been downloaded from the command above, totaling {}'.format(accurate_file_ct,
@@ -841,14 +2032,17 @@ class Download(Protocol):
         logger.info('')
         logger.info('Parsing program system logs for history of completed downloads...')
         logger.info(
-            'Important - if you think files may have been deleted from your system after the download was run, you should remove the system log at {}'
+            'Important - if you think files may have been deleted from your system after the download was run, you should remove the system logs at {} and {}'
             ' and re-run the --verify command. This will force the program to check for these files instead of assuming they exist based on system log entries. This will cause the --verify step to take longer'
-            ' to finish but will be necessary for accurate results.'.format(pr_path))
-        downloaded_file_records = parse_download_progress_report_for_files(pr_path)
+            ' to finish but will be necessary for accurate results.'.format(pr_path, self.get_download_progress_report_path()))
         # There shouldn't be duplicates in the system logs, but check anyway
-        downloaded_file_records_count = len({f['package_file_expected_location'] for f in downloaded_file_records if
-                                             f['package_file_expected_location']})
-        downloaded_file_set = {int(f['package_file_id']) for f in downloaded_file_records}
+        downloaded_file_locations = set()
+        downloaded_file_set = set()
+        for f in progress_journal.completed_records():
+            downloaded_file_set.add(f['package_file_id'])
+            if f['package_file_expected_location']:
+                downloaded_file_locations.add(f['package_file_expected_location'])
+        downloaded_file_records_count = len(downloaded_file_locations)
         logger.info('')
         logger.info(
             'Found {} complete file downloads according to log file {}'.format(downloaded_file_records_count, pr_path))
@@ -857,7 +2051,9 @@ class Download(Protocol):
         logger.info(
             'Checking {} for all files which were not found in the program system logs. Detailed report will be created at {}...'
             .format(self.download_directory, verification_report_path))
-        undownloaded_s3_links = add_files_to_report(pr_path, verification_report_path, probably_missing_files, df)
+        undownloaded_s3_links = add_files_to_report(progress_journal, verification_report_path, probably_missing_files,
+                                                    df)
+        progress_journal.close()
         logger.info('')
         if undownloaded_s3_links:
             logger.info(
@@ -873,7 +2069,7 @@ class Download(Protocol):
                 'Finished creating {} file. \nThis file contains s3-links for all files that were found to be missing or incomplete. You may '
                 'download these files by running:\n'
                 '   {} -t {}'.format(incomplete_s3_fp,
-                                     self.build_rerun_download_cmd(['--verify', '--text', '--datastructure']),
+                                     self.build_rerun_download_cmd(['--verify', '--text', '--datastructure', '--shard']),
                                      incomplete_s3_fp))
         else:
             logger.info(
@@ -884,6 +2080,24 @@ class Download(Protocol):
             'Details about status of files in download can be found at {} (This file can be opened with Excel or Google Spreadsheets)'.format(
                 verification_report_path))
 
+    def get_temp_creds_for_files(self, id_list):
+        """
+        Returns a dict of package_file_id to the temporary credentials used to copy the file to the s3 destination.
+        The service hands out credentials one file at a time, so the requests for a batch are sent in parallel.
+        Files whose credentials could not be retrieved are mapped to None, and request them again when they are copied
+        """
+
+        def get_temp_creds(package_file_id):
+            try:
+                return self.get_temp_creds_for_file(package_file_id, self.custom_user_s3_endpoint)
+            except Exception as e:
+                logger.debug('Could not retrieve credentials for file {}: {}'.format(package_file_id, e))
+                return None
+
+        logger.debug('Retrieving credentials for {} files'.format(len(id_list)))
+        with ThreadPoolExecutor(max_workers=min(len(id_list), 8) or 1) as executor:
+            return dict(zip(id_list, executor.map(get_temp_creds, id_list)))
+
     def get_temp_creds_for_file(self, package_file_id, custom_user_s3_endpoint=None):
         url = self.package_url + '/{}/files/{}/download_token'.format(self.package_id, package_file_id)
         if custom_user_s3_endpoint:
@@ -900,19 +2114,27 @@ class Download(Protocol):
         logger.info(f'Getting list of all files in package at {time.strftime("%H:%M:%S")} ....')
         print('This is a one time operation that will take about 1 min for every 1 million files in your package.')
         print('Your download will start after this process completes.... ')
-        end_time = datetime.datetime.now() + datetime.timedelta(minutes=30)
         self.request_metadata_file_creation()
-        while True:
+
+        def check():
             try:
-                creds = self.get_package_file_metadata_creds()
-                logger.info(f'List of files retrieved at {time.strftime("%H:%M:%S")}...')
-                return creds
-            except:
-                time.sleep(15)
-                if datetime.datetime.now() > end_time:
-                    logger.error('Error during creation of package meta-data file')
-                    logger.error('\nPlease contact NDAHelp@mail.nih.gov for help in resolving this error')
-                    exit_error()
+                return self.get_package_file_metadata_creds()
+            except HTTPError as e:
+                if e.response is not None and e.response.status_code in (429, 503):
+                    raise RetryLater(parse_retry_after(e.response.headers.get('Retry-After')))
+                # the file has not been created yet
+                return None
+            except Exception:
+                return None
+
+        try:
+            creds = poll(check, timeout_seconds=30 * 60, backoff=Backoff(initial=2, maximum=15), first_delay=2)
+        except PollTimeoutError:
+            logger.error('Error during creation of package meta-data file')
+            logger.error('\nPlease contact NDAHelp@mail.nih.gov for help in resolving this error')
+            exit_error()
+        logger.info(f'List of files retrieved at {time.strftime("%H:%M:%S")}...')
+        return creds
 
     def download_package_metadata_file(self):
         if os.path.exists(self.metadata_file_path):
@@ -923,16 +2145,19 @@ class Download(Protocol):
         except:
             creds = self.generate_metadata_and_get_creds()
 
-        file_resource = self.get_package_file(creds['package_file_id'])
-        self.download_from_s3link(file_resource, creds['downloadURL'], download_local=True,
-                                  download_dir=self.package_metadata_directory)
-        download_location = f"{self.metadata_file_path}.gz"
-        outfile = download_location.rstrip('.gz')
-        logger.debug(f'unzipping metadata file at {time.strftime("%H:%M:%S")}...')
-        with gzip.open(download_location, 'rb') as f_in:
-            with open(outfile, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return outfile
+        presigned_url = creds['downloadURL']
+        os.makedirs(self.package_metadata_directory, exist_ok=True)
+        logger.debug(f'streaming metadata file at {time.strftime("%H:%M:%S")}...')
+        # the file is decompressed and indexed while it downloads. the .gz is only saved with --keep-metadata-gz
+        raw_copy_path = f'{self.metadata_file_path}.gz'
+        s = self.get_http_session(presigned_url)
+        with s.get(presigned_url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = False
+            with open(raw_copy_path, 'wb') if self.keep_metadata_gz else contextlib.nullcontext() as raw_copy:
+                stream = GzipStreamReader(response.raw, raw_copy, on_read=bandwidth_limiter.consume)
+                self.get_package_metadata().write(stream)
+        return self.metadata_file_path
 
     def get_package_file_metadata_creds(self):
         url = self.package_url + \
@@ -948,10 +2173,15 @@ class Download(Protocol):
         tmp = get_request(url, auth=self.auth, deserialize_handler=DeserializeHandler.convert_json)
         return tmp
 
+    def get_package_metadata(self):
+        return PackageMetadata(self.metadata_file_path)
+
+    def load_package_metadata(self, chunk_filter=None):
+        """ Loads the files in the package metadata file that pass chunk_filter and match --file-regex """
+        return self.get_package_metadata().load(chunk_filter, regex=self.regex_file_filter)
+
     def get_files_from_datastructure(self, data_structure):
-        df = pd.read_csv(self.metadata_file_path, header=0)
-        df = self.rename_df_columns_to_lowercase(df)
-        return df[df['short_name'] == data_structure]
+        return self.get_package_metadata().find_by_short_name(data_structure, regex=self.regex_file_filter)
 
     def get_data_structure_manifest_file_info(self):
         url = self.package_url + \
@@ -1027,21 +2257,37 @@ class Download(Protocol):
         logger.debug('Finished retrieving credentials')
         return creds
 
-    def get_completed_files_in_download(self):
-        download_progress_report_path = os.path.join(self.package_metadata_directory,
-                                                     '.download-progress', self.download_job_uuid,
-                                                     'download-progress-report.csv')
+    def get_download_progress_report_path(self):
+        return os.path.join(self.package_metadata_directory, '.download-progress', self.download_job_uuid,
+                            'download-progress-report.csv')
+
+    def get_download_progress_journal(self):
+        """ Opens the progress journal of the current download job, importing the job's csv report if needed """
+        journal_path = os.path.join(self.package_metadata_directory, '.download-progress', self.download_job_uuid,
+                                    'download-progress.db')
+        return DownloadProgressJournal(journal_path, self.download_job_progress_report_column_defs.keys(),
+                                       legacy_csv_path=self.get_download_progress_report_path())
 
-        files = []
-        if os.path.exists(download_progress_report_path):
-            with open(download_progress_report_path, newline='') as csvfile:
-                file_reader = csv.DictReader(csvfile)
-                files = [f for f in file_reader if bool(f['exists'])]
-        return files
+    def merge_shard_progress(self, progress_journal):
+        """
+        Adds the progress of every shard of this download (run with --shard on this machine, or whose .download-progress
+        folder and manifest entries were copied here) to progress_journal, so that it covers the whole download
+        """
+        if self.shard:
+            return
+        download_progress_folder = os.path.join(self.package_metadata_directory, '.download-progress')
+        jobs = self.find_download_jobs(os.path.join(download_progress_folder, 'download-job-manifest.csv'),
+                                       any_shard=True)
+        for job in jobs:
+            if job['uuid'] == self.download_job_uuid:
+                continue
+            job_dir = os.path.join(download_progress_folder, job['uuid'])
+            merged = progress_journal.merge(os.path.join(job_dir, 'download-progress.db'),
+                                            legacy_csv_path=os.path.join(job_dir, 'download-progress-report.csv'))
+            logger.info('Merged {} completed files from the progress of shard {}'.format(merged, job['shard']))
 
     def get_all_files_in_package(self):
-        df = pd.read_csv(self.metadata_file_path, header=0)
-        return self.rename_df_columns_to_lowercase(df)
+        return self.load_package_metadata()
 
     def use_s3_links_file(self):
         """
@@ -1079,15 +2325,10 @@ class Download(Protocol):
             exit_error()
         return df
 
-    def rename_df_columns_to_lowercase(self, df):
-        return df.rename(columns={c: c.lower() for c in df.columns})
-
     def query_files_by_s3_path(self, path_list):
         if not path_list:
             exit_error(message='Illegal Argument - path_list cannot be empty')
-        df = pd.read_csv(self.metadata_file_path, header=0)
-        df = self.rename_df_columns_to_lowercase(df)
-        return df[df['nda_s3_url'].isin(path_list)]
+        return self.get_package_metadata().find_by_s3_urls(path_list, regex=self.regex_file_filter)
 
     def request_metadata_file_creation(self):
         url = self.package_creation_url + \
@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def link_or_copy(source, target):
+    """ Hard links target to source, or copies source if the two are on filesystems that cannot share a link """
+    try:
+        os.link(source, target)
+    except OSError:
+        tmp_target = target + '.partial'
+        shutil.copyfile(source, tmp_target)
+        os.replace(tmp_target, target)
+
+
+class DownloadCache:
+    """
+    Cache of downloaded files that can be shared by the downloads of many packages. Files are stored under a key made
+    from their nda_s3_url and size, so the same s3 object is only downloaded once no matter how many packages contain
+    it. Files are hard linked between the cache and the download directories where possible, so a cached file
+    usually takes no extra disk space.
+
+    When the files in the cache add up to more than max_size bytes, the least recently used files are removed.
+    An index of the cached files is kept in a SQLite database, which allows several downloads to share the cache.
+    """
+    TABLE = 'cached_file'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(cache_dir, 'cache.db'), timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, path TEXT, size INTEGER, '
+                                'e_tag TEXT, checksum TEXT, last_access REAL)'.format(self.TABLE))
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(nda_s3_url, file_size):
+        return '{}:{}'.format(nda_s3_url, int(file_size))
+
+    def get_path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def get(self, nda_s3_url, file_size, target):
+        """
+        Creates target from the cached copy of the file, if there is one. Returns the cache entry as a dict with the
+        e_tag and checksum of the file, or None if the file is not in the cache
+        """
+        key = self.get_key(nda_s3_url, file_size)
+        with self.lock:
+            row = self.connection.execute('SELECT path, size, e_tag, checksum FROM {} WHERE key = ?'
+                                          .format(self.TABLE), (key,)).fetchone()
+            if row is None:
+                return None
+            path, size, e_tag, checksum = row
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                # the file was removed or changed outside of the program
+                self.connection.execute('DELETE FROM {} WHERE key = ?'.format(self.TABLE), (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute('UPDATE {} SET last_access = ? WHERE key = ?'.format(self.TABLE),
+                                    (time.time(), key))
+            self.connection.commit()
+        try:
+            link_or_copy(path, target)
+        except OSError as e:
+            # another download sharing the cache evicted the file after it was looked up
+            logger.debug('Could not use the cached copy of {}: {}'.format(nda_s3_url, e))
+            with self.lock:
+                self.connection.execute('DELETE FROM {} WHERE key = ?'.format(self.TABLE), (key,))
+                self.connection.commit()
+            return None
+        return {'size': size, 'e_tag': e_tag, 'checksum': checksum}
+
+    def add(self, nda_s3_url, file_size, source, e_tag=None, checksum=None):
+        """ Adds a downloaded file to the cache, then removes the least recently used files if the cache is full """
+        key = self.get_key(nda_s3_url, file_size)
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.isfile(path):
+            link_or_copy(source, path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO {} (key, path, size, e_tag, checksum, last_access) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)'.format(self.TABLE),
+                                    (key, path, int(file_size), e_tag, checksum, time.time()))
+            self.connection.commit()
+            self.evict()
+
+    def evict(self):
+        if not self.max_size:
+            return
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM {}'.format(self.TABLE)).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        for key, path, size in self.connection.execute('SELECT key, path, size FROM {} ORDER BY last_access'
+                                                       .format(self.TABLE)).fetchall():
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            total_size -= size
+        self.connection.executemany('DELETE FROM {} WHERE key = ?'.format(self.TABLE), evicted)
+        self.connection.commit()
+        logger.debug('Removed {} files from the download cache at {}'.format(len(evicted), self.cache_dir))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
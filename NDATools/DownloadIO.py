@@ -0,0 +1,468 @@
+import hashlib
+import http.client
+import io
+import logging
+import math
+import os
+import re
+import socket
+import statistics
+import threading
+import time
+import zlib
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# part size used by the aws cli and boto3 (and so by vtcmd) when uploading files in parts
+DEFAULT_UPLOAD_PART_SIZE = 8 * MB
+
+
+class BufferPool:
+    """
+    Fixed set of reusable bytearrays that response bodies are read into. Buffers are allocated on first use, up to
+    max_buffers, and acquire() blocks once they are all in use, which also limits how much downloaded data can be
+    waiting in memory for a disk writer.
+    """
+
+    def __init__(self, buffer_size, max_buffers):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.free_buffers = Queue()
+        self.allocated = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.free_buffers.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.allocated < self.max_buffers:
+                self.allocated += 1
+                return bytearray(self.buffer_size)
+        return self.free_buffers.get()
+
+    def release(self, buffer):
+        self.free_buffers.put(buffer)
+
+
+class PendingWrites:
+    """ Tracks the buffers that have been queued for a file, and the first error raised while writing them """
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self):
+        with self.condition:
+            self.count += 1
+
+    def done(self, error=None):
+        with self.condition:
+            self.count -= 1
+            if error and not self.error:
+                self.error = error
+            self.condition.notify_all()
+
+    def wait(self):
+        """ Blocks until every queued buffer has been written. Raises the first write error, if any """
+        with self.condition:
+            self.condition.wait_for(lambda: self.count == 0)
+        if self.error:
+            raise self.error
+
+
+class DiskWriter(Thread):
+    """
+    Writes filled buffers to disk on behalf of the download threads, so that a slow filesystem does not stall the
+    network reads. Buffers for the same file are always sent to the same writer, which keeps them in order.
+    """
+
+    def __init__(self, buffer_pool):
+        Thread.__init__(self)
+        self.buffer_pool = buffer_pool
+        self.queue = Queue()
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+        self.start()
+
+    def submit(self, pending_writes, buffer, length):
+        pending_writes.add()
+        self.queue.put((pending_writes, buffer, length))
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            try:
+                pending_writes, buffer, length = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            error = None
+            try:
+                # skip the remaining buffers for a file once a write to it has failed
+                if not pending_writes.error:
+                    pending_writes.file.write(memoryview(buffer)[:length])
+            except Exception as e:
+                error = e
+            finally:
+                self.buffer_pool.release(buffer)
+                pending_writes.done(error)
+                self.queue.task_done()
+
+
+class ResponseBodyReader:
+    """
+    Reads the body of a streaming requests response into buffers provided by the caller. urllib3's readinto reads a
+    new bytes object and copies it into the buffer, so bodies without a Content-Encoding are read from the underlying
+    http.client response instead, which reads from the socket straight into the buffer. Encoded bodies are read (and
+    decoded) through urllib3, the same way iter_content reads them.
+    """
+
+    def __init__(self, response):
+        self.raw = response.raw
+        encoding = (response.headers.get('Content-Encoding') or '').strip().lower()
+        fp = getattr(self.raw, '_fp', None)
+        self.direct = encoding in ('', 'identity') and hasattr(fp, 'readinto') and hasattr(fp, 'isclosed')
+        self.fp = fp if self.direct else None
+        if not self.direct:
+            self.raw.decode_content = True
+        try:
+            # urllib3 checks that the whole body arrived. the direct reads have to check it themselves
+            self.content_length = int(response.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            self.content_length = None
+        self.position = 0
+
+    def readinto(self, view):
+        if not self.direct:
+            read = self.raw.readinto(view)
+        else:
+            read = self.fp.readinto(view)
+            if not read and len(view) and self.content_length is not None and self.position < self.content_length:
+                # the connection was closed before the whole body was sent
+                raise http.client.IncompleteRead(b'', self.content_length - self.position)
+            if not read and self.fp.isclosed():
+                # urllib3 returns the connection to the pool once it has read the whole body. do the same, so that
+                # the keep-alive connection is reused rather than closed with the response
+                self.raw.release_conn()
+        self.position += read
+        return read
+
+    def tell(self):
+        return self.position
+
+
+def readinto_buffer(raw, buffer):
+    """
+    Fills buffer from the raw response stream (or a ResponseBodyReader). Returns the number of bytes read, which is 0 at
+    the end of the body
+    """
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view):
+        read = raw.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def preallocate_file(file, size):
+    """
+    Sets the size of an open file, reserving the disk blocks up front where the OS supports it so that the file is
+    not fragmented by writes arriving out of order.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError as e:
+            # not every filesystem supports fallocate (e.g. some network mounts)
+            logger.debug('posix_fallocate not supported for {}: {}'.format(file.name, e))
+    file.truncate(size)
+
+
+class GzipStreamReader(io.RawIOBase):
+    """
+    Readable stream of the decompressed contents of a gzip stream, e.g. the body of a response, so that a compressed
+    file can be parsed while it is downloaded. The compressed bytes are also written to raw_copy when one is given,
+    and on_read is called with the number of compressed bytes after each read.
+    """
+
+    def __init__(self, raw, raw_copy=None, on_read=None, read_size=MB):
+        self.raw = raw
+        self.raw_copy = raw_copy
+        self.on_read = on_read
+        self.read_size = read_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = bytearray()
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        data = self.raw.read(self.read_size)
+        if not data:
+            self.finished = True
+            if not self.decompressor.eof:
+                raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            return
+        if self.raw_copy:
+            self.raw_copy.write(data)
+        if self.on_read:
+            self.on_read(len(data))
+        while data:
+            self.pending += self.decompressor.decompress(data)
+            data = b''
+            if self.decompressor.eof and self.decompressor.unused_data:
+                # gzip files can contain several members, one after the other
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def readinto(self, b):
+        while not self.pending and not self.finished:
+            self.fill()
+        length = min(len(b), len(self.pending))
+        b[:length] = self.pending[:length]
+        del self.pending[:length]
+        return length
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+class TransferStalledError(Exception):
+    """ Raised by a download thread when its transfer was cancelled by the StallDetector for being too slow """
+    pass
+
+
+def shutdown_response(response):
+    """
+    Ends a streaming response from another thread. The socket is shut down, which wakes up a thread blocked reading
+    from it, rather than closed, which would not
+    """
+    raw = getattr(response, 'raw', None)
+    for get_socket in (lambda: raw._connection.sock, lambda: raw._fp.fp.raw._sock):
+        try:
+            sock = get_socket()
+        except AttributeError:
+            continue
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                return
+            except OSError:
+                pass
+    response.close()
+
+
+class WatchedTransfer:
+    def __init__(self, response, started):
+        self.response = response
+        self.reader = None
+        self.started = started
+        self.last_check = started
+        self.last_position = 0
+        self.position = 0
+        self.slow_since = None
+        self.cancelled = False
+
+
+class StallDetector(Thread):
+    """
+    Watches the rate of every response being read by the download threads. The position of each response body is
+    sampled every interval_seconds. A transfer whose rate stays below slow_ratio times the median rate of the run's
+    transfers for grace_seconds, or that receives nothing for stall_seconds, is cancelled by shutting down its
+    connection. The download thread then raises TransferStalledError and the file is retried, resuming from the bytes
+    it already has.
+
+    Near the end of the run (when is_run_ending() returns True, e.g. no files are waiting for a thread) the remaining
+    transfers hold up the whole run, so transfers below end_of_run_ratio times the median are reissued as well.
+    """
+
+    def __init__(self, slow_ratio=0.1, end_of_run_ratio=0.5, interval_seconds=5, grace_seconds=30, stall_seconds=60,
+                 min_samples=5, is_run_ending=None, clock=time.monotonic):
+        Thread.__init__(self)
+        self.slow_ratio = slow_ratio
+        self.end_of_run_ratio = max(slow_ratio, end_of_run_ratio)
+        self.interval_seconds = interval_seconds
+        self.grace_seconds = grace_seconds
+        self.stall_seconds = stall_seconds
+        self.min_samples = min_samples
+        self.is_run_ending = is_run_ending
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.transfers = set()
+        # average rates of the transfers that finished recently
+        self.completed_rates = deque(maxlen=200)
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+
+    def watch(self, response, reader=None):
+        """ reader is the object the body is read through, whose tell() is the position in the body """
+        transfer = WatchedTransfer(response, self.clock())
+        transfer.reader = reader or response.raw
+        with self.lock:
+            self.transfers.add(transfer)
+        return transfer
+
+    def unwatch(self, transfer):
+        with self.lock:
+            self.transfers.discard(transfer)
+            elapsed = self.clock() - transfer.started
+            # transfers that take less than one interval mostly measure latency rather than throughput
+            if not transfer.cancelled and elapsed >= self.interval_seconds:
+                self.completed_rates.append(self.get_position(transfer) / elapsed)
+
+    @staticmethod
+    def get_position(transfer):
+        try:
+            return transfer.reader.tell()
+        except (AttributeError, OSError, ValueError):
+            return transfer.position
+
+    def get_median_rate(self, now):
+        rates = list(self.completed_rates)
+        rates += [t.position / (now - t.started) for t in self.transfers
+                  if now - t.started >= self.interval_seconds]
+        return statistics.median(rates) if len(rates) >= self.min_samples else None
+
+    def check(self):
+        """ Samples every transfer, and cancels the ones that have been too slow for too long """
+        now = self.clock()
+        with self.lock:
+            for transfer in self.transfers:
+                transfer.last_position, transfer.position = transfer.position, self.get_position(transfer)
+            median_rate = self.get_median_rate(now)
+            ratio = self.end_of_run_ratio if self.is_run_ending and self.is_run_ending() else self.slow_ratio
+            to_cancel = []
+            for transfer in self.transfers:
+                if transfer.cancelled or now == transfer.last_check:
+                    continue
+                rate = (transfer.position - transfer.last_position) / (now - transfer.last_check)
+                transfer.last_check = now
+                is_slow = rate == 0 or (median_rate is not None and rate < ratio * median_rate)
+                if not is_slow:
+                    transfer.slow_since = None
+                    continue
+                if transfer.slow_since is None:
+                    transfer.slow_since = now - self.interval_seconds
+                slow_seconds = now - transfer.slow_since
+                if (rate == 0 and slow_seconds >= self.stall_seconds) or \
+                        (median_rate is not None and slow_seconds >= self.grace_seconds):
+                    transfer.cancelled = True
+                    to_cancel.append((transfer, rate, median_rate))
+        for transfer, rate, median_rate in to_cancel:
+            logger.warning('Reissuing a transfer that slowed to {:.0f} bytes/s (median rate of the run is {}): {}'
+                           .format(rate, '{:.0f} bytes/s'.format(median_rate) if median_rate else 'unknown',
+                                   # the query string of a presigned url holds its credentials
+                                   str(getattr(transfer.response, 'url', '')).split('?')[0]))
+            shutdown_response(transfer.response)
+        return len(to_cancel)
+
+    def run(self):
+        while not self.shutdown_flag.wait(self.interval_seconds):
+            try:
+                self.check()
+            except Exception as e:
+                logger.debug('Could not check transfer rates: {}'.format(e))
+
+    def stop(self):
+        self.shutdown_flag.set()
+
+
+def get_comparable_e_tag(headers):
+    """
+    Returns the ETag from the response headers when it is derived from the MD5 of the object, otherwise None.
+    The ETag of an object encrypted with SSE-KMS or SSE-C is not an MD5, and the body of a response with a
+    Content-Encoding is decoded, so it no longer matches the stored object.
+    """
+    e_tag = (headers.get('ETag') or '').strip('"')
+    if not re.fullmatch(r'[0-9a-f]{32}(-\d+)?', e_tag):
+        return None
+    if headers.get('x-amz-server-side-encryption') == 'aws:kms' \
+            or headers.get('x-amz-server-side-encryption-customer-algorithm') \
+            or headers.get('Content-Encoding'):
+        return None
+    return e_tag
+
+
+def get_upload_part_size(file_size, part_count):
+    """
+    Works out the part size an object was uploaded with from the part count in its ETag, assuming a whole number of
+    MB per part. Returns the part size and whether it is the only size that fits, or (None, False) if none fits.
+    """
+    if part_count == 1:
+        # a single part covers the whole file, whatever the part size was
+        return max(file_size, 1), True
+    # every part except the last is the same size, so part_count - 1 full parts are smaller than the file
+    smallest = math.ceil(file_size / part_count / MB)
+    largest = math.ceil(file_size / (part_count - 1) / MB) - 1
+    if smallest > largest:
+        return None, False
+    for part_size in (DEFAULT_UPLOAD_PART_SIZE, 16 * MB, 5 * MB, 64 * MB, 100 * MB):
+        if smallest * MB <= part_size <= largest * MB:
+            return part_size, smallest == largest
+    return smallest * MB, smallest == largest
+
+
+class StreamingChecksum:
+    """
+    Computes the checksum of a file while it is downloaded, in the format S3 uses for ETags: the MD5 of the file or,
+    for objects that were uploaded in parts, the MD5 of the concatenated part MD5s followed by '-<part count>'.
+    """
+
+    def __init__(self, e_tag=None, file_size=None):
+        self.part_size, self.part_size_certain = None, True
+        if e_tag and '-' in e_tag and file_size is not None:
+            self.part_size, self.part_size_certain = get_upload_part_size(int(file_size), int(e_tag.split('-')[1]))
+        self.md5 = hashlib.md5()
+        self.part_bytes = 0
+        self.part_digests = []
+
+    def update(self, data):
+        if not self.part_size:
+            self.md5.update(data)
+            return
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self.part_size - self.part_bytes)
+            self.md5.update(view[:length])
+            self.part_bytes += length
+            view = view[length:]
+            if self.part_bytes == self.part_size:
+                self.part_digests.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.part_bytes = 0
+
+    def update_from_file(self, path, length, buffer):
+        """ Adds the first length bytes of the file at path, e.g. the part of a download completed by an earlier run """
+        view = memoryview(buffer)
+        with open(path, 'rb') as f:
+            while length > 0:
+                read = f.readinto(view[:min(length, len(view))])
+                if not read:
+                    break
+                self.update(view[:read])
+                length -= read
+
+    def digests(self):
+        """ Returns the MD5 digests of the parts added so far, including the last part if it is not complete """
+        return self.part_digests + ([self.md5.digest()] if self.part_bytes else [])
+
+    def hexdigest(self):
+        if not self.part_size:
+            return self.md5.hexdigest()
+        return combine_part_digests(self.digests())
+
+
+def combine_part_digests(digests):
+    """ Returns the ETag s3 gives an object uploaded in parts, from the MD5 digests of its parts """
+    return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
@@ -0,0 +1,180 @@
+import csv
+import logging
+import os
+import sqlite3
+import threading
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadProgressJournal:
+    """
+    Records which package files have been downloaded, keyed by package_file_id, in a SQLite database running in WAL
+    mode. Records are committed in batches - at least every commit_interval_seconds - so a crash loses at most one
+    commit interval of progress. Completion state can be looked up without re-reading the whole download history.
+
+    The journal replaces the download-progress-report.csv file. An existing csv report is imported the first time the
+    journal is opened, and the journal can be exported back to the csv layout with export_csv.
+    """
+    TABLE = 'download_progress'
+
+    class CommitThread(Thread):
+        """ Thread that periodically commits the records that have been added to the journal """
+
+        def __init__(self, journal, interval_seconds):
+            Thread.__init__(self)
+            self.journal = journal
+            self.interval_seconds = interval_seconds
+            self.daemon = True
+            self.shutdown_flag = threading.Event()
+            self.start()
+
+        def run(self):
+            while not self.shutdown_flag.wait(self.interval_seconds):
+                self.journal.commit()
+
+    def __init__(self, db_path, columns, legacy_csv_path=None, commit_interval_seconds=5, commit_batch_size=1000):
+        self.db_path = db_path
+        self.columns = list(columns)
+        self.commit_batch_size = commit_batch_size
+        self.pending_records = []
+        self.lock = threading.RLock()
+        is_new_journal = not os.path.exists(db_path)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        column_defs = ', '.join('"{}" {}'.format(c, 'INTEGER PRIMARY KEY' if c == 'package_file_id' else '')
+                                for c in self.columns)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(self.TABLE, column_defs))
+        # journals created by an earlier version may be missing columns that have been added since
+        existing_columns = {row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(self.TABLE))}
+        for column in self.columns:
+            if column not in existing_columns:
+                self.connection.execute('ALTER TABLE {} ADD COLUMN "{}"'.format(self.TABLE, column))
+        self.connection.commit()
+        self.column_names = ', '.join('"{}"'.format(c) for c in self.columns)
+        if is_new_journal and legacy_csv_path and os.path.exists(legacy_csv_path):
+            self.import_csv(legacy_csv_path)
+        self.commit_thread = DownloadProgressJournal.CommitThread(self, commit_interval_seconds)
+
+    def _to_row(self, record):
+        row = []
+        for column in self.columns:
+            value = record.get(column)
+            if column == 'exists':
+                value = 1 if str(value).lower() in ('1', 'true', 'y') else 0
+            elif column in ('package_file_id', 'expected_file_size', 'actual_file_size'):
+                value = int(value) if value not in (None, '') else None
+            elif value is not None:
+                value = str(value)
+            row.append(value)
+        return row
+
+    def _insert(self, rows):
+        placeholders = ', '.join('?' for _ in self.columns)
+        self.connection.executemany('INSERT OR REPLACE INTO {} ({}) VALUES ({})'
+                                    .format(self.TABLE, self.column_names, placeholders), rows)
+
+    def record(self, download_record):
+        """ Adds or replaces the record for a file. The record is committed with the next batch """
+        row = self._to_row(download_record)
+        with self.lock:
+            self.pending_records.append(row)
+            if len(self.pending_records) >= self.commit_batch_size:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.pending_records:
+                self._insert(self.pending_records)
+                self.connection.commit()
+                self.pending_records = []
+
+    def is_complete(self, package_file_id):
+        with self.lock:
+            self.commit()
+            cursor = self.connection.execute('SELECT 1 FROM {} WHERE package_file_id = ? AND "exists" = 1'
+                                             .format(self.TABLE), (int(package_file_id),))
+            return cursor.fetchone() is not None
+
+    def get_completed_file_sizes(self):
+        """ Returns a dict of package_file_id to the file size on disk for every completed file """
+        with self.lock:
+            self.commit()
+            cursor = self.connection.execute('SELECT package_file_id, actual_file_size FROM {} WHERE "exists" = 1'
+                                             .format(self.TABLE))
+            return {package_file_id: size or 0 for package_file_id, size in cursor}
+
+    def completed_records(self):
+        """ Yields the completed records as dicts in the same layout as the csv report """
+        with self.lock:
+            self.commit()
+            cursor = self.connection.execute('SELECT {} FROM {} WHERE "exists" = 1'
+                                             .format(self.column_names, self.TABLE))
+            rows = cursor.fetchall()
+        for row in rows:
+            yield dict(zip(self.columns, row))
+
+    def import_csv(self, csv_path):
+        logger.debug('Importing download progress from {}'.format(csv_path))
+        with open(csv_path, newline='') as csvfile, self.lock:
+            batch = []
+            for record in csv.DictReader(csvfile):
+                batch.append(self._to_row(record))
+                if len(batch) >= self.commit_batch_size:
+                    self._insert(batch)
+                    batch = []
+            self._insert(batch)
+            self.connection.commit()
+
+    def merge(self, db_path, legacy_csv_path=None):
+        """
+        Adds the completed records of another journal, e.g. the journal of another shard of the same download, falling
+        back to its csv report if it has no journal. Returns the number of records that were merged
+        """
+        if not os.path.exists(db_path):
+            if not legacy_csv_path or not os.path.exists(legacy_csv_path):
+                return 0
+            with open(legacy_csv_path, newline='') as csvfile:
+                rows = [self._to_row(r) for r in csv.DictReader(csvfile) if str(r.get('exists')).lower() in
+                        ('1', 'true', 'y')]
+            with self.lock:
+                self._insert(rows)
+                self.connection.commit()
+            return len(rows)
+        with self.lock:
+            self.commit()
+            self.connection.execute('ATTACH DATABASE ? AS other', (db_path,))
+            try:
+                # the other journal may have been created by an earlier version, with fewer columns
+                other_columns = {row[1] for row in
+                                 self.connection.execute('PRAGMA other.table_info({})'.format(self.TABLE))}
+                columns = ', '.join('"{}"'.format(c) for c in self.columns if c in other_columns)
+                cursor = self.connection.execute('INSERT OR REPLACE INTO main.{0} ({1}) SELECT {1} FROM other.{0} '
+                                                 'WHERE "exists" = 1'.format(self.TABLE, columns))
+                merged = cursor.rowcount
+                self.connection.commit()
+            finally:
+                self.connection.execute('DETACH DATABASE other')
+        return merged
+
+    def export_csv(self, csv_path):
+        """ Writes the journal to csv_path using the layout of the download-progress-report.csv file """
+        with self.lock:
+            self.commit()
+            cursor = self.connection.execute('SELECT {} FROM {}'.format(self.column_names, self.TABLE))
+            with open(csv_path, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(self.columns)
+                exists_index = self.columns.index('exists')
+                for row in cursor:
+                    row = list(row)
+                    row[exists_index] = bool(row[exists_index])
+                    writer.writerow(row)
+
+    def close(self):
+        self.commit_thread.shutdown_flag.set()
+        with self.lock:
+            self.commit()
+            self.connection.close()
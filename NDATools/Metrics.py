@@ -0,0 +1,356 @@
+import atexit
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+class EwmaRate:
+    """
+    Exponentially weighted moving average of a rate, e.g. bytes per second. Amounts are added as they happen, and
+    the average is updated at most every min_interval seconds. Older samples lose half their weight every
+    half_life_seconds, so the rate follows changes in throughput without jumping around with every chunk.
+    """
+
+    def __init__(self, half_life_seconds=10, min_interval=1, clock=time.monotonic):
+        self.half_life_seconds = half_life_seconds
+        self.min_interval = min_interval
+        self.clock = clock
+        self.last_update = clock()
+        self.pending = 0
+        self.rate = 0.0
+
+    def add(self, amount):
+        self.pending += amount
+
+    def get_rate(self):
+        now = self.clock()
+        elapsed = now - self.last_update
+        if elapsed >= self.min_interval:
+            alpha = 1 - math.exp(-elapsed * math.log(2) / self.half_life_seconds)
+            self.rate += alpha * (self.pending / elapsed - self.rate)
+            self.pending = 0
+            self.last_update = now
+        return self.rate
+
+
+class Summary:
+    """ Count, mean, min and max of a series of values, with percentiles estimated from a random sample """
+
+    def __init__(self, sample_size=1000):
+        self.sample_size = sample_size
+        self.samples = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        # reservoir sampling keeps an evenly spread sample of every value seen
+        if len(self.samples) < self.sample_size:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.sample_size:
+                self.samples[index] = value
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else None, 'min': self.min,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'max': self.max}
+
+
+class FileTransfer:
+    def __init__(self, expected_size, started):
+        self.expected_size = expected_size
+        self.started = started
+        self.first_byte = None
+        self.received = 0
+
+
+class DownloadMetrics:
+    """
+    Live metrics of a download, fed by the download threads as data arrives: total and EWMA throughput, the files
+    and bytes still in flight, per-thread byte counts, and the time to first byte and transfer time of each file.
+    The queue depth and the number of idle workers are read from the thread pool given to set_pool().
+
+    A snapshot of the metrics can be printed as a progress report or saved as JSON.
+    """
+
+    def __init__(self, half_life_seconds=10, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.throughput = EwmaRate(half_life_seconds, clock=clock)
+        self.bytes_transferred = 0
+        self.files_completed = 0
+        self.files_failed = 0
+        self.in_flight = {}
+        self.thread_bytes = {}
+        self.ttfb = Summary()
+        self.transfer_time = Summary()
+        self.pool = None
+
+    def set_pool(self, pool):
+        """ pool has a get_stats() method returning a dict with queued, active and threads counts """
+        self.pool = pool
+
+    def file_started(self, file_id, expected_size=None):
+        with self.lock:
+            self.in_flight[file_id] = FileTransfer(int(expected_size or 0), self.clock())
+
+    def record_bytes(self, byte_count, file_id=None):
+        now = self.clock()
+        thread_name = threading.current_thread().name
+        with self.lock:
+            self.bytes_transferred += byte_count
+            self.throughput.add(byte_count)
+            self.thread_bytes[thread_name] = self.thread_bytes.get(thread_name, 0) + byte_count
+            transfer = self.in_flight.get(file_id)
+            if transfer is not None:
+                if transfer.first_byte is None:
+                    transfer.first_byte = now
+                    self.ttfb.add(now - transfer.started)
+                transfer.received += byte_count
+
+    def file_finished(self, file_id, success=True):
+        now = self.clock()
+        with self.lock:
+            transfer = self.in_flight.pop(file_id, None)
+            if transfer is None:
+                return
+            if success:
+                self.files_completed += 1
+            else:
+                self.files_failed += 1
+            # files that were linked from the cache or already on disk did not transfer anything
+            if success and transfer.first_byte is not None:
+                self.transfer_time.add(now - transfer.started)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = self.clock() - self.started
+            snapshot = {
+                'elapsed_seconds': elapsed,
+                'bytes_transferred': self.bytes_transferred,
+                'files_completed': self.files_completed,
+                'files_failed': self.files_failed,
+                'throughput_bytes_per_second': self.throughput.get_rate(),
+                'average_bytes_per_second': self.bytes_transferred / elapsed if elapsed > 0 else 0.0,
+                'files_in_flight': len(self.in_flight),
+                'bytes_in_flight': sum(max(0, t.expected_size - t.received) for t in self.in_flight.values()),
+                'time_to_first_byte_seconds': self.ttfb.to_dict(),
+                'transfer_time_seconds': self.transfer_time.to_dict(),
+                'bytes_per_thread': dict(self.thread_bytes)
+            }
+        if self.pool is not None:
+            stats = self.pool.get_stats()
+            snapshot['queue_depth'] = stats['queued']
+            snapshot['active_workers'] = stats['active']
+            snapshot['idle_workers'] = max(0, stats['threads'] - stats['active'])
+        return snapshot
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+class MetricsReporter(Thread):
+    """ Calls report_func every interval_seconds, unless a report was made in the meantime by calling reported() """
+
+    def __init__(self, report_func, interval_seconds=60):
+        Thread.__init__(self)
+        self.report_func = report_func
+        self.interval_seconds = interval_seconds
+        self.last_report = time.monotonic()
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+
+    def reported(self):
+        self.last_report = time.monotonic()
+
+    def run(self):
+        while not self.shutdown_flag.wait(1):
+            if time.monotonic() - self.last_report >= self.interval_seconds:
+                try:
+                    self.report_func()
+                except Exception as e:
+                    logger.debug('Could not print the progress report: {}'.format(e))
+                self.reported()
+
+    def stop(self):
+        self.shutdown_flag.set()
+
+
+# type and description of the metrics exported with --metrics-file
+METRIC_DEFINITIONS = {
+    'nda_api_requests_total': ('counter', 'Requests made to NDA web services, by method and status code'),
+    'nda_api_request_duration_seconds': ('summary', 'Time taken by requests to NDA web services'),
+    'nda_api_retries_total': ('counter', 'Requests to NDA web services that were retried after an error'),
+    'nda_download_bytes_total': ('counter', 'Bytes downloaded or copied to the -s3 destination'),
+    'nda_download_files_total': ('counter', 'Files processed by downloadcmd, by result'),
+    'nda_download_errors_total': ('counter', 'Failed download attempts, by kind of error'),
+    'nda_download_retries_total': ('counter', 'Downloads that were retried in the same run, by reason (an expired '
+                                              'url, a transient error or a stalled transfer)'),
+    'nda_download_throughput_bytes_per_second': ('gauge', 'Current download rate (moving average)'),
+    'nda_download_files_in_flight': ('gauge', 'Files being downloaded'),
+    'nda_download_queue_depth': ('gauge', 'Files waiting for a download thread'),
+    'nda_credential_refreshes_total': ('counter', 'Presigned urls and temporary credentials requested again '
+                                                  'because they expired'),
+    'nda_upload_files_total': ('counter', 'Files processed by vtcmd uploaders, by result'),
+    'nda_upload_bytes_total': ('counter', 'Bytes uploaded by vtcmd'),
+    'nda_validations_total': ('counter', 'Validations that finished, by status'),
+}
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and summaries shared by the whole program, identified by a metric name and a set of labels.
+    Collectors are functions called whenever the metrics are read, which return a dict of gauge names to values,
+    e.g. the current download rate.
+
+    When a metrics file is configured, the metrics are written to it every interval_seconds and when the program
+    exits, either in the Prometheus text format (for the node exporter textfile collector) or, for .json files, as
+    JSON.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.collectors = []
+        self.writer = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """ Adds a value to a summary, which is exported as the _sum and _count of the values """
+        self.inc(name + '_sum', value, **labels)
+        self.inc(name + '_count', 1, **labels)
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def collect(self):
+        """ Returns a dict of (name, labels) to value, with labels as a tuple of (label, value) pairs """
+        with self.lock:
+            collectors = list(self.collectors)
+            values = dict(self.values)
+        for collector in collectors:
+            try:
+                for name, value in collector().items():
+                    values[self._key(name, {})] = value
+            except Exception as e:
+                logger.debug('Could not collect metrics: {}'.format(e))
+        return values
+
+    @staticmethod
+    def _base_name(name):
+        for suffix in ('_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRIC_DEFINITIONS:
+                return name[:-len(suffix)]
+        return name
+
+    def to_prometheus(self):
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(self.collect().items()):
+            base_name = self._base_name(name)
+            if base_name not in described:
+                metric_type, description = METRIC_DEFINITIONS.get(base_name, ('untyped', base_name))
+                lines.append('# HELP {} {}'.format(base_name, description))
+                lines.append('# TYPE {} {}'.format(base_name, metric_type))
+                described.add(base_name)
+            label_text = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels)
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        metrics = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            metrics.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return json.dumps({'timestamp': time.time(), 'metrics': metrics}, indent=2)
+
+    def write_file(self, path):
+        text = self.to_json() if str(path).lower().endswith('.json') else self.to_prometheus()
+        # written to a temporary file first so that readers never see a partly written file
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def start_file_writer(self, path, interval_seconds=15):
+        if self.writer is None:
+            self.writer = MetricsFileWriter(self, path, interval_seconds)
+            self.writer.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """ Stops writing the metrics file, after writing it one last time """
+        if self.writer is not None:
+            self.writer.stop()
+
+
+class MetricsFileWriter(Thread):
+    """ Writes the metrics of a registry to a file every interval_seconds, and once more when stopped """
+
+    def __init__(self, registry, path, interval_seconds=15):
+        Thread.__init__(self)
+        self.registry = registry
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self.daemon = True
+        self.shutdown_flag = threading.Event()
+        # the shutdown flag of every thread is set when the program exits, so it does not tell if stop was called
+        self.stopped = False
+
+    def write(self):
+        try:
+            self.registry.write_file(self.path)
+        except OSError as e:
+            logger.warning('Could not write metrics to {}: {}'.format(self.path, e))
+
+    def run(self):
+        while not self.shutdown_flag.wait(self.interval_seconds):
+            self.write()
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.shutdown_flag.set()
+            self.write()
+
+
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,470 @@
+import io
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# compact types for the columns of the package metadata file. short_name only has one value per data structure
+METADATA_DTYPES = {
+    'package_file_id': 'int64',
+    'nda_s3_url': 'object',
+    'file_size': 'int64',
+    'download_alias': 'object',
+    'short_name': 'category'
+}
+
+# file_size of the files whose size is missing from the package metadata file
+UNKNOWN_FILE_SIZE = -1
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+def hash_strings(values):
+    """ Returns a 64 bit hash of each string. Unlike hash(), the hashes are the same in every process """
+    return pd.util.hash_pandas_object(pd.Series(values, dtype=object), index=False).to_numpy(dtype=np.uint64)
+
+
+def get_regex_literal_prefix(regex):
+    """
+    Returns the text that every string matching regex starts with, or None if there is none. --file-regex can match
+    anywhere in the alias, so only regexes anchored with ^ and without alternatives have a prefix.
+    """
+    if not regex or not regex.startswith('^') or '|' in regex:
+        return None
+    prefix = []
+    for c in regex[1:]:
+        if c in '*?{':
+            # the previous character is optional or may be repeated zero times
+            prefix = prefix[:-1]
+            break
+        if c in REGEX_METACHARACTERS:
+            break
+        prefix.append(c)
+    return ''.join(prefix) or None
+
+
+class MetadataColumnCache:
+    """
+    Binary, column-per-file copy of the package metadata file. Numeric columns are stored as raw int64 arrays,
+    strings as NUL separated UTF-8 with an array of offsets, and categorical columns as int32 codes. The files are
+    memory-mapped when read, so opening the cache does not depend on the size of the package.
+
+    The cache also holds indexes that are built once, when the cache is written: a hash index on the columns in
+    HASH_INDEX_COLUMNS, the rows of each category of a categorical column, and the rows of the columns in
+    SORTED_INDEX_COLUMNS in sorted order. Lookups through an index read only the rows they return.
+
+    The cache records the size and modification time of the metadata file it was built from, and is ignored (and
+    rebuilt) when the metadata file changes.
+    """
+    VERSION = 2
+    SEPARATOR = '\x00'
+    HASH_INDEX_COLUMNS = ('nda_s3_url',)
+    SORTED_INDEX_COLUMNS = ('download_alias',)
+
+    def __init__(self, cache_dir, source_path):
+        self.cache_dir = cache_dir
+        self.source_path = source_path
+        self._manifest = None
+        self._maps = {}
+
+    def get_source_signature(self):
+        stat = os.stat(self.source_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with open(os.path.join(self.cache_dir, 'manifest.json'), 'r') as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def reset(self):
+        self._manifest = None
+        self._maps = {}
+
+    def is_valid(self):
+        try:
+            return self.manifest['version'] == self.VERSION and \
+                self.manifest['source'] == self.get_source_signature()
+        except (OSError, ValueError, KeyError):
+            return False
+
+    @property
+    def row_count(self):
+        return self.manifest['row_count']
+
+    def _map(self, name, dtype):
+        if name not in self._maps:
+            path = os.path.join(self.cache_dir, name)
+            if os.path.getsize(path) == 0:
+                # empty files cannot be memory-mapped
+                self._maps[name] = np.empty(0, dtype=dtype)
+            else:
+                self._maps[name] = np.memmap(path, dtype=dtype, mode='r')
+        return self._maps[name]
+
+    def read_column(self, column, start, stop):
+        kind = self.manifest['columns'][column]
+        if kind == 'int64':
+            return np.array(self._map(column + '.int64', np.int64)[start:stop])
+        elif kind == 'category':
+            codes = self._map(column + '.codes', np.int32)[start:stop]
+            return pd.Categorical.from_codes(codes, self.manifest['categories'][column])
+        offsets = self._map(column + '.offsets', np.int64)
+        nulls = self._map(column + '.nulls', np.bool_)[start:stop]
+        data = self._map(column + '.data', np.uint8)
+        values = np.empty(stop - start, dtype=object)
+        if stop > start:
+            # strings are decoded a whole chunk at a time. the last separator is left out of the slice
+            text = data[offsets[start]:offsets[stop] - 1].tobytes().decode('utf-8')
+            values[:] = text.split(self.SEPARATOR)
+        values[nulls] = np.nan
+        return pd.Series(values, dtype=object)
+
+    def read_rows(self, start, stop):
+        """ Returns the rows from start up to stop as a dataframe """
+        return pd.DataFrame({column: self.read_column(column, start, stop) for column in self.manifest['columns']})
+
+    def read_chunks(self, chunk_size):
+        for start in range(0, self.row_count, chunk_size):
+            yield self.read_rows(start, min(start + chunk_size, self.row_count))
+
+    def get_string(self, column, row):
+        if self._map(column + '.nulls', np.bool_)[row]:
+            return None
+        offsets = self._map(column + '.offsets', np.int64)
+        return self._map(column + '.data', np.uint8)[offsets[row]:offsets[row + 1] - 1].tobytes().decode('utf-8')
+
+    def take(self, rows):
+        """ Returns the given rows as a dataframe, in the order they appear in the metadata file """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        columns = {}
+        for column, kind in self.manifest['columns'].items():
+            if kind == 'int64':
+                columns[column] = self._map(column + '.int64', np.int64)[rows]
+            elif kind == 'category':
+                codes = self._map(column + '.codes', np.int32)[rows]
+                columns[column] = pd.Categorical.from_codes(codes, self.manifest['categories'][column])
+            else:
+                values = np.empty(len(rows), dtype=object)
+                values[:] = [self.get_string(column, row) for row in rows]
+                values[self._map(column + '.nulls', np.bool_)[rows]] = np.nan
+                columns[column] = pd.Series(values, dtype=object)
+        return pd.DataFrame(columns)
+
+    def find_rows(self, column, values):
+        """ Returns the rows where column is one of values, using the hash index of the column """
+        values = list(values)
+        if not values:
+            return np.empty(0, dtype=np.int64)
+        keys = self._map(column + '.hash_keys', np.uint64)
+        hash_rows = self._map(column + '.hash_rows', np.int64)
+        hashes = hash_strings(values)
+        starts = np.searchsorted(keys, hashes, side='left')
+        stops = np.searchsorted(keys, hashes, side='right')
+        wanted = set(values)
+        # different strings can share a hash, so the value of each candidate row is checked
+        return np.array([row for start, stop in zip(starts, stops) for row in hash_rows[start:stop]
+                         if self.get_string(column, row) in wanted], dtype=np.int64)
+
+    def find_category_rows(self, column, category):
+        """ Returns the rows where the categorical column equals category """
+        categories = self.manifest['categories'][column]
+        if category not in categories:
+            return np.empty(0, dtype=np.int64)
+        # group 0 holds the rows without a value, and group i + 1 the rows with code i
+        group = categories.index(category) + 1
+        offsets = self.manifest['group_offsets'][column]
+        return np.array(self._map(column + '.group_rows', np.int64)[offsets[group]:offsets[group + 1]])
+
+    def find_prefix_rows(self, column, prefix):
+        """ Returns the rows where column starts with prefix, using the sorted index of the column """
+        sorted_rows = self._map(column + '.sorted_rows', np.int64)
+
+        def bisect_sorted(is_before):
+            lo, hi = 0, len(sorted_rows)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if is_before(self.get_string(column, sorted_rows[mid])):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        start = bisect_sorted(lambda value: value < prefix)
+        stop = bisect_sorted(lambda value: value < prefix or value.startswith(prefix))
+        return np.array(sorted_rows[start:stop])
+
+    def create_writer(self, source_signature=None):
+        """
+        Returns a writer for a new copy of the cache. source_signature is the signature of the metadata file the
+        cache is built from, and can be set on the writer before it is committed if the file is still being written
+        """
+        return MetadataColumnCacheWriter(self, source_signature)
+
+
+class MetadataColumnCacheWriter:
+    """ Writes the chunks of the metadata file to a temporary directory, which replaces the cache on commit """
+
+    def __init__(self, cache, source_signature=None):
+        self.cache = cache
+        self.source_signature = source_signature
+        self.tmp_dir = '{}.tmp-{}'.format(cache.cache_dir, uuid.uuid4().hex)
+        os.makedirs(self.tmp_dir)
+        self.files = {}
+        self.columns = None
+        self.categories = {}
+        self.string_offsets = {}
+        self.row_count = 0
+
+    def _write(self, name, array):
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.tmp_dir, name), 'wb')
+        self.files[name].write(np.ascontiguousarray(array).tobytes())
+
+    def write(self, chunk):
+        if self.columns is None:
+            self.columns = {c: METADATA_DTYPES[c] for c in chunk.columns}
+            for column, kind in self.columns.items():
+                if kind == 'object':
+                    self.string_offsets[column] = 0
+                    self._write(column + '.offsets', np.zeros(1, dtype=np.int64))
+        for column, kind in self.columns.items():
+            values = chunk[column]
+            if kind == 'int64':
+                self._write(column + '.int64', values.to_numpy(dtype=np.int64, na_value=UNKNOWN_FILE_SIZE))
+            elif kind == 'category':
+                # codes are re-numbered so that they refer to a single list of categories for the whole file
+                categories = self.categories.setdefault(column, {})
+                for category in values.cat.categories:
+                    categories.setdefault(category, len(categories))
+                mapping = np.array([categories[c] for c in values.cat.categories] + [-1], dtype=np.int32)
+                self._write(column + '.codes', mapping[values.cat.codes.to_numpy()])
+            else:
+                nulls = values.isna().to_numpy()
+                strings = values.where(~nulls, '').astype(str)
+                encoded = [(v + MetadataColumnCache.SEPARATOR).encode('utf-8') for v in strings]
+                lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+                self._write(column + '.offsets', self.string_offsets[column] + np.cumsum(lengths))
+                self.string_offsets[column] += int(lengths.sum())
+                self._write(column + '.data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+                self._write(column + '.nulls', nulls)
+                if column in MetadataColumnCache.HASH_INDEX_COLUMNS:
+                    self._write(column + '.hash', hash_strings(strings))
+        self.row_count += len(chunk)
+
+    def write_indexes(self, manifest):
+        """ Builds the indexes of the columns from the files in the temporary directory """
+        written = MetadataColumnCache(self.tmp_dir, self.cache.source_path)
+        written._manifest = manifest
+        group_offsets = {}
+        for column, kind in manifest['columns'].items():
+            if kind == 'category':
+                codes = np.fromfile(os.path.join(self.tmp_dir, column + '.codes'), dtype=np.int32)
+                counts = np.bincount(codes + 1, minlength=len(manifest['categories'][column]) + 1)
+                group_offsets[column] = [0] + np.cumsum(counts).tolist()
+                np.argsort(codes, kind='stable').astype(np.int64).tofile(os.path.join(self.tmp_dir,
+                                                                                      column + '.group_rows'))
+            elif column in MetadataColumnCache.HASH_INDEX_COLUMNS:
+                hash_path = os.path.join(self.tmp_dir, column + '.hash')
+                hashes = np.fromfile(hash_path, dtype=np.uint64)
+                order = np.argsort(hashes, kind='stable')
+                hashes[order].tofile(os.path.join(self.tmp_dir, column + '.hash_keys'))
+                order.astype(np.int64).tofile(os.path.join(self.tmp_dir, column + '.hash_rows'))
+                os.remove(hash_path)
+            if column in MetadataColumnCache.SORTED_INDEX_COLUMNS:
+                values = written.read_column(column, 0, self.row_count).to_numpy()
+                rows = np.flatnonzero(~pd.isna(values))
+                # rows without a value never match a prefix, so they are left out
+                rows[np.argsort(values[rows], kind='stable')].astype(np.int64).tofile(
+                    os.path.join(self.tmp_dir, column + '.sorted_rows'))
+        written.reset()
+        manifest['group_offsets'] = group_offsets
+
+    def commit(self):
+        for f in self.files.values():
+            f.close()
+        manifest = {'version': MetadataColumnCache.VERSION, 'source': self.source_signature,
+                    'row_count': self.row_count, 'columns': self.columns or {},
+                    'categories': {c: list(categories) for c, categories in self.categories.items()}}
+        self.write_indexes(manifest)
+        with open(os.path.join(self.tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        try:
+            if os.path.exists(self.cache.cache_dir):
+                shutil.rmtree(self.cache.cache_dir)
+            os.rename(self.tmp_dir, self.cache.cache_dir)
+        except OSError as e:
+            # e.g. another download of the same package replaced the cache first
+            logger.debug('Could not save the package metadata cache: {}'.format(e))
+            self.abort()
+        self.cache.reset()
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class CopyingReader(io.RawIOBase):
+    """ Readable stream that writes everything read from source to copy_to """
+
+    def __init__(self, source, copy_to):
+        self.source = source
+        self.copy_to = copy_to
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        length = self.source.readinto(b)
+        if length:
+            self.copy_to.write(memoryview(b)[:length])
+        return length
+
+
+class PackageMetadata:
+    """
+    Reads the package metadata file, which lists every file in a package. Packages can contain millions of files, so
+    the file is read in chunks of chunk_size rows using compact column types, and only the columns in METADATA_DTYPES
+    are kept. Filters are applied to one chunk at a time, so the whole table is never held in memory unless it is
+    asked for.
+
+    The first time the file is read, a MetadataColumnCache is written next to it, and later reads come from the
+    cache instead of parsing the csv again. Lookups by s3 url, data structure or alias prefix use the indexes in the
+    cache, so they only read the rows they return.
+    """
+
+    def __init__(self, metadata_file_path, chunk_size=500000):
+        self.metadata_file_path = metadata_file_path
+        self.chunk_size = chunk_size
+        self.cache = MetadataColumnCache(str(metadata_file_path) + '.columns', metadata_file_path)
+
+    def read_chunks(self):
+        """ Yields the rows of the metadata file as dataframes with lowercase column names """
+        if self.cache.is_valid():
+            yield from self.cache.read_chunks(self.chunk_size)
+            return
+        logger.debug('Building the package metadata cache at {}'.format(self.cache.cache_dir))
+        writer = self.cache.create_writer(self.cache.get_source_signature())
+        committed = False
+        try:
+            for chunk in self.read_csv_chunks():
+                writer.write(chunk)
+                yield chunk
+            writer.commit()
+            committed = True
+        finally:
+            # the cache is only saved when the whole file has been read
+            if not committed:
+                writer.abort()
+
+    def read_csv_chunks(self, source=None):
+        """ Parses the metadata file, or source, a binary stream with the contents of the file, in one pass """
+        # column names are upper case in the file. integer columns are parsed as nullable, since values can be missing
+        with pd.read_csv(source or self.metadata_file_path, header=0, usecols=lambda c: c.lower() in METADATA_DTYPES,
+                         dtype={c.upper(): 'Int64' if t == 'int64' else t for c, t in METADATA_DTYPES.items()},
+                         chunksize=self.chunk_size) as reader:
+            for chunk in reader:
+                yield self.fill_missing_values(chunk.rename(columns=str.lower))
+
+    @staticmethod
+    def fill_missing_values(chunk):
+        """
+        Converts the nullable integer columns of a chunk to int64. Files without a size are given a size of
+        UNKNOWN_FILE_SIZE
+        """
+        if 'package_file_id' in chunk.columns and chunk['package_file_id'].isna().any():
+            # there is no way to download a file without an id
+            logger.warning('Skipping {} rows of the package metadata file without a PACKAGE_FILE_ID'
+                           .format(int(chunk['package_file_id'].isna().sum())))
+            chunk = chunk[chunk['package_file_id'].notna()]
+        int_columns = [c for c in chunk.columns if METADATA_DTYPES[c] == 'int64']
+        return chunk.fillna({c: UNKNOWN_FILE_SIZE for c in int_columns}).astype({c: 'int64' for c in int_columns})
+
+    def write(self, stream):
+        """
+        Writes the metadata file from stream, a binary stream with the contents of the file, and builds the cache from
+        the same stream, so the contents are only read once. The file is written to a .partial file that only
+        replaces metadata_file_path when the whole stream has been read.
+        """
+        partial_path = str(self.metadata_file_path) + '.partial'
+        writer = self.cache.create_writer()
+        committed = False
+        try:
+            with open(partial_path, 'wb') as f:
+                source = io.BufferedReader(CopyingReader(stream, f), buffer_size=1024 * 1024)
+                for chunk in self.read_csv_chunks(source):
+                    writer.write(chunk)
+                # keep anything the parser did not need, e.g. trailing blank lines, so the file is complete
+                while source.read(1024 * 1024):
+                    pass
+            os.replace(partial_path, self.metadata_file_path)
+            writer.source_signature = self.cache.get_source_signature()
+            writer.commit()
+            committed = True
+        finally:
+            if not committed:
+                writer.abort()
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+    def build_cache(self):
+        """ Writes the cache if it is missing or out of date. Returns whether a valid cache is available """
+        if not self.cache.is_valid():
+            for _ in self.read_chunks():
+                pass
+        return self.cache.is_valid()
+
+    def load(self, chunk_filter=None, regex=None):
+        """
+        Returns the rows of the metadata file that pass chunk_filter, a function from a dataframe to the rows of the
+        dataframe to keep, and whose download_alias matches regex
+        """
+        prefix = get_regex_literal_prefix(regex)
+        if chunk_filter is None and prefix and self.build_cache():
+            # only the aliases that start with the literal prefix of the regex can match it
+            return self.take(self.cache.find_prefix_rows('download_alias', prefix), regex)
+        chunks = []
+        for chunk in self.read_chunks():
+            if chunk_filter is not None:
+                chunk = chunk_filter(chunk)
+            if regex:
+                chunk = chunk[chunk['download_alias'].str.contains(regex)]
+            chunks.append(chunk)
+        return self.concat(chunks)
+
+    def find_by_s3_urls(self, s3_urls, regex=None):
+        """ Returns the rows whose nda_s3_url is in s3_urls and whose download_alias matches regex """
+        if not self.build_cache():
+            return self.load(lambda chunk: chunk[chunk['nda_s3_url'].isin(s3_urls)], regex)
+        return self.take(self.cache.find_rows('nda_s3_url', s3_urls), regex)
+
+    def find_by_short_name(self, short_name, regex=None):
+        """ Returns the rows of the data structure short_name whose download_alias matches regex """
+        if not self.build_cache():
+            return self.load(lambda chunk: chunk[chunk['short_name'] == short_name], regex)
+        return self.take(self.cache.find_category_rows('short_name', short_name), regex)
+
+    def take(self, rows, regex=None):
+        df = self.cache.take(rows)
+        if regex:
+            df = df[df['download_alias'].str.contains(regex)]
+        return self.concat([df])
+
+    @staticmethod
+    def concat(chunks):
+        if not chunks:
+            return pd.DataFrame({c: pd.Series(dtype=t) for c, t in METADATA_DTYPES.items()})
+        df = pd.concat(chunks, ignore_index=True)
+        if 'short_name' in df.columns:
+            # concat only keeps the categorical type when every chunk has the same categories
+            short_name = df['short_name'].astype('category')
+            df['short_name'] = short_name.cat.reorder_categories(sorted(short_name.cat.categories))
+        return df
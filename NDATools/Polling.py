@@ -0,0 +1,180 @@
+import datetime
+import email.utils
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+from threading import Thread
+
+from NDATools.Utils import HttpErrorHandlingStrategy
+
+logger = logging.getLogger(__name__)
+
+
+class PollTimeoutError(Exception):
+    pass
+
+
+class RetryLater(Exception):
+    """ Raised by a check when the server asked for the next request to wait, e.g. with a Retry-After header """
+
+    def __init__(self, retry_after=None):
+        super().__init__('Retry after {} seconds'.format(retry_after))
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """ Returns the number of seconds to wait from the value of a Retry-After header, or None if it is not valid """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def retry_later_or_exit(response):
+    """ Error handler for requests made by a poll check. Throttled requests are retried instead of ending the program """
+    if response.status_code in (429, 503):
+        raise RetryLater(parse_retry_after(response.headers.get('Retry-After')))
+    HttpErrorHandlingStrategy.print_and_exit(response)
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter. The n-th delay is initial * multiplier^n seconds, at most maximum, reduced by a
+    random amount of up to jitter (as a fraction of the delay) so that jobs started together do not poll together.
+    """
+
+    def __init__(self, initial=1, maximum=10, multiplier=1.5, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def get_delay(self, attempt):
+        delay = min(self.maximum, self.initial * self.multiplier ** attempt)
+        return delay * random.uniform(1 - self.jitter, 1)
+
+
+class PollJob:
+    def __init__(self, check, backoff, deadline, next_poll):
+        self.check = check
+        self.backoff = backoff
+        self.deadline = deadline
+        self.next_poll = next_poll
+        self.attempt = 0
+        self.future = Future()
+
+
+class Poller(Thread):
+    """
+    Polls any number of long-running server operations from a single thread. Each job has a check function, which
+    returns None while the operation is still running and its result once it has finished. Checks are called with a
+    jittered exponential backoff until they return a result, raise an exception, or the job's deadline passes, and the
+    outcome is set on the Future returned by submit().
+
+    A check can raise RetryLater to wait at least as long as the server asked for before the next check.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.shutdown_flag = threading.Event()
+        self.start()
+
+    def submit(self, check, timeout_seconds=None, backoff=None, first_delay=0):
+        """ Starts polling check, first after first_delay seconds. Returns a Future with the result of the check """
+        now = time.monotonic()
+        deadline = now + timeout_seconds if timeout_seconds is not None else None
+        job = PollJob(check, backoff or Backoff(), deadline, now + first_delay)
+        self.schedule(job)
+        return job.future
+
+    def schedule(self, job):
+        with self.condition:
+            heapq.heappush(self.jobs, (job.next_poll, next(self.sequence), job))
+            self.condition.notify()
+
+    def next_due_job(self):
+        with self.condition:
+            while not self.shutdown_flag.is_set():
+                if self.jobs:
+                    wait_seconds = self.jobs[0][0] - time.monotonic()
+                    if wait_seconds <= 0:
+                        return heapq.heappop(self.jobs)[2]
+                    self.condition.wait(wait_seconds)
+                else:
+                    self.condition.wait()
+        return None
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            job = self.next_due_job()
+            if job is None:
+                break
+            if job.attempt == 0 and not job.future.set_running_or_notify_cancel():
+                continue
+            self.poll(job)
+
+    def poll(self, job):
+        retry_after = None
+        try:
+            result = job.check()
+            if result is not None:
+                job.future.set_result(result)
+                return
+        except RetryLater as e:
+            retry_after = e.retry_after
+        except BaseException as e:
+            # e.g. SystemExit from exit_error(), which is raised again in the thread waiting for the result
+            job.future.set_exception(e)
+            return
+        now = time.monotonic()
+        if job.deadline is not None and now >= job.deadline:
+            job.future.set_exception(PollTimeoutError('Operation did not finish before the deadline'))
+            return
+        delay = job.backoff.get_delay(job.attempt)
+        if retry_after is not None:
+            logger.debug('Server asked to retry after {} seconds'.format(retry_after))
+            delay = max(delay, retry_after)
+        job.attempt += 1
+        job.next_poll = now + delay
+        if job.deadline is not None:
+            # always check once more at the deadline, rather than giving up early
+            job.next_poll = min(job.next_poll, job.deadline)
+        self.schedule(job)
+
+    def shutdown(self):
+        with self.condition:
+            self.shutdown_flag.set()
+            self.condition.notify_all()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    """ Returns the poller shared by the whole program, starting it on first use """
+    global _poller
+    with _poller_lock:
+        if _poller is None or not _poller.is_alive():
+            _poller = Poller()
+        return _poller
+
+
+def poll(check, timeout_seconds=None, backoff=None, first_delay=0):
+    """ Polls check on the shared poller and blocks until it returns a result. Raises PollTimeoutError on timeout """
+    return get_poller().submit(check, timeout_seconds, backoff, first_delay).result()
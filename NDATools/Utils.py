@@ -4,6 +4,8 @@ import logging
 import os
 import re
 import sys
+import threading
+import time
 import urllib.parse
 from pathlib import Path
 from typing import Callable, List, Tuple
@@ -15,6 +17,7 @@ from requests.adapters import HTTPAdapter, Retry
 from tqdm.contrib.concurrent import thread_map
 
 from NDATools import exit_error
+from NDATools.Metrics import metrics_registry
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +79,99 @@ class HttpErrorHandlingStrategy():
         response.raise_for_status()
 
 
+class TokenBucket:
+    """
+    Token bucket that limits the rate (in bytes per second) at which bytes are transferred by all of the threads in
+    the process. Callers report the bytes they have transferred with consume(), and are put to sleep when the
+    transfer rate goes above the limit. A rate of 0 means unlimited.
+
+    The limit can be changed while the program is running by writing a new value (e.g. '20MB') to the control file.
+    The control file is checked every few seconds.
+    """
+
+    def __init__(self, rate=0, control_file=None, control_file_check_seconds=5):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.control_file = control_file
+        self.control_file_mtime = None
+        self.control_file_check_seconds = control_file_check_seconds
+        self.next_control_file_check = 0
+
+    def configure(self, rate=None, control_file=None):
+        self.control_file = control_file
+        self.control_file_mtime = None
+        self.next_control_file_check = 0
+        if rate is not None:
+            self.set_rate(rate)
+        if control_file:
+            logger.info('To change the bandwidth limit while the program is running, write a new value to {}'
+                        .format(control_file))
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.rate = rate
+            # start from an empty bucket so that the debt accumulated under the old rate is forgotten
+            self.tokens = 0
+            self.last_refill = time.monotonic()
+        logger.info('Bandwidth limit set to {}'.format('{}/s'.format(human_size(rate)) if rate else 'unlimited'))
+
+    def _check_control_file(self):
+        now = time.monotonic()
+        if not self.control_file or now < self.next_control_file_check:
+            return
+        self.next_control_file_check = now + self.control_file_check_seconds
+        try:
+            mtime = os.path.getmtime(self.control_file)
+            if mtime == self.control_file_mtime:
+                return
+            self.control_file_mtime = mtime
+            with open(self.control_file, 'r') as f:
+                self.set_rate(parse_byte_size(f.read().strip() or '0'))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read bandwidth limit from {}: {}'.format(self.control_file, e))
+
+    def consume(self, byte_count):
+        self._check_control_file()
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            # the bucket holds at most one second worth of transfers
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= byte_count
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+# shared by every download and upload thread in the process
+bandwidth_limiter = TokenBucket()
+
+
+def parse_byte_size(value):
+    """ Parses a size such as '500000', '750K', '20MB' or '1.5G' (optionally followed by '/s') into bytes """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?(?:/S)?\s*', str(value).upper())
+    if not match:
+        raise ValueError('Invalid size: {}'.format(value))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit or ' '))
+
+
+def parse_shard(value):
+    """ Parses a shard such as '2/8' (the 2nd of 8 shards) into a tuple of the shard number and the number of shards """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', str(value))
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError('Invalid shard: {}'.format(value))
+    return int(match.group(1)), int(match.group(2))
+
+
 def parse_local_files(directory_list, no_match, full_file_path, no_read_access, skip_local_file_check):
     """
     Iterates through associated files generate a dictionary of full filepaths and file sizes.
@@ -209,6 +305,15 @@ def is_json(test):
         return False
 
 
+def record_api_request(method, response, seconds):
+    metrics_registry.inc('nda_api_requests_total', method=method, status=response.status_code)
+    metrics_registry.observe('nda_api_request_duration_seconds', seconds, method=method)
+    # the retries made by urllib3 before this response, e.g. after 502 or 503 errors
+    history = getattr(getattr(getattr(response, 'raw', None), 'retries', None), 'history', None)
+    if isinstance(history, tuple) and history:
+        metrics_registry.inc('nda_api_retries_total', len(history), method=method)
+
+
 def _send_prepared_request(prepped, timeout=150, deserialize_handler=DeserializeHandler.convert_json,
                            error_handler=HttpErrorHandlingStrategy.print_and_exit):
     with requests.Session() as session:
@@ -217,7 +322,9 @@ def _send_prepared_request(prepped, timeout=150, deserialize_handler=Deserialize
                         status_forcelist=[502, 503, 504])
         logger.debug('{} {} @ {}'.format(prepped.method, prepped.url, datetime.datetime.now()))
         session.mount(prepped.url, HTTPAdapter(max_retries=retries))
+        start = time.monotonic()
         tmp = session.send(prepped, timeout=timeout)
+        record_api_request(prepped.method, tmp, time.monotonic() - start)
         logger.debug(
             '{} {} (elapsed = {})- STATUS {}'.format(prepped.method, prepped.url, tmp.elapsed, tmp.status_code))
         if not tmp.ok:
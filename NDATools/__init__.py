@@ -191,6 +191,12 @@ def init_and_create_configuration(args, logs_folder, auth_req=True):
     prerun_checks_and_setup()
     LoggingConfiguration.load_config(logs_folder, args.verbose, args.log_dir)
     config = ClientConfiguration(args)
+    if args.max_bandwidth or args.bandwidth_control_file:
+        from NDATools.Utils import bandwidth_limiter
+        bandwidth_limiter.configure(args.max_bandwidth, args.bandwidth_control_file)
+    if args.metrics_file:
+        from NDATools.Metrics import metrics_registry
+        metrics_registry.start_file_writer(args.metrics_file, args.metrics_interval)
     if auth_req:
         authenticate(config)
     return config
@@ -203,6 +209,9 @@ def authenticate(config):
 
 
 def _exit_client(message=None, status_code=1):
+    from NDATools.Metrics import metrics_registry
+    # os._exit skips the atexit handlers, so the metrics file is written one last time here
+    metrics_registry.stop()
     for t in threading.enumerate():
         try:
             t.shutdown_flag.set()
@@ -1,13 +1,31 @@
 import argparse
+import copy
 import sys
 
 from NDATools import exit_error
 from NDATools.Configuration import *
 from NDATools.Download import Download
+from NDATools.Utils import parse_byte_size, parse_shard
 
 logger = logging.getLogger(__name__)
 
 
+def worker_threads_arg(value):
+    if value.lower() == 'auto':
+        return 'auto'
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an integer or 'auto'")
+
+
+def package_ids_arg(value):
+    try:
+        return [int(package_id) for package_id in value.split(',') if package_id.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError('must be a package-id or a comma separated list of package-ids')
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='This application allows you to download files from an NDA package. Tutorials for creating packages'
@@ -26,9 +44,14 @@ def parse_args():
     required = parser.add_argument_group('required arguments')
     parser._action_groups.append(optional)
 
-    required.add_argument('-dp', '--package', required=True, metavar='<package-id>', type=int, action='store',
+    required.add_argument('-dp', '--package', required=True, metavar='<package-id>', type=package_ids_arg,
+                          action='extend', dest='packages',
                           help='The package-id containing the files you wish to download. If no other command-line '
-                               'options are provided, the program will download all files from the specified package.')
+                               'options are provided, the program will download all files from the specified package.\n'
+                               'Several packages can be downloaded at once by giving a comma separated list of package-ids, '
+                               'or by repeating -dp,\ne.g. \'downloadcmd -dp 12345,12346\'. The packages share the download '
+                               'threads and connections, and each package\nkeeps its own download progress. With -d, each '
+                               'package is saved in a folder named after its package-id inside the directory.')
 
     parser.add_argument('paths', metavar='<S3_path_list>', type=str, nargs='*', action='store',
                         help='Optional. When provided, the program will download only the specified files from the package.'
@@ -52,12 +75,91 @@ and always ends in a 2 digit number. (For example, see the data-structure page f
     parser.add_argument('-d', '--directory', metavar='<download_directory>', type=str, nargs=1, action='store',
                         help='Enter an alternate full directory path where you would like your files to be saved. The default is ~/NDA/nda-tools/<package-id>')
 
-    parser.add_argument('-wt', '--workerThreads', metavar='<thread-count>', type=int, action='store',
+    parser.add_argument('-wt', '--workerThreads', metavar='<thread-count>', type=worker_threads_arg, action='store',
                         help='''Specifies the number of downloads to attempt in parallel. For example, running 'downloadcmd -dp 12345 -wt 10' will 
 cause the program to download a maximum of 10 files simultaneously until all of the files from package 12345 have been downloaded. 
 A default value is calculated based on the number of cpus found on the machine, however a higher value can be chosen to decrease download times. 
 If this value is set too high the download will slow. With 32 GB of RAM, a value of '10' is probably close to the maximum number of 
-parallel downloads that the computer can handle''')
+parallel downloads that the computer can handle.
+If 'auto' is entered, the program starts with the default value and measures the download rate and the number of errors while the 
+download is running, adding threads while the download rate improves and removing them when errors or throttling are detected. The 
+chosen thread count is written to the log''')
+
+    parser.add_argument('--multipart-threshold', metavar='<size-in-MB>', type=int, default=1024, action='store',
+                        help='''Files of this size (in MB) or larger are split into byte ranges which are downloaded in parallel, instead of 
+being downloaded over a single connection. Interrupted multipart downloads resume from the ranges that were already completed. 
+Set to 0 to disable multipart downloads. The default value is 1024 (1 GB). This option has no effect when used with -s3''')
+
+    parser.add_argument('--multipart-chunksize', metavar='<size-in-MB>', type=int, default=64, action='store',
+                        help='''The size (in MB) of each byte range requested during a multipart download. The default value is 64''')
+
+    parser.add_argument('--writer-threads', metavar='<thread-count>', type=int, default=0, action='store',
+                        help='''Number of threads used to write downloaded data to disk. When set, download threads hand their data to the 
+writer threads and continue reading from the network, which can help when downloading to a slow or network filesystem. 
+The default value is 0, which writes to disk from the download threads''')
+
+    parser.add_argument('--retries', metavar='<count>', type=int, default=5, action='store',
+                        help='''The number of times a file is retried in the same run after a transient error, such as a dropped connection, 
+a timeout, throttling or a server error. Retries resume from the data that was already downloaded, and the wait between 
+attempts doubles each time (up to a minute). Files that still fail are written to the failed s3 links file. The default 
+value is 5. Set to 0 to disable retries''')
+
+    parser.add_argument('--slow-transfer-ratio', metavar='<fraction>', type=float, default=0.1, action='store',
+                        help='''Transfers that stay slower than this fraction of the median transfer rate of the download for 30 seconds, or 
+that receive no data for a minute, are cancelled and retried over a new connection, resuming from the data already 
+downloaded. Once no files are waiting to be downloaded, transfers slower than half of the median rate are retried as well, 
+so that a few slow connections do not hold up the end of the download. The default value is 0.1. Set to 0 to disable''')
+
+    parser.add_argument('--s3-copy-part-size', metavar='<size-in-MB>', type=int, default=1024, action='store',
+                        help='''Used with -s3. Objects of 5 GB or larger are copied to the s3 destination in parts of this size (in MB). 
+The size is increased when needed to stay under the s3 limit of 10,000 parts. The default value is 1024 (1 GB)''')
+
+    parser.add_argument('--s3-copy-concurrency', metavar='<part-count>', type=int, default=10, action='store',
+                        help='''Used with -s3. The number of parts of a large object that are copied at the same time. Interrupted 
+copies continue from the parts that were already copied. The default value is 10''')
+
+    parser.add_argument('--cache-dir', metavar='<directory>', type=str, action='store',
+                        help='''A directory used to share downloaded files between packages. Files that were already downloaded for any 
+package using the same cache directory are linked into the download directory instead of being downloaded again. Works best 
+when the cache directory is on the same filesystem as the download directory, so that files can be hard linked''')
+
+    parser.add_argument('--cache-size', metavar='<bytes>', type=parse_byte_size, action='store',
+                        help='''The maximum size of the files kept in --cache-dir, e.g. '500G' or '2T'. When the cache is larger, the 
+least recently used files are removed from it. By default the size of the cache is not limited''')
+
+    parser.add_argument('--keep-metadata-gz', action='store_true',
+                        help='''Keep the compressed copy of the package metadata file. The metadata file is decompressed while it is downloaded, 
+and by default only the decompressed file is saved''')
+
+    parser.add_argument('--shard', metavar='<i/N>', type=parse_shard, action='store',
+                        help='''Downloads only the i-th of N parts of the files, so that a large package can be downloaded by N machines at once, 
+e.g. run 'downloadcmd -dp <package-id> --shard 1/4' on the first machine, '--shard 2/4' on the second and so on. Files are 
+assigned to shards the same way on every machine. Each shard keeps its own download progress. Running --verify without 
+--shard merges the progress of the shards that were run on this machine (or whose .download-progress folder was copied here)''')
+
+    parser.add_argument('--shard-by', choices=['id', 'size'], action='store', default='id',
+                        help='''How files are assigned to shards. 'id' (the default) uses a hash of the package_file_id. 'size' balances 
+the shards so that each has about the same number of bytes. Every shard must be run with the same value''')
+
+    parser.add_argument('--metrics-json', metavar='<file>', type=str, action='store',
+                        help='''Saves metrics of the download to a json file when the program finishes, including the download rate, 
+the number of files completed and failed, bytes downloaded by each thread, and the time to first byte and transfer time of files''')
+
+    parser.add_argument('--metrics-file', metavar='<file>', type=str, action='store',
+                        help='''Writes metrics of the run (bytes transferred, files completed, retries, credential refreshes and the latency of 
+requests to NDA web services) to this file every --metrics-interval seconds and when the program exits. Files ending in .json 
+are written as JSON, anything else in the Prometheus text format, e.g. for the node exporter textfile collector''')
+
+    parser.add_argument('--metrics-interval', metavar='<seconds>', type=int, action='store', default=15,
+                        help='How often the --metrics-file is written, in seconds. Defaults to 15')
+
+    parser.add_argument('--max-bandwidth', metavar='<bytes-per-second>', type=parse_byte_size, action='store',
+                        help='''Limits the combined transfer rate of all download threads, in bytes per second. Units can be added to the value, 
+e.g. '500K', '20MB' or '1G'. By default the transfer rate is not limited''')
+
+    parser.add_argument('--bandwidth-control-file', metavar='<file>', type=str, action='store',
+                        help='''A file containing the bandwidth limit (using the same format as --max-bandwidth). The file is checked every 
+few seconds while the program is running, so the limit can be changed without restarting the program. A value of '0' removes the limit''')
 
     parser.add_argument('--file-regex', metavar='<regular expression>',
                         help='''Option can be used to download only a subset of the files in a package.  This command line arg can be used with
@@ -159,10 +261,30 @@ For more details, check the information on the README page.
                                                                     'If this value is not provided or the provided directory does not exist, logs will be saved to NDA/nda-tools/downloadcmd/logs inside your root folder.')
 
     args = parser.parse_args()
+    if not args.packages:
+        # e.g. '-dp ,'
+        parser.error('-dp requires at least one package-id')
+    # the same package may have been given more than once
+    args.packages = list(dict.fromkeys(args.packages))
+    if len(args.packages) > 1 and (args.txt or args.paths):
+        parser.error('-t and s3 paths can only be used when downloading a single package')
+    args.package = args.packages[0]
 
     return args
 
 
+def get_package_args(args):
+    """ Returns a copy of args for each package given with -dp """
+    package_args = []
+    for package_id in args.packages:
+        package_arg = copy.copy(args)
+        package_arg.package = package_id
+        if len(args.packages) > 1 and args.directory:
+            package_arg.directory = [os.path.join(args.directory[0], str(package_id))]
+        package_args.append(package_arg)
+    return package_args
+
+
 def main():
     args = parse_args()
     config = NDATools.init_and_create_configuration(args, NDATools.NDA_TOOLS_DOWNLOADCMD_LOGS_FOLDER)
@@ -174,11 +296,12 @@ def main():
             'ERROR: "--verify" only works with python 3.5 or later. Please upgrade Python in order to continue')
         exit_error()
 
-    s3Download = Download(config, args)
+    downloads = [Download(config, package_args) for package_args in get_package_args(args)]
     if args.verify:
-        s3Download.verify_download()
+        for s3Download in downloads:
+            s3Download.verify_download()
     else:
-        s3Download.start()
+        downloads[0].start(downloads[1:])
 
 
 if __name__ == "__main__":
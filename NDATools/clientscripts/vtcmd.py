@@ -7,7 +7,7 @@ import NDATools
 from NDATools import authenticate
 from NDATools import exit_error
 from NDATools.Configuration import ClientConfiguration
-from NDATools.Utils import get_non_blank_input, get_int_input
+from NDATools.Utils import get_non_blank_input, get_int_input, parse_byte_size
 from NDATools.upload.submission.api import CollectionApi
 from NDATools.upload.submission.resubmission import check_replacement_authorized
 from NDATools.upload.validation.api import ValidationV2Api
@@ -73,6 +73,22 @@ def parse_args():
     parser.add_argument('-bc', '--batch', metavar='<arg>', type=int, action='store',
                         help='Batch size', default=50)
 
+    parser.add_argument('--metrics-file', metavar='<file>', type=str, action='store',
+                        help='''Writes metrics of the run (bytes transferred, files completed, retries, credential refreshes and the latency of 
+requests to NDA web services) to this file every --metrics-interval seconds and when the program exits. Files ending in .json 
+are written as JSON, anything else in the Prometheus text format, e.g. for the node exporter textfile collector''')
+
+    parser.add_argument('--metrics-interval', metavar='<seconds>', type=int, action='store', default=15,
+                        help='How often the --metrics-file is written, in seconds. Defaults to 15')
+
+    parser.add_argument('--max-bandwidth', metavar='<bytes-per-second>', type=parse_byte_size, action='store',
+                        help='''Limits the combined transfer rate of all upload threads, in bytes per second. Units can be added to the value, 
+e.g. '500K', '20MB' or '1G'. By default the transfer rate is not limited''')
+
+    parser.add_argument('--bandwidth-control-file', metavar='<file>', type=str, action='store',
+                        help='''A file containing the bandwidth limit (using the same format as --max-bandwidth). The file is checked every 
+few seconds while the program is running, so the limit can be changed without restarting the program. A value of '0' removes the limit''')
+
     parser.add_argument('--hideProgress', action='store_true', help='Hides upload/processing progress')
 
     parser.add_argument('-f', '--force', action='store_true',
@@ -10,6 +10,7 @@ from typing import List, Callable, Union
 from tqdm import tqdm
 
 from NDATools import exit_error
+from NDATools.Metrics import metrics_registry
 
 logger = logging.getLogger(__name__)
 
@@ -99,12 +100,18 @@ class BatchFileUploader(ABC):
         files_found, not_found = group_files_by_path_exists()
 
         with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [executor.submit(self._upload_file, man) for man in files_found]
+            futures = {executor.submit(self._upload_file, man): man for man in files_found}
 
+        uploader = type(self).__name__
+        if not_found:
+            metrics_registry.inc('nda_upload_files_total', len(not_found), result='not_found', uploader=uploader)
         for f in as_completed(futures):
             if f.exception():
+                metrics_registry.inc('nda_upload_files_total', result='failed', uploader=uploader)
                 exit_error()
             else:
+                metrics_registry.inc('nda_upload_files_total', result='uploaded', uploader=uploader)
+                metrics_registry.inc('nda_upload_bytes_total', futures[f].calculate_size(), uploader=uploader)
                 progress_cb()
 
         self._post_batch_hook(BatchResults(files_found, not_found, search_folders))
@@ -1,8 +1,6 @@
-import datetime
 import enum
 import json
 import logging
-import time
 from typing import List, Union
 
 import requests
@@ -10,6 +8,7 @@ from pydantic import BaseModel, Field
 from requests import HTTPError
 
 from NDATools import exit_error
+from NDATools.Polling import poll, Backoff, PollTimeoutError, retry_later_or_exit
 from NDATools.Utils import get_request, post_request, HttpErrorHandlingStrategy, DeserializeHandler, \
     put_request
 
@@ -172,16 +171,17 @@ class SubmissionApi:
             f"{self.api_endpoint}/{submission_id}?submissionPackageUuid={package_id}&async=true",
             auth=self.auth, deserialize_handler=DeserializeHandler.none)
         # poll the versions endpoint until a new one is created or until we timeout
-        end_time = datetime.timedelta(seconds=self.create_submission_timeout) + datetime.datetime.now()
-        while True:
-            if datetime.datetime.now() > end_time:
-                logger.error("Timed out waiting for submission to replace.")
-                logger.error('\nPlease email NDAHelp@mail.nih.gov for help in resolving this error')
-                exit_error()
+        def check():
             new_version_count = len(self.get_submission_history(submission_id))
-            if new_version_count > version_count:
-                return self.get_submission(submission_id)
-            time.sleep(10)
+            return new_version_count > version_count or None
+
+        try:
+            poll(check, self.create_submission_timeout, Backoff(initial=1, maximum=10))
+        except PollTimeoutError:
+            logger.error("Timed out waiting for submission to replace.")
+            logger.error('\nPlease email NDAHelp@mail.nih.gov for help in resolving this error')
+            exit_error()
+        return self.get_submission(submission_id)
 
     def get_files_by_page(self, submission_id, page_number, page_size, exclude_uploaded=True):
         excluded_q_param = f'&omitCompleted=true' if exclude_uploaded else ''
@@ -202,18 +202,16 @@ class SubmissionApi:
                 exit_error()
 
     def _wait_submission_complete(self, package_id):
-        # poll the versions endpoint until a new one is created or until we timeout
-        end_time = datetime.timedelta(seconds=self.create_submission_timeout) + datetime.datetime.now()
-        while True:
-            if datetime.datetime.now() > end_time:
-                logger.error("Timed out waiting for submission to get created.")
-                logger.error('\nPlease email NDAHelp@mail.nih.gov for help in resolving this error')
-                exit_error()
-            submission = self._query_submissions_by_package_id(package_id)
-            if submission:
-                logger.debug(f"Submission: {submission.submission_id}")
-                return submission
-            time.sleep(10)
+        # poll the submissions endpoint until the submission is created or until we timeout
+        try:
+            submission = poll(lambda: self._query_submissions_by_package_id(package_id),
+                              self.create_submission_timeout, Backoff(initial=1, maximum=10))
+        except PollTimeoutError:
+            logger.error("Timed out waiting for submission to get created.")
+            logger.error('\nPlease email NDAHelp@mail.nih.gov for help in resolving this error')
+            exit_error()
+        logger.debug(f"Submission: {submission.submission_id}")
+        return submission
 
     def _query_submissions_by_package_id(self, package_id):
         tmp = get_request(f"{self.api_endpoint}?packageUuid={package_id}", auth=self.auth)
@@ -259,22 +257,22 @@ class SubmissionPackageApi:
         return SubmissionPackage(**tmp)
 
     def wait_package_complete(self, package_id) -> SubmissionPackage:
-
-        while True:
-            time.sleep(1.1)
-            response = get_request("/".join([self.api_endpoint, package_id]), auth=self.auth)
-            package_status = PackagingStatus(response['status'])
-            if package_status != PackagingStatus.PROCESSING:
-                # done processing. Check for erors...
-                if package_status != PackagingStatus.COMPLETE:
-                    message = 'There was an error in building your package.'
-                    if package_status == PackagingStatus.SYSERROR:
-                        message = response['errors']['system'][0]['message']
-                    elif 'has changed since validation' in response['errors']:
-                        message = response['errors']
-                    exit_error(message=message)
-                else:
-                    return SubmissionPackage(**response)
+        def check():
+            response = get_request("/".join([self.api_endpoint, package_id]), auth=self.auth,
+                                   error_handler=retry_later_or_exit)
+            return response if PackagingStatus(response['status']) != PackagingStatus.PROCESSING else None
+
+        response = poll(check, backoff=Backoff(initial=0.5, maximum=5), first_delay=0.5)
+        package_status = PackagingStatus(response['status'])
+        # done processing. Check for erors...
+        if package_status != PackagingStatus.COMPLETE:
+            message = 'There was an error in building your package.'
+            if package_status == PackagingStatus.SYSERROR:
+                message = response['errors']['system'][0]['message']
+            elif 'has changed since validation' in response['errors']:
+                message = response['errors']
+            exit_error(message=message)
+        return SubmissionPackage(**response)
 
 
 class CollectionApi:
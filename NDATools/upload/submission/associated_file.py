@@ -9,7 +9,7 @@ from boto3.s3.transfer import TransferConfig
 from tqdm import tqdm
 
 from NDATools import exit_error
-from NDATools.Utils import get_s3_client_with_config, deconstruct_s3_url, get_directory_input
+from NDATools.Utils import get_s3_client_with_config, deconstruct_s3_url, get_directory_input, bandwidth_limiter
 from NDATools.upload.batch_file_uploader import BatchFileUploader, UploadContext, Uploadable, UploadError, \
     files_not_found_msg, BatchResults
 from NDATools.upload.submission.api import Submission, AssociatedFile, AssociatedFileStatus, BatchUpdate, \
@@ -102,11 +102,13 @@ class _AssociatedBatchFileUploader(BatchFileUploader):
                 except botocore.exceptions.ClientError as ce:
                     # only upload the file if it hasn't already been uploaded to s3
                     if str(ce.response['Error']['Code']) == '404':
-                        s3.upload_file(file_name, bucket, key, Config=self.upload_context.transfer_config)
+                        s3.upload_file(file_name, bucket, key, Config=self.upload_context.transfer_config,
+                                       Callback=bandwidth_limiter.consume)
                     else:
                         raise UploadError(up, ce)
             else:
-                s3.upload_file(file_name, bucket, key, Config=self.upload_context.transfer_config)
+                s3.upload_file(file_name, bucket, key, Config=self.upload_context.transfer_config,
+                               Callback=bandwidth_limiter.consume)
         except Exception as e:
             logger.error(f'Unexpected error occurred while uploading {up.search_name}: {e}')
             logger.error(traceback.format_exc())
@@ -2,7 +2,6 @@ import json
 import logging
 import os
 import pathlib
-import time
 from threading import RLock
 from typing import Union, List
 
@@ -12,6 +11,8 @@ from botocore.exceptions import ClientError
 from pydantic import BaseModel, Field, ValidationError
 
 from NDATools import exit_error
+from NDATools.Metrics import metrics_registry
+from NDATools.Polling import poll, Backoff, PollTimeoutError
 from NDATools.Utils import get_request, post_request
 
 logger = logging.getLogger(__name__)
@@ -185,6 +186,7 @@ class ValidationV2Api:
 
     def refresh_upload_credentials(self, uuid):
         url = f"{self.api_v2_endpoint}{uuid}/refresh-credentials"
+        metrics_registry.inc('nda_credential_refreshes_total', kind='validation')
         tmp = post_request(url, auth=self.auth)
         return self._get_refreshable_credentials(tmp)
 
@@ -211,24 +213,22 @@ class ValidationV2Api:
         return results
 
     def wait_validation_complete(self, uuid, timeout_seconds, wait_manifest_upload=False) -> ValidationV2:
-        timeout = time.time() + timeout_seconds
-        poll_interval_sec = 1
-        while True:
+        def check():
             validation = self.get_validation(uuid)
             status = validation.status.lower()
+            if 'complete' in status or 'error' in status or ('pending' in status and not wait_manifest_upload):
+                return validation
+            return None
 
-            if 'complete' in status:
-                break
-            elif 'pending' in status and not wait_manifest_upload:
-                break
-            elif 'error' in status:
-                exit_error()
-            else:
-                time.sleep(poll_interval_sec)  # Wait before checking again
-                poll_interval_sec = min(poll_interval_sec * 1.5, 10)
-                if time.time() > timeout:
-                    logger.error(f"Validation timed out for uuid {uuid}")
-                    exit_error()
+        try:
+            validation = poll(check, timeout_seconds, Backoff(initial=0.5, maximum=10))
+        except PollTimeoutError:
+            logger.error(f"Validation timed out for uuid {uuid}")
+            exit_error()
+        metrics_registry.inc('nda_validations_total', status=validation.status)
+        status = validation.status.lower()
+        if 'error' in status and 'complete' not in status:
+            exit_error()
         return validation
 
     def get_v2_routing_percent(self):
@@ -12,6 +12,7 @@ import requests
 from pydantic import BaseModel, Field
 from tqdm import tqdm
 
+from NDATools.Polling import get_poller, Backoff
 from NDATools.Utils import get_request, put_request, Protocol, post_request
 
 logger = logging.getLogger(__name__)
@@ -246,9 +247,23 @@ class Validation:
             return post_request(self.api_scope, data, timeout=self.validation_timeout,
                                 headers={'content-type': 'text/csv'}, auth=self.auth)
 
+        def _check_validation(self, validation_id):
+            def check():
+                response = self._get_validation(validation_id)
+                return response if not response or response['done'] else None
+            return check
+
+        def _add_result(self, response, file_name):
+            if response:
+                self.result_queue.put((response, file_name))
+                if self.progress_bar:
+                    self.progress_bar.update(n=1)
+
         def run(self):
+            # validations are polled by the shared poller, so this thread can create the next validation while
+            # the earlier ones are still running
+            pending = []
             while True and not self.shutdown_flag.is_set():
-                polling = 0
                 file_name = self.file_queue.get()
                 if file_name == "STOP":
                     self.file_queue.put("STOP")
@@ -264,16 +279,15 @@ class Validation:
                     exit_error()
 
                 response = self._create_validation(file.read().encode('utf-8'))
-                while response and not response['done']:
-                    response = self._get_validation(response['id'])
-                    time.sleep(polling)
-                    polling += 1
-                if response:
-                    self.result_queue.put((response, file_name))
-                    if self.progress_bar:
-                        self.progress_bar.update(n=1)
-                # Stop thread after adding validation response
+                if response and not response['done']:
+                    future = get_poller().submit(self._check_validation(response['id']),
+                                                 backoff=Backoff(initial=0.5, maximum=10))
+                    pending.append((future, file_name))
+                else:
+                    self._add_result(response, file_name)
                 self.file_queue.task_done()
+            for future, file_name in pending:
+                self._add_result(future.result(), file_name)
 
 
 class Status:
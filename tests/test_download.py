@@ -1,16 +1,34 @@
+import datetime
+import gzip
+import hashlib
+import http.client
+import io
 import json
 import os
 import shlex
 import shutil
+import threading
+import time
+import tracemalloc
 from unittest.mock import MagicMock
 
 import boto3
+import botocore.exceptions
+import pandas as pd
 import pytest
+import requests
+import urllib3
 from requests import HTTPError
 from requests.structures import CaseInsensitiveDict
 
 import NDATools
-from NDATools.Download import Download, DownloadRequest
+from NDATools.Download import Download, DownloadJob, DownloadRequest, LaneThreadPool, AdaptiveConcurrencyController, \
+    PresignedUrlPrefetcher, get_presigned_url_expiration, is_presigned_url_expiring, is_temp_credentials_expiring, \
+    get_shard_numbers, is_transient_download_error
+from NDATools.clientscripts.downloadcmd import get_package_args
+from NDATools.DownloadIO import MB, BufferPool, StreamingChecksum, ChecksumMismatchError, StallDetector, \
+    TransferStalledError
+from NDATools.PackageMetadata import UNKNOWN_FILE_SIZE
 from tests.conftest import MockLogger
 
 
@@ -106,6 +124,27 @@ def test_download(download_args, expected_file_count, logger_mock, download_mock
     assert ds_download.download_local.call_count == expected_file_count
 
 
+def test_download_several_packages(download_mock, download_config_factory, logger_mock, tmp_path):
+    args, _ = download_config_factory(['-dp', '1189934,1189935', '-dp', '1189934', '-d', str(tmp_path / 'data')])
+    assert args.packages == [1189934, 1189935]
+    with pytest.raises(SystemExit):
+        download_config_factory(['-dp', ','])
+    assert [a.directory for a in get_package_args(args)] == [[str(tmp_path / 'data' / '1189934')],
+                                                             [str(tmp_path / 'data' / '1189935')]]
+
+    downloads = [download_mock(args=['-dp', '1189934']),
+                 download_mock(args=['-dp', '1189934', '--file-regex', '.*.txt', '-d', str(tmp_path / 'other')])]
+    downloads[0].start(downloads[1:])
+    # one pool, session and metrics are shared, and each download keeps its own files and progress
+    assert downloads[1].get_http_session == downloads[0].get_http_session
+    assert downloads[1].metrics is downloads[0].metrics
+    assert downloads[0].download_local.call_count == 7
+    assert downloads[1].download_local.call_count == 5
+    assert downloads[0].download_job_uuid != downloads[1].download_job_uuid
+    logger_mock.info.assert_any_call_contains('Total download requests: 12')
+    logger_mock.info.assert_any_call_contains('Package 1189934: 5 download requests, 0 errors')
+
+
 def test_invalid_regex(download_mock, logger_mock):
     """ User inputs a regex that is invalid. Should alert user and exit"""
     ds_download = download_mock(args=['-dp', '1189934', '--file-regex', '.*.asdfasdf'])
@@ -158,6 +197,230 @@ def test_download_with_some_completed_files(download_mock, logger_mock, tmp_path
     logger_mock.info.assert_any_call_contains('Beginning download of the remaining 2 files')
 
 
+def test_split_download_lanes(download_mock):
+    download = download_mock(args=['-dp', '1189934'])
+    download.large_file_threshold = 100
+    df = pd.DataFrame({'package_file_id': [1, 2, 3, 4, 5], 'file_size': [10, 500, 20, 1000, 100]})
+    large, small = download.split_download_lanes(df)
+    # large files are ordered biggest first, small files keep their original order
+    assert list(large['package_file_id']) == [4, 2, 5]
+    assert list(small['package_file_id']) == [1, 3]
+
+
+def test_small_files_start_before_large_backlog_drains(download_mock, tmp_path):
+    download = download_mock(args=['-dp', '1189934', '-wt', '2'])
+    download.large_file_threshold = 100
+    download.default_download_batch_size = 5
+    started = []
+
+    def download_local(download_request, *args):
+        started.append(download_request.package_file_id)
+        time.sleep(0.01)
+
+    download.download_local.side_effect = download_local
+    # more large files than the queue of a lane holds (6 per thread)
+    df = pd.DataFrame({'package_file_id': range(60), 'download_alias': ['f{}'.format(i) for i in range(60)],
+                       'nda_s3_url': ['s3://b/f{}'.format(i) for i in range(60)],
+                       'file_size': [1000] * 50 + [1] * 10})
+    large_files_df, small_files_df = download.split_download_lanes(df)
+    job = DownloadJob(download, MagicMock(), open(tmp_path / 'failed.csv', 'a'), set(), {}, large_files_df,
+                      small_files_df)
+    download.run_download_jobs([job], [download])
+    assert len(started) == 60
+    first_small = min(started.index(str(i)) for i in range(50, 60))
+    assert first_small < 20
+
+
+def test_generate_download_batch_file_ids(download_mock):
+    download = download_mock(args=['-dp', '1189934'])
+    download.default_download_batch_size = 3
+    df = pd.DataFrame({'package_file_id': range(10), 'download_alias': ['f{}'.format(i) for i in range(10)],
+                       'file_size': [1] * 10})
+    batches = list(download.generate_download_batch_file_ids({0, 5, 9}, df, chunk_size=4))
+    assert [[f['package_file_id'] for f in b] for b in batches] == [[1, 2, 3], [4], [6, 7, 8]]
+    assert batches[0][0] == {'package_file_id': 1, 'download_alias': 'f1', 'file_size': 1}
+
+
+def test_group_duplicate_files(download_mock):
+    download = download_mock(args=['-dp', '1189934'])
+    df = pd.DataFrame({'package_file_id': [1, 2, 3, 4, 4, 5],
+                       'download_alias': ['a/f1', 'b/f1', 'c/f1', 'f2', 'f2', 'f3'],
+                       'nda_s3_url': ['s3://b/f1', 's3://b/f1', 's3://b/f1', 's3://b/f2', 's3://b/f2', 's3://b/f3'],
+                       'file_size': [1] * 6})
+    to_download, duplicate_files = download.group_duplicate_files(df, {5})
+    assert list(to_download['package_file_id']) == [1, 4]
+    assert {k: [f['package_file_id'] for f in v] for k, v in duplicate_files.items()} == {1: [2, 3]}
+
+
+@pytest.mark.parametrize('shard_by', ['id', 'size'])
+def test_get_shard_numbers(shard_by):
+    df = pd.DataFrame({'package_file_id': list(range(1000)) + [7],
+                       'file_size': [(i * 7919) % 1000 for i in range(1000)] + [(7 * 7919) % 1000]})
+    shards = get_shard_numbers(df, 4, shard_by)
+    assert set(shards) == {1, 2, 3, 4}
+    # assignment does not depend on the order of the files, and repeated rows are in the same shard
+    shuffled = df.sample(frac=1, random_state=1)
+    assert list(get_shard_numbers(shuffled, 4, shard_by)) == list(pd.Series(shards, index=df.index)[shuffled.index])
+    assert shards[7] == shards[1000]
+    if shard_by == 'size':
+        shard_sizes = df.iloc[:1000].groupby(shards[:1000])['file_size'].sum()
+        assert shard_sizes.max() - shard_sizes.min() <= df['file_size'].max()
+
+
+def test_download_shards(download_mock, tmp_path):
+    shard_downloads = [download_mock(args=['-dp', '1189934', '--shard', '{}/2'.format(i), '--shard-by', 'size'])
+                       for i in (1, 2)]
+    assert shard_downloads[0].download_job_uuid != shard_downloads[1].download_job_uuid
+    assert shard_downloads[0].build_rerun_download_cmd([]).endswith('--shard 1/2 --shard-by size')
+
+    df = shard_downloads[0].get_all_files_in_package()
+    shard_ids = [set(d.select_shard(df)['package_file_id']) for d in shard_downloads]
+    assert not shard_ids[0] & shard_ids[1]
+    assert shard_ids[0] | shard_ids[1] == set(df['package_file_id'])
+
+    for download, file_ids in zip(shard_downloads, shard_ids):
+        journal = download.get_download_progress_journal()
+        for file_id in file_ids:
+            journal.record({'package_file_id': file_id, 'exists': True, 'actual_file_size': 1})
+        journal.close()
+
+    # the progress of both shards is merged for --verify
+    download = download_mock(args=['-dp', '1189934'])
+    journal = download.get_download_progress_journal()
+    download.merge_shard_progress(journal)
+    assert set(journal.get_completed_file_sizes()) == set(df['package_file_id'])
+    journal.close()
+
+
+def test_download_job_manifest_upgrade(download_mock, tmp_path):
+    download = download_mock(args=['-dp', '1189934'])
+    manifest_path = os.path.join(download.package_metadata_directory, '.download-progress',
+                                 'download-job-manifest.csv')
+    # manifests written before --shard was added do not have the shard columns
+    manifest = pd.read_csv(manifest_path).drop(columns=['shard', 'shard_by'])
+    manifest.to_csv(manifest_path, index=False)
+
+    assert download_mock(args=['-dp', '1189934']).download_job_uuid == download.download_job_uuid
+    assert download_mock(args=['-dp', '1189934', '--shard', '1/2']).download_job_uuid != download.download_job_uuid
+    assert list(pd.read_csv(manifest_path).columns[-2:]) == ['shard', 'shard_by']
+
+
+def test_link_duplicate_file(download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '-d', str(tmp_path)])
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, str(tmp_path))
+    os.makedirs(os.path.dirname(download_request.completed_download_abs_path), exist_ok=True)
+    with open(download_request.completed_download_abs_path, 'w') as f:
+        f.write('{}')
+    download_request.nda_s3_url = 's3://nda-central/testing.txt'
+    duplicate_file = dict(package_file, package_file_id=999, download_alias='other/testing.txt')
+    duplicate_request = download.link_duplicate_file(download_request, duplicate_file)
+    assert duplicate_request.exists
+    assert duplicate_request.actual_file_size == 2
+    assert duplicate_request.nda_s3_url == download_request.nda_s3_url
+    assert os.path.samefile(duplicate_request.completed_download_abs_path,
+                            download_request.completed_download_abs_path)
+
+
+def test_lane_thread_pool_runs_all_lanes():
+    pool = LaneThreadPool(num_threads=3, large_lane_threads=1)
+    completed = []
+    lock = threading.Lock()
+
+    def task(name):
+        with lock:
+            completed.append(name)
+
+    pool.map(task, [['large-{}'.format(i)] for i in range(10)], LaneThreadPool.LARGE)
+    pool.map(task, [['small-{}'.format(i)] for i in range(10)], LaneThreadPool.SMALL)
+    pool.wait_completion()
+    assert len(completed) == 20
+
+
+def test_lane_thread_pool_keeps_a_slot_for_small_files():
+    # the large-file workers could take every active slot, since workers take tasks from the other lane
+    pool = LaneThreadPool(num_threads=4, large_lane_threads=1, active_threads=2)
+    release = threading.Event()
+    small_done = threading.Event()
+    pool.map(lambda: release.wait(5), [[] for _ in range(4)], LaneThreadPool.LARGE)
+    pool.map(small_done.set, [[]], LaneThreadPool.SMALL)
+    # small files run while the large files are still in progress
+    assert small_done.wait(5)
+    assert pool.active_large_tasks == 1
+    release.set()
+    pool.wait_completion()
+
+
+def test_adaptive_concurrency_controller():
+    pool = MagicMock()
+    samples = [(0, 0, 0), (100, 0, 0), (300, 0, 0), (350, 0, 0), (500, 0, 1)]
+    controller = AdaptiveConcurrencyController(pool, MagicMock(side_effect=samples), initial_threads=4,
+                                               min_threads=1, max_threads=5, interval_seconds=1)
+    controller.last_sample = controller.sample_func()
+    controller.adjust()  # throughput improved
+    assert controller.active_threads == 5
+    controller.adjust()  # throughput improved but already at the upper bound
+    assert controller.active_threads == 5
+    controller.adjust()  # throughput dropped
+    assert controller.active_threads == 4
+    controller.adjust()  # throttled
+    assert controller.active_threads == 2
+    pool.set_active_limit.assert_called_with(2)
+
+
+def test_auto_worker_threads(download_mock):
+    download = download_mock(args=['-dp', '1189934', '-wt', 'auto'])
+    assert download.adaptive_threads
+    assert download.max_thread_num >= download.thread_num
+    assert '-wt auto' in download.build_rerun_download_cmd([])
+
+
+def test_presigned_url_expiration():
+    v4_url = 'https://nda-central.s3.amazonaws.com/file.txt?X-Amz-Algorithm=AWS4-HMAC-SHA256' \
+             '&X-Amz-Date=20240101T120000Z&X-Amz-Expires=3600&X-Amz-Signature=abc'
+    assert get_presigned_url_expiration(v4_url) == datetime.datetime(2024, 1, 1, 13, tzinfo=datetime.timezone.utc)
+    assert is_presigned_url_expiring(v4_url)
+    v2_url = 'https://nda-central.s3.amazonaws.com/file.txt?AWSAccessKeyId=abc&Expires=4102444800&Signature=abc'
+    assert not is_presigned_url_expiring(v2_url)
+    assert get_presigned_url_expiration('https://nda-central.s3.amazonaws.com/file.txt') is None
+
+
+def test_presigned_url_prefetcher():
+    files = [(LaneThreadPool.LARGE, {'package_file_id': i}) for i in range(3)]
+    files += [(LaneThreadPool.SMALL, {'package_file_id': i}) for i in range(3, 300)]
+    get_urls = MagicMock(side_effect=get_presigned_urls_mock)
+    prefetcher = PresignedUrlPrefetcher(iter(files), get_urls, min_batch_size=50, max_batch_size=100)
+    prefetcher.start()
+    batches = list(prefetcher.batches())
+    # batches dont mix lanes and grow while the service responds quickly
+    assert [(lane, len(b)) for lane, b in batches] == [(LaneThreadPool.LARGE, 3), (LaneThreadPool.SMALL, 100),
+                                                       (LaneThreadPool.SMALL, 100), (LaneThreadPool.SMALL, 97)]
+    assert batches[1][1][0] == ({'package_file_id': 3}, 's3://fake-presigned-url')
+
+
+def test_presigned_url_prefetcher_url_lifetime():
+    signed_at = datetime.datetime.now(datetime.timezone.utc)
+    expired_at = signed_at - datetime.timedelta(hours=1)
+
+    def presigned_url(signed, expires=3600):
+        return 'https://nda-central.s3.amazonaws.com/file.txt?X-Amz-Date={}&X-Amz-Expires={}&X-Amz-Signature=abc' \
+            .format(signed.strftime('%Y%m%dT%H%M%SZ'), expires)
+
+    get_urls = MagicMock(side_effect=lambda ids: {i: presigned_url(signed_at) for i in ids})
+    prefetcher = PresignedUrlPrefetcher(iter([]), get_urls, min_batch_size=50, max_batch_size=5000)
+    # urls that are valid for an hour, handed out at 1 file per second, only allow batches of 3600 / 2 / 5 files
+    prefetcher.url_lifetime = 3600
+    prefetcher.handed_out_files = 100
+    prefetcher.first_handed_out = time.time() - 100
+    assert 350 < prefetcher.get_max_batch_size() <= 360
+    # urls that expired while the batch waited in the queue are requested again
+    package_files = [({'package_file_id': 1}, presigned_url(expired_at)),
+                     ({'package_file_id': 2}, presigned_url(signed_at))]
+    refreshed = prefetcher.refresh_expiring_urls(LaneThreadPool.SMALL, package_files)
+    get_urls.assert_called_once_with([1])
+    assert refreshed == [({'package_file_id': 1}, presigned_url(signed_at)), package_files[1]]
+
+
 @pytest.fixture
 def download_mock2(load_from_file, download_config_factory, monkeypatch, tmp_path, logger_mock):
     """mock for testing download_local and download_to_s3 methods"""
@@ -175,7 +438,7 @@ def package_file():
     return {
         'package_file_id': 12345678,
         'download_alias': 'image03/testing.txt',
-        'file_size': 123
+        'file_size': 2  # the size of the default Response body
     }
 
 
@@ -193,6 +456,7 @@ class Response:
         self.text = text
         self.elapsed = elapsed
         self.headers = headers
+        self.raw = io.BytesIO(text.encode('utf-8'))
 
     @property
     def ok(self):
@@ -214,7 +478,7 @@ def test_download_local(monkeypatch, download_mock2, download_request):
     download = download_mock2(args=['-dp', '1189934'])
     mock_session = MagicMock()
     mock_response_context = MagicMock()
-    mock_session.return_value.__enter__.return_value.get.return_value = mock_response_context
+    mock_session.return_value.get.return_value = mock_response_context
     mock_response_context.__enter__.return_value = Response()
     with monkeypatch.context() as m:
         m.setattr('requests.session', mock_session)
@@ -227,15 +491,25 @@ def test_download_local(monkeypatch, download_mock2, download_request):
 
     # test that a download continues where it left off when a file is alreay present on disk
     # mock a response that returns the last byte of the file
-    mock_response_context.__enter__.return_value = Response(text='}')
+    mock_response_context.__enter__.return_value = Response(status_code=206, text='}')
+    with monkeypatch.context() as m:
+        m.setattr('requests.session', mock_session)
+        m.setattr(os, 'rename', MagicMock())
+        m.setattr(os.path, 'isfile', MagicMock(side_effect=lambda path: path.endswith('.partial')))
+        m.setattr(os.path, 'getsize', MagicMock(return_value=1))
+        download.download_local(download_request)
+        assert download_request.actual_file_size == 2
+        assert mock_session.return_value.get.call_args.kwargs['headers'] == {'Range': 'bytes=1-'}
+
+    # the download starts over when the server sends the whole file instead of the requested range
+    mock_response_context.__enter__.return_value = Response(text='{}')
     with monkeypatch.context() as m:
         m.setattr('requests.session', mock_session)
         m.setattr(os, 'rename', MagicMock())
-        m.setattr(os.path, 'isfile', MagicMock(side_effect=[False, True]))
+        m.setattr(os.path, 'isfile', MagicMock(side_effect=lambda path: path.endswith('.partial')))
         m.setattr(os.path, 'getsize', MagicMock(return_value=1))
         download.download_local(download_request)
         assert download_request.actual_file_size == 2
-        assert mock_session.headers.update.called_once_with({'Range': 'bytes=1-'})
 
     # test that a download is skipped when the file is already downloaded
     with monkeypatch.context() as m:
@@ -249,7 +523,364 @@ def test_download_local(monkeypatch, download_mock2, download_request):
         assert not os.rename.called
 
 
-def test_download_to_s3(monkeypatch, download_mock2, download_request):
+def ranged_session_mock(content, e_tag=None):
+    """ mock session that serves byte ranges of content """
+
+    def get(url, stream=False, headers=None):
+        start, end = headers['Range'].replace('bytes=', '').split('-')
+        response_context = MagicMock()
+        response_context.__enter__.return_value = Response(status_code=206, text=content[int(start):int(end) + 1],
+                                                           headers=CaseInsensitiveDict({'ETag': f'"{e_tag}"'})
+                                                           if e_tag else None)
+        return response_context
+
+    session = MagicMock()
+    session.get = MagicMock(side_effect=get)
+    return session
+
+
+def test_download_local_in_parts(monkeypatch, download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '--multipart-threshold', '1', '--multipart-chunksize', '1'])
+    content = 'abcdefghij' * 250000  # 2.5 MB => 3 parts
+    package_file['file_size'] = len(content)
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, tmp_path)
+    session = ranged_session_mock(content)
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    download.download_local(download_request)
+    assert session.get.call_count == 3
+    assert download_request.actual_file_size == len(content)
+    with open(download_request.completed_download_abs_path) as f:
+        assert f.read() == content
+    assert not os.path.exists(download_request.partial_download_parts_abs_path)
+    download.close_part_executor()
+
+
+@pytest.mark.parametrize('upload_part_size,status', [(MB, 'verified'), (2 * MB, 'unverified')])
+def test_download_local_in_parts_checksum(monkeypatch, download_mock2, package_file, tmp_path, upload_part_size,
+                                          status):
+    download = download_mock2(args=['-dp', '1189934', '--multipart-threshold', '1', '--multipart-chunksize', '1'])
+    content = 'abcdefghij' * 250000
+    package_file['file_size'] = len(content)
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, tmp_path)
+    data = content.encode('utf-8')
+    part_digests = [hashlib.md5(data[i:i + upload_part_size]).digest() for i in range(0, len(data), upload_part_size)]
+    e_tag = '{}-{}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=ranged_session_mock(content, e_tag)))
+    download.download_local(download_request)
+    # 1MB ranges can only be checksummed when they cover whole upload parts
+    assert download_request.checksum_status == status
+    assert download_request.checksum == (e_tag if status == 'verified' else None)
+    download.close_part_executor()
+
+
+def test_download_local_in_parts_resume(monkeypatch, download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '--multipart-threshold', '1', '--multipart-chunksize', '1'])
+    content = 'abcdefghij' * 250000
+    package_file['file_size'] = len(content)
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, tmp_path)
+    # simulate an interrupted download where the first and last parts completed
+    os.makedirs(os.path.dirname(download_request.partial_download_abs_path), exist_ok=True)
+    with open(download_request.partial_download_abs_path, 'wb') as f:
+        f.truncate(len(content))
+        f.write(content[:1024 * 1024].encode('utf-8'))
+        f.seek(2 * 1024 * 1024)
+        f.write(content[2 * 1024 * 1024:].encode('utf-8'))
+    with open(download_request.partial_download_parts_abs_path, 'w') as f:
+        json.dump({'file_size': len(content), 'part_size': 1024 * 1024, 'completed_parts': [0, 2]}, f)
+
+    session = ranged_session_mock(content)
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    download.download_local(download_request)
+    assert session.get.call_count == 1
+    assert session.get.call_args.kwargs['headers'] == {'Range': 'bytes=1048576-2097151'}
+    with open(download_request.completed_download_abs_path) as f:
+        assert f.read() == content
+    download.close_part_executor()
+
+
+def test_download_local_short_body(monkeypatch, download_mock2, download_request):
+    download = download_mock2(args=['-dp', '1189934'])
+    download_request.expected_file_size = 10
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response()
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    with pytest.raises(http.client.IncompleteRead):
+        download.download_local(download_request)
+    # the truncated file is not completed, and the next attempt resumes it
+    assert not os.path.exists(download_request.completed_download_abs_path)
+    assert os.path.getsize(download_request.partial_download_abs_path) == 2
+
+
+def test_download_local_restarts_preallocated_partial_file(monkeypatch, download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '--multipart-threshold', '1', '--multipart-chunksize', '1'])
+    content = 'abcdefghij' * 250000
+    package_file['file_size'] = len(content)
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, tmp_path)
+    # a download in parts that was interrupted after preallocating, before its parts file was written
+    os.makedirs(os.path.dirname(download_request.partial_download_abs_path), exist_ok=True)
+    with open(download_request.partial_download_abs_path, 'wb') as f:
+        f.truncate(len(content))
+
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response(text=content)
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    download.download_local(download_request)
+    # the file is downloaded again instead of asking for a range past its end
+    assert session.get.call_args.kwargs['headers'] is None
+    with open(download_request.completed_download_abs_path) as f:
+        assert f.read() == content
+
+
+@pytest.mark.parametrize('e_tag,matches', [
+    (hashlib.md5(b'{}').hexdigest(), True),
+    (hashlib.md5(b'[]').hexdigest(), False),
+])
+def test_download_local_checksum(monkeypatch, download_mock2, download_request, e_tag, matches):
+    download = download_mock2(args=['-dp', '1189934'])
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response(headers=CaseInsensitiveDict({'ETag': f'"{e_tag}"'}))
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    if matches:
+        download.download_local(download_request)
+        assert download_request.checksum == e_tag
+        assert os.path.isfile(download_request.completed_download_abs_path)
+    else:
+        with pytest.raises(ChecksumMismatchError):
+            download.download_local(download_request)
+        # the corrupt file is removed so that it is downloaded again
+        assert not os.path.exists(download_request.partial_download_abs_path)
+        assert not os.path.exists(download_request.completed_download_abs_path)
+    assert download_request.e_tag == e_tag
+    assert download_request.checksum_status == ('verified' if matches else 'mismatch')
+
+
+@pytest.mark.parametrize('part_count,status', [(1, 'mismatch'), (2, 'unverified')])
+def test_download_local_multipart_checksum_mismatch(monkeypatch, download_mock2, download_request, part_count,
+                                                    status):
+    download = download_mock2(args=['-dp', '1189934'])
+    e_tag = '{}-{}'.format(hashlib.md5(b'[]').hexdigest(), part_count)
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response(headers=CaseInsensitiveDict({'ETag': f'"{e_tag}"'}))
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    download.download_local(download_request)
+    # the ETag depends on the part size used for the upload, so the file is kept and the mismatch recorded. a file
+    # of 2 bytes in 2 parts does not fit a whole number of MB per part, so the file could not be verified
+    assert download_request.checksum_status == status
+    assert os.path.isfile(download_request.completed_download_abs_path)
+
+
+def test_streaming_checksum_multipart_e_tag():
+    content = os.urandom(20 * 1024 * 1024 + 123)
+    part_size = 8 * 1024 * 1024
+    part_digests = [hashlib.md5(content[i:i + part_size]).digest() for i in range(0, len(content), part_size)]
+    e_tag = '{}-3'.format(hashlib.md5(b''.join(part_digests)).hexdigest())
+    checksum = StreamingChecksum(e_tag, len(content))
+    for i in range(0, len(content), 5 * 1024 * 1024):
+        checksum.update(content[i:i + 5 * 1024 * 1024])
+    assert checksum.hexdigest() == e_tag
+
+
+def test_download_local_writer_threads(monkeypatch, download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '--writer-threads', '2'])
+    download.download_chunk_size = 1024
+    download.buffer_pool = BufferPool(1024, 3)
+    content = 'abcdefghij' * 1000
+    package_file['file_size'] = len(content)
+    download_request = DownloadRequest(package_file, 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1',
+                                       123456789, tmp_path)
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response(text=content)
+    monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+    download.download_local(download_request)
+    assert download_request.actual_file_size == len(content)
+    with open(download_request.completed_download_abs_path) as f:
+        assert f.read() == content
+    # every buffer is returned to the pool once written
+    assert download.buffer_pool.free_buffers.qsize() == download.buffer_pool.allocated
+    download.close_disk_writers()
+    assert download.metrics.snapshot()['bytes_transferred'] == len(content)
+
+
+class FakeSocket:
+    """ Socket that returns a canned http response, for building real http.client and urllib3 responses """
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode):
+        return io.BufferedReader(io.BytesIO(self.data))
+
+
+def make_streaming_response(body, headers, content_length=None):
+    head = 'HTTP/1.1 200 OK\r\nContent-Length: {}\r\n'.format(content_length or len(body))
+    head += ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items()) + '\r\n'
+    http_response = http.client.HTTPResponse(FakeSocket(head.encode() + body))
+    http_response.begin()
+    pool = MagicMock()
+    raw = urllib3.HTTPResponse(body=http_response, headers=dict(http_response.getheaders()), status=200,
+                               preload_content=False, decode_content=False, original_response=http_response,
+                               pool=pool, connection=MagicMock())
+    return MagicMock(raw=raw, headers=CaseInsensitiveDict(raw.headers)), pool
+
+
+@pytest.mark.parametrize('encoded', [False, True])
+def test_write_response_reads_into_buffers(download_mock2, tmp_path, encoded):
+    download = download_mock2(args=['-dp', '1189934'])
+    download.buffer_pool = BufferPool(MB, 2)
+    # allocate the pooled buffers up front, so that only allocations made while reading are traced
+    download.buffer_pool.release(download.buffer_pool.acquire())
+    content = os.urandom(8 * MB)
+    response, pool = make_streaming_response(gzip.compress(content) if encoded else content,
+                                             {'Content-Encoding': 'gzip'} if encoded else {})
+    with open(tmp_path / 'file.partial', 'wb') as f:
+        tracemalloc.start()
+        written = download.write_response(response, f)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert written == len(content)
+    assert (tmp_path / 'file.partial').read_bytes() == content
+    if not encoded:
+        # the body is read into the pooled buffers without a bytes object for each chunk
+        assert peak < MB // 4
+    # the connection goes back to the pool to be reused
+    pool._put_conn.assert_called_once()
+
+
+@pytest.mark.parametrize('encoded', [False, True])
+def test_write_response_truncated_body(download_mock2, tmp_path, encoded):
+    download = download_mock2(args=['-dp', '1189934'])
+    body = gzip.compress(os.urandom(1000)) if encoded else os.urandom(1000)
+    # the connection is closed halfway through the body
+    response, pool = make_streaming_response(body[:len(body) // 2], {'Content-Encoding': 'gzip'} if encoded else {},
+                                             content_length=len(body))
+    with open(tmp_path / 'file.partial', 'wb') as f:
+        with pytest.raises(Exception) as e:
+            download.write_response(response, f)
+    # the download is retried
+    assert is_transient_download_error(e.value)
+
+
+def test_stall_detector():
+    now = [0.0]
+    detector = StallDetector(slow_ratio=0.1, interval_seconds=5, grace_seconds=15, stall_seconds=30, min_samples=3,
+                             clock=lambda: now[0])
+    fast = [MagicMock(raw=io.BytesIO(b'x' * 10 ** 6)) for _ in range(3)]
+    slow, stalled = MagicMock(raw=io.BytesIO(b'x' * 10 ** 6)), MagicMock(raw=io.BytesIO(b'x' * 10 ** 6))
+    transfers = {response: detector.watch(response) for response in fast + [slow, stalled]}
+    cancelled = 0
+    for _ in range(6):
+        now[0] += 5
+        for response in fast:
+            response.raw.read(10000)
+        slow.raw.read(100)
+        cancelled += detector.check()
+    # transfers far below the median rate are cancelled once they have been slow for the grace period
+    assert cancelled == 2
+    assert transfers[slow].cancelled and transfers[stalled].cancelled
+    slow.close.assert_called_once()
+    assert not any(transfers[response].cancelled for response in fast)
+
+    # near the end of the run, transfers at a fraction of the median rate are reissued as well
+    detector.is_run_ending = lambda: True
+    for _ in range(4):
+        now[0] += 5
+        fast[0].raw.read(10000)
+        fast[1].raw.read(10000)
+        fast[2].raw.read(2000)
+        detector.check()
+    assert transfers[fast[2]].cancelled and not transfers[fast[0]].cancelled
+
+
+def test_write_response_raises_when_stalled(monkeypatch, download_mock2, tmp_path):
+    download = download_mock2(args=['-dp', '1189934'])
+    download.stall_detector = MagicMock()
+    download.stall_detector.watch.return_value.cancelled = True
+    with open(tmp_path / 'file.partial', 'wb') as f:
+        with pytest.raises(TransferStalledError):
+            download.write_response(Response(text='abc'), f)
+    download.stall_detector.unwatch.assert_called_once()
+
+
+def test_download_from_s3link_uses_cache(monkeypatch, download_mock2, package_file, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    package_file = dict(package_file, file_size=2, nda_s3_url='s3://nda-central/testing.txt')
+    presigned_url = 'https://s3.amazonaws.com/nda-central/testing.txt?signature=1'
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = Response()
+
+    first = download_mock2(args=['-dp', '1189934', '-d', str(tmp_path / 'first'), '--cache-dir', cache_dir])
+    monkeypatch.setattr(first, 'get_http_session', MagicMock(return_value=session))
+    assert first.download_from_s3link(package_file, presigned_url).exists
+
+    # a download of another package that contains the same object is served from the cache
+    second = download_mock2(args=['-dp', '1189935', '-d', str(tmp_path / 'second'), '--cache-dir', cache_dir])
+    monkeypatch.setattr(second, 'get_http_session', MagicMock(return_value=session))
+    download_request = second.download_from_s3link(package_file, presigned_url)
+    assert download_request.exists
+    assert download_request.actual_file_size == 2
+    assert session.get.call_count == 1
+    assert first.metrics.snapshot()['transfer_time_seconds']['count'] == 1
+    # files linked from the cache count as completed, without a transfer time
+    assert second.metrics.snapshot()['files_completed'] == 1
+    assert second.metrics.snapshot()['transfer_time_seconds']['count'] == 0
+    with open(download_request.completed_download_abs_path) as f:
+        assert f.read() == '{}'
+
+
+def test_download_package_metadata_file_streams_gzip(monkeypatch, download_mock2, tmp_path):
+    contents = b'"PACKAGE_FILE_ID","NDA_S3_URL","FILE_SIZE","DOWNLOAD_ALIAS","SHORT_NAME"\n' + \
+               b''.join(b'"%d","s3://nda-central/image03/file%d.txt","%d","image03/file%d.txt","image03"\n'
+                        % (i, i, i, i) for i in range(1, 101))
+    # a gzip file with two members, as written by e.g. concatenating two .gz files
+    compressed = gzip.compress(contents[:1000]) + gzip.compress(contents[1000:])
+
+    for args, keeps_gz in ((['-dp', '1189934'], False), (['-dp', '1189934', '--keep-metadata-gz'], True)):
+        download = download_mock2(args=args)
+        package_dir = tmp_path / str(keeps_gz)
+        monkeypatch.setattr(download, 'package_metadata_directory', str(package_dir))
+        monkeypatch.setattr(download, 'metadata_file_path', str(package_dir / 'package_file_metadata_1189934.txt'))
+        monkeypatch.setattr(download, 'get_package_file_metadata_creds',
+                            MagicMock(return_value={'package_file_id': 1, 'downloadURL': 'https://s3/metadata.gz'}))
+        response = Response()
+        response.raw = io.BytesIO(compressed)
+        session = MagicMock()
+        session.get.return_value.__enter__.return_value = response
+        monkeypatch.setattr(download, 'get_http_session', MagicMock(return_value=session))
+
+        download.download_package_metadata_file()
+        with open(download.metadata_file_path, 'rb') as f:
+            assert f.read() == contents
+        assert os.path.exists(download.metadata_file_path + '.gz') == keeps_gz
+        metadata = download.get_package_metadata()
+        # the cache was built while the file was downloaded
+        assert metadata.cache.is_valid()
+        assert metadata.find_by_s3_urls(['s3://nda-central/image03/file42.txt'])['file_size'].tolist() == [42]
+
+
+def test_http_session_is_reused(monkeypatch, download_mock2):
+    download = download_mock2(args=['-dp', '1189934', '-wt', '4'])
+    mock_session = MagicMock()
+    with monkeypatch.context() as m:
+        m.setattr('requests.session', mock_session)
+        s1 = download.get_http_session('https://s3.amazonaws.com/nda-central/file1.txt?signature=1')
+        s2 = download.get_http_session('https://s3.amazonaws.com/nda-central/file2.txt?signature=2')
+        s3 = download.get_http_session('https://nda.central.s3.amazonaws.com/file3.txt?signature=3')
+        # one session for the whole run, with one connection pool mounted per host
+        assert s1 is s2 is s3
+        assert mock_session.call_count == 1
+        assert s1.mount.call_count == 2
+        adapter = s1.mount.call_args_list[0].args[1]
+        # room for the connections of the download workers and of the part executor
+        assert adapter._pool_maxsize == 8
+        download.close_http_session()
+        assert s1.close.called
+
+
+def test_download_to_s3(monkeypatch, download_mock2, download_request, package_file, tmp_path):
     download = download_mock2(args=['-dp', '1189934'])
     with monkeypatch.context() as m:
         creds = {
@@ -262,23 +893,135 @@ def test_download_to_s3(monkeypatch, download_mock2, download_request):
         m.setattr(download, 'get_temp_creds_for_file', MagicMock(return_value=creds))
         s3_session = MagicMock()
         s3_client = MagicMock()
-        s3_resource = MagicMock()
         head_object_response = {
-            'ContentLength': '999999999999',
+            'ContentLength': '1000',
             'ETag': '123123123',
         }
 
         m.setattr(boto3.session, 'Session', MagicMock(return_value=s3_session))
         m.setattr(s3_session, 'client', MagicMock(return_value=s3_client))
-        m.setattr(s3_session, 'resource', MagicMock(return_value=s3_resource))
         m.setattr(s3_client, 'head_object', MagicMock(return_value=head_object_response))
+        s3_client.copy_object.return_value = {'CopyObjectResult': {'ETag': '"456456456"'}}
+        # without a size in the package metadata, the size is looked up with head_object
+        download_request = DownloadRequest(dict(package_file, file_size=UNKNOWN_FILE_SIZE),
+                                           download_request.presigned_url, 123456789, tmp_path)
+        assert download_request.expected_file_size is None
         download.download_to_s3(download_request)
-        assert s3_resource.meta.client.copy.called_once_with({
+        assert s3_client.head_object.called
+        # objects under 5GB are copied with a single request
+        s3_client.copy_object.assert_called_once_with(CopySource={
             'Bucket': 'nda-central',
             'Key': 'collection-1860/submission-12345/testing.txt',
-        }, 'personal-bucket', 'prefix/image03/testing.txt')
-        assert 'Config' in s3_resource.meta.client.copy.call_args_list[0].kwargs
-        assert 'Callback' in s3_resource.meta.client.copy.call_args_list[0].kwargs
+        }, Bucket='personal-bucket', Key='prefix/image03/testing.txt', ACL='bucket-owner-full-control')
+        assert not s3_client.copy.called
+        assert download_request.e_tag == '456456456'
+
+        # credentials fetched ahead of time are used, the client is reused and head_object is skipped
+        download.get_temp_creds_for_file.reset_mock()
+        s3_client.head_object.reset_mock()
+        download_request.expected_file_size = 123
+        download.download_to_s3(download_request, dict(creds))
+        assert not download.get_temp_creds_for_file.called
+        assert not s3_client.head_object.called
+        assert download_request.actual_file_size == 123
+        assert boto3.session.Session.call_count == 1
+        assert s3_session.client.call_count == 1
+
+
+def test_download_to_s3_in_parts(monkeypatch, download_mock2, download_request):
+    download = download_mock2(args=['-dp', '1189934', '--s3-copy-part-size', '2048'])
+    creds = {
+        'access_key': 'XXX',
+        'secret_key': '123',
+        'session_token': '123',
+        'source_uri': 's3://nda-central/collection-1860/submission-12345/testing.txt',
+        'destination_uri': 's3://personal-bucket/prefix/image03/testing.txt'
+    }
+    s3_client = MagicMock()
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3_client.upload_part_copy.side_effect = lambda **kwargs: {
+        'CopyPartResult': {'ETag': '"etag-{}"'.format(kwargs['PartNumber'])}}
+    monkeypatch.setattr(download, 'get_s3_client', MagicMock(return_value=s3_client))
+    gb = 1024 * 1024 * 1024
+    download_request.expected_file_size = 7 * gb
+
+    # simulate a copy that was interrupted after the first and last parts completed
+    state_path = download.get_s3_copy_state_path(download_request)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump({'upload_id': 'upload-0', 'file_size': 7 * gb, 'part_size': 2 * gb,
+                   'source': {'Bucket': 'nda-central', 'Key': 'collection-1860/submission-12345/testing.txt'},
+                   'destination': ['personal-bucket', 'prefix/image03/testing.txt'],
+                   'parts': {'1': '"etag-1"', '4': '"etag-4"'}}, f)
+
+    download.download_to_s3(download_request, creds)
+    assert not s3_client.create_multipart_upload.called
+    copied = sorted(c.kwargs['PartNumber'] for c in s3_client.upload_part_copy.call_args_list)
+    assert copied == [2, 3]
+    assert s3_client.upload_part_copy.call_args_list[0].kwargs['UploadId'] == 'upload-0'
+    assert {c.kwargs['CopySourceRange'] for c in s3_client.upload_part_copy.call_args_list} == {
+        'bytes={}-{}'.format(2 * gb, 4 * gb - 1), 'bytes={}-{}'.format(4 * gb, 6 * gb - 1)}
+    s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket='personal-bucket', Key='prefix/image03/testing.txt', UploadId='upload-0',
+        MultipartUpload={'Parts': [{'ETag': '"etag-{}"'.format(n), 'PartNumber': n} for n in range(1, 5)]})
+    assert not os.path.exists(state_path)
+
+
+@pytest.mark.parametrize('destination_size,completed', [(7, True), (6, False)])
+def test_download_to_s3_in_parts_already_completed(monkeypatch, download_mock2, download_request, destination_size,
+                                                   completed):
+    download = download_mock2(args=['-dp', '1189934'])
+    creds = {
+        'access_key': 'XXX',
+        'secret_key': '123',
+        'session_token': '123',
+        'source_uri': 's3://nda-central/collection-1860/submission-12345/testing.txt',
+        'destination_uri': 's3://personal-bucket/prefix/image03/testing.txt'
+    }
+    gb = 1024 * 1024 * 1024
+    s3_client = MagicMock()
+    s3_client.complete_multipart_upload.side_effect = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'NoSuchUpload'}}, 'CompleteMultipartUpload')
+    s3_client.head_object.return_value = {'ContentLength': destination_size * gb}
+    monkeypatch.setattr(download, 'get_s3_client', MagicMock(return_value=s3_client))
+    download_request.expected_file_size = 7 * gb
+
+    # the earlier run completed the upload but stopped before removing the state file
+    state_path = download.get_s3_copy_state_path(download_request)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump({'upload_id': 'upload-0', 'file_size': 7 * gb, 'part_size': 2 * gb,
+                   'source': {'Bucket': 'nda-central', 'Key': 'collection-1860/submission-12345/testing.txt'},
+                   'destination': ['personal-bucket', 'prefix/image03/testing.txt'],
+                   'parts': {str(n): '"etag-{}"'.format(n) for n in range(1, 5)}}, f)
+    if completed:
+        download.download_to_s3(download_request, creds)
+    else:
+        with pytest.raises(botocore.exceptions.ClientError):
+            download.download_to_s3(download_request, creds)
+    assert not s3_client.upload_part_copy.called
+    # the state file is removed either way, so the next run does not fail the same way
+    assert not os.path.exists(state_path)
+
+
+def test_get_temp_creds_for_files(monkeypatch, download_mock2):
+    download = download_mock2(args=['-dp', '1189934'])
+
+    def get_temp_creds_for_file(package_file_id, custom_user_s3_endpoint=None):
+        if package_file_id == 2:
+            raise HTTPError(response=Response(status_code=500))
+        return {'access_key': str(package_file_id)}
+
+    monkeypatch.setattr(download, 'get_temp_creds_for_file', get_temp_creds_for_file)
+    assert download.get_temp_creds_for_files([1, 2, 3]) == {1: {'access_key': '1'}, 2: None,
+                                                           3: {'access_key': '3'}}
+
+
+def test_is_temp_credentials_expiring():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    assert is_temp_credentials_expiring({'expiration_date': (now + datetime.timedelta(seconds=30)).isoformat()})
+    assert not is_temp_credentials_expiring({'expiration_date': (now + datetime.timedelta(hours=1)).isoformat()})
+    assert not is_temp_credentials_expiring({'access_key': 'XXX'})
 
 
 # line 552
@@ -288,12 +1031,27 @@ def test_download_handle_credentials_expired(monkeypatch, download_mock2, downlo
     with monkeypatch.context() as m:
         expired_error = HTTPError(response=Response(status_code=403, text='Request has expired'))
         m.setattr(download, 'download_local', MagicMock(side_effect=[expired_error, None]))
-        m.setattr(download, 'get_temp_creds_for_file', MagicMock())
+        m.setattr(download, 'get_temp_creds_for_file', MagicMock(return_value='https://new-url'))
+        m.setattr(download.metrics, 'file_started', MagicMock())
         download_request = download.download_from_s3link(package_file, 'https://asdfasdf/asdfasdf')
         assert download_request is not None
         assert download_request.exists
         assert download_request.download_complete_time is not None
         assert download.get_temp_creds_for_file.call_count == 1
+        # the same request is retried with the new url
+        assert download.download_local.call_args.args[0] is download_request
+        assert download_request.presigned_url == 'https://new-url'
+        assert download.metrics.file_started.call_count == 1
+
+    # refreshing the url counts towards --retries
+    download = download_mock2(args=['-dp', '1189934', '--retries', '2'])
+    with monkeypatch.context() as m:
+        m.setattr(download, 'download_local', MagicMock(side_effect=expired_error))
+        m.setattr(download, 'get_temp_creds_for_file', MagicMock(return_value='https://new-url'))
+        m.setattr(download, 'handle_download_exception', MagicMock())
+        download.download_from_s3link(package_file, 'https://asdfasdf/asdfasdf')
+        assert download.download_local.call_count == 3
+        assert download.handle_download_exception.called
 
 
 def test_handle_download_exception(monkeypatch, download_mock2, download_request, tmp_path):
@@ -335,6 +1093,29 @@ def test_handle_download_exception(monkeypatch, download_mock2, download_request
             'This error is likely caused by a misconfiguration on the target s3 bucket')
 
 
+def test_download_from_s3link_retries_transient_errors(monkeypatch, download_mock2, package_file, tmp_path):
+    download = download_mock2(args=['-dp', '1189934', '--retries', '2'])
+    monkeypatch.setattr(download.retry_backoff, 'get_delay', lambda attempt: 0)
+    monkeypatch.setattr(download, 'write_to_failed_download_link_file', MagicMock())
+    presigned_url = 'https://s3.amazonaws.com/nda-central/testing.txt?signature=123'
+
+    # a dropped connection and a server error are retried, and the download completes
+    errors = [requests.exceptions.ConnectionError('Connection reset by peer'),
+              HTTPError(response=Response(status_code=500))]
+    monkeypatch.setattr(download, 'download_local', MagicMock(side_effect=errors + [None]))
+    record = download.download_from_s3link(package_file, presigned_url, download_dir=tmp_path)
+    assert record.exists and download.download_local.call_count == 3
+    download.write_to_failed_download_link_file.assert_not_called()
+
+    # files are given up on when the attempts run out, or straight away for errors that would happen again
+    for error, call_count in [(TimeoutError('timed out'), 3), (HTTPError(response=Response(status_code=404)), 1),
+                              (OSError('No space left on device'), 1)]:
+        monkeypatch.setattr(download, 'download_local', MagicMock(side_effect=error))
+        record = download.download_from_s3link(package_file, presigned_url, download_dir=tmp_path)
+        assert not record.exists and download.download_local.call_count == call_count
+    assert download.write_to_failed_download_link_file.call_count == 3
+
+
 def test_verify(monkeypatch, download_mock2, tmp_path, datadir):
     download = download_mock2(args=['-dp', '1228592', '--verify', '-s3', 's3://personalbucket/abc'])
     # test that error is raised when user attempts to verify download with -s3 arg specified
@@ -0,0 +1,55 @@
+import os
+
+from NDATools.DownloadCache import DownloadCache
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def test_cache_hit_is_linked(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    source = write_file(tmp_path / 'package1' / 'image.nii', 10)
+    cache.add('s3://nda-central/image.nii', 10, source, e_tag='abc')
+
+    target = str(tmp_path / 'package2' / 'image.nii')
+    os.makedirs(os.path.dirname(target))
+    cached_file = cache.get('s3://nda-central/image.nii', 10, target)
+    assert cached_file == {'size': 10, 'e_tag': 'abc', 'checksum': None}
+    assert os.path.samefile(source, target)
+    # a different size is a different object
+    assert cache.get('s3://nda-central/image.nii', 11, str(tmp_path / 'other.nii')) is None
+    cache.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), max_size=25)
+    for name in ('a', 'b'):
+        cache.add('s3://nda-central/{}'.format(name), 10, write_file(tmp_path / name, 10))
+    # reading 'a' makes 'b' the least recently used file
+    assert cache.get('s3://nda-central/a', 10, str(tmp_path / 'a-copy'))
+    cache.add('s3://nda-central/c', 10, write_file(tmp_path / 'c', 10))
+
+    assert cache.get('s3://nda-central/b', 10, str(tmp_path / 'b-copy')) is None
+    assert cache.get('s3://nda-central/a', 10, str(tmp_path / 'a-copy2'))
+    assert cache.get('s3://nda-central/c', 10, str(tmp_path / 'c-copy'))
+    # evicting from the cache leaves the downloaded files in place
+    assert os.path.isfile(tmp_path / 'b')
+    cache.close()
+
+
+def test_cache_file_removed_during_get(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    cache.add('s3://nda-central/a', 10, write_file(tmp_path / 'a', 10))
+
+    # another process evicts the file between the lookup and the link
+    def link_or_copy(source, target):
+        raise FileNotFoundError(source)
+
+    monkeypatch.setattr('NDATools.DownloadCache.link_or_copy', link_or_copy)
+    assert cache.get('s3://nda-central/a', 10, str(tmp_path / 'a-copy')) is None
+    assert cache.connection.execute('SELECT COUNT(*) FROM {}'.format(DownloadCache.TABLE)).fetchone()[0] == 0
+    cache.close()
@@ -0,0 +1,96 @@
+import csv
+
+from NDATools.DownloadProgress import DownloadProgressJournal
+
+COLUMNS = ['package_file_id', 'package_file_expected_location', 'nda_s3_url', 'exists', 'expected_file_size',
+           'actual_file_size', 'e_tag', 'download_complete_time']
+
+
+def make_record(package_file_id, size=10):
+    return {
+        'package_file_id': package_file_id,
+        'package_file_expected_location': 'image03/file{}.txt'.format(package_file_id),
+        'nda_s3_url': 's3://nda-central/file{}.txt'.format(package_file_id),
+        'exists': True,
+        'expected_file_size': size,
+        'actual_file_size': size,
+        'e_tag': None,
+        'download_complete_time': '20250101T120000',
+        'presigned_url': 'https://ignored-column'
+    }
+
+
+def test_journal_records_and_resumes(tmp_path):
+    db_path = tmp_path / 'download-progress.db'
+    journal = DownloadProgressJournal(str(db_path), COLUMNS, commit_batch_size=2)
+    journal.record(make_record(1))
+    journal.record(make_record(2, size=20))
+    journal.record(make_record(3, size=30))
+    assert journal.is_complete(2)
+    assert not journal.is_complete(4)
+    journal.close()
+
+    # a new run sees all of the committed records
+    journal = DownloadProgressJournal(str(db_path), COLUMNS)
+    assert journal.get_completed_file_sizes() == {1: 10, 2: 20, 3: 30}
+    journal.close()
+
+
+def test_journal_imports_and_exports_csv(tmp_path):
+    legacy_csv = tmp_path / 'download-progress-report.csv'
+    with open(legacy_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerow(make_record(1))
+        writer.writerow(make_record(2))
+
+    journal = DownloadProgressJournal(str(tmp_path / 'download-progress.db'), COLUMNS, legacy_csv_path=legacy_csv)
+    assert journal.get_completed_file_sizes() == {1: 10, 2: 10}
+    journal.record(make_record(3))
+    export = tmp_path / 'export.csv'
+    journal.export_csv(export)
+    journal.close()
+
+    with open(export, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['package_file_id'] for r in rows] == ['1', '2', '3']
+    assert rows[2]['exists'] == 'True'
+    assert rows[2]['package_file_expected_location'] == 'image03/file3.txt'
+
+
+def test_journal_adds_new_columns(tmp_path):
+    db_path = tmp_path / 'download-progress.db'
+    journal = DownloadProgressJournal(str(db_path), COLUMNS)
+    journal.record(make_record(1))
+    journal.close()
+
+    # a journal written by an earlier version is upgraded with the columns it is missing
+    columns = COLUMNS[:-1] + ['checksum', COLUMNS[-1]]
+    journal = DownloadProgressJournal(str(db_path), columns)
+    journal.record(dict(make_record(2), checksum='abc'))
+    records = {r['package_file_id']: r for r in journal.completed_records()}
+    journal.close()
+    assert records[1]['checksum'] is None
+    assert records[2]['checksum'] == 'abc'
+    assert records[2]['download_complete_time'] == '20250101T120000'
+
+
+def test_journal_merge(tmp_path):
+    journal = DownloadProgressJournal(str(tmp_path / 'download-progress.db'), COLUMNS)
+    journal.record(make_record(1))
+
+    shard_journal = DownloadProgressJournal(str(tmp_path / 'shard-progress.db'), COLUMNS)
+    shard_journal.record(make_record(2, size=20))
+    shard_journal.record(dict(make_record(3), exists=False))
+    shard_journal.close()
+    assert journal.merge(str(tmp_path / 'shard-progress.db')) == 1
+
+    # shards without a journal are merged from their csv report
+    shard_csv = tmp_path / 'download-progress-report.csv'
+    with open(shard_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerow(make_record(4, size=40))
+    assert journal.merge(str(tmp_path / 'missing.db'), legacy_csv_path=str(shard_csv)) == 1
+    assert journal.get_completed_file_sizes() == {1: 10, 2: 20, 4: 40}
+    journal.close()
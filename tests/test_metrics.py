@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import NDATools
+from NDATools.Metrics import DownloadMetrics, EwmaRate, Summary, MetricsRegistry, MetricsFileWriter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ewma_rate_follows_throughput():
+    clock = FakeClock()
+    rate = EwmaRate(half_life_seconds=1, clock=clock)
+    for _ in range(10):
+        clock.now += 1
+        rate.add(1000)
+        rate.get_rate()
+    assert rate.get_rate() == pytest.approx(1000, rel=0.01)
+    # after one half life without data, the rate is halved
+    clock.now += 1
+    assert rate.get_rate() == pytest.approx(500, rel=0.01)
+
+
+def test_summary_percentiles():
+    summary = Summary(sample_size=10)
+    for i in range(1, 101):
+        summary.add(i)
+    stats = summary.to_dict()
+    assert stats['count'] == 100
+    assert stats['mean'] == 50.5
+    assert (stats['min'], stats['max']) == (1, 100)
+    assert len(summary.samples) == 10
+
+
+class PoolStub:
+    def get_stats(self):
+        return {'queued': 7, 'active': 3, 'threads': 4}
+
+
+def test_download_metrics(tmp_path):
+    clock = FakeClock()
+    metrics = DownloadMetrics(clock=clock)
+    metrics.set_pool(PoolStub())
+    metrics.file_started(1, expected_size=300)
+    metrics.file_started(2, expected_size=50)
+    clock.now = 0.5
+    metrics.record_bytes(100, 1)
+    clock.now = 2
+    snapshot = metrics.snapshot()
+    assert snapshot['files_in_flight'] == 2
+    assert snapshot['bytes_in_flight'] == 250
+    assert (snapshot['queue_depth'], snapshot['active_workers'], snapshot['idle_workers']) == (7, 3, 1)
+
+    metrics.record_bytes(200, 1)
+    metrics.file_finished(1)
+    metrics.file_finished(2, success=False)
+    # a file that is finished twice, e.g. after a retry, is only counted once
+    metrics.file_finished(2, success=False)
+    path = tmp_path / 'metrics.json'
+    metrics.export_json(path)
+    with open(path) as f:
+        exported = json.load(f)
+    assert exported['bytes_transferred'] == 300
+    assert (exported['files_completed'], exported['files_failed']) == (1, 1)
+    assert exported['time_to_first_byte_seconds']['mean'] == 0.5
+    assert exported['transfer_time_seconds']['max'] == 2
+    assert exported['average_bytes_per_second'] == 150
+    assert sum(exported['bytes_per_thread'].values()) == 300
+
+
+def test_metrics_registry_formats(tmp_path):
+    registry = MetricsRegistry()
+    registry.inc('nda_download_bytes_total', 100)
+    registry.inc('nda_download_bytes_total', 50)
+    registry.inc('nda_api_requests_total', method='GET', status=200)
+    registry.observe('nda_api_request_duration_seconds', 0.5, method='GET')
+    registry.observe('nda_api_request_duration_seconds', 1.5, method='GET')
+    registry.add_collector(lambda: {'nda_download_files_in_flight': 3})
+
+    text = registry.to_prometheus()
+    assert '# TYPE nda_download_bytes_total counter\nnda_download_bytes_total 150\n' in text
+    assert 'nda_api_requests_total{method="GET",status="200"} 1' in text
+    assert '# TYPE nda_api_request_duration_seconds summary' in text
+    assert 'nda_api_request_duration_seconds_sum{method="GET"} 2.0' in text
+    assert 'nda_api_request_duration_seconds_count{method="GET"} 2' in text
+    assert 'nda_download_files_in_flight 3' in text
+
+    path = tmp_path / 'metrics.json'
+    writer = MetricsFileWriter(registry, str(path), interval_seconds=60)
+    writer.stop()
+    with open(path) as f:
+        metrics = json.load(f)['metrics']
+    assert metrics['nda_api_requests_total'] == [{'labels': {'method': 'GET', 'status': '200'}, 'value': 1}]
+    registry.write_file(str(tmp_path / 'metrics.prom'))
+    with open(tmp_path / 'metrics.prom') as f:
+        assert f.read() == registry.to_prometheus()
+
+
+def test_exit_client_writes_metrics_file(tmp_path, monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr('NDATools.Metrics.metrics_registry', registry)
+    registry.start_file_writer(str(tmp_path / 'metrics.json'), interval_seconds=60)
+    registry.inc('nda_download_files_total', result='completed')
+    exit_codes = []
+    monkeypatch.setattr(NDATools.os, '_exit', exit_codes.append)
+    NDATools.exit_normal()
+    # os._exit skips atexit handlers, so the file has to be written before exiting
+    assert exit_codes == [0]
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['metrics']['nda_download_files_total'][0]['value'] == 1
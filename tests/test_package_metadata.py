@@ -0,0 +1,127 @@
+import gzip
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from NDATools.DownloadIO import GzipStreamReader
+from NDATools.PackageMetadata import PackageMetadata, UNKNOWN_FILE_SIZE, get_regex_literal_prefix
+
+
+def write_metadata_file(path, rows):
+    with open(path, 'w') as f:
+        f.write('"PACKAGE_FILE_ID","NDA_S3_URL","FILE_SIZE","DOWNLOAD_ALIAS","SHORT_NAME","UNUSED"\n')
+        for package_file_id, short_name in rows:
+            f.write('"{0}","s3://nda-central/{1}/file{0}.txt","{0}","{1}/file{0}.txt","{1}","x"\n'
+                    .format(package_file_id, short_name))
+    return str(path)
+
+
+def test_load_uses_compact_types(tmp_path):
+    path = write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03'), (2, 'fmriresults01')])
+    df = PackageMetadata(path).load()
+    assert list(df.columns) == ['package_file_id', 'nda_s3_url', 'file_size', 'download_alias', 'short_name']
+    assert df['package_file_id'].dtype == 'int64'
+    assert df['file_size'].dtype == 'int64'
+    assert df['short_name'].dtype == 'category'
+
+
+def test_load_rows_with_missing_values(tmp_path, monkeypatch):
+    path = write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03'), (2, 'image03')])
+    with open(path, 'a') as f:
+        f.write('"3","s3://nda-central/image03/file3.txt","","image03/file3.txt","image03","x"\n')
+        f.write('"","s3://nda-central/image03/file4.txt","4","image03/file4.txt","image03","x"\n')
+    df = PackageMetadata(path).load()
+    # files without a size are given a size of UNKNOWN_FILE_SIZE, and rows without an id are skipped
+    assert df['package_file_id'].tolist() == [1, 2, 3]
+    assert df['file_size'].tolist() == [1, 2, UNKNOWN_FILE_SIZE]
+    assert df['file_size'].dtype == 'int64'
+
+    metadata = PackageMetadata(path)
+    monkeypatch.setattr(metadata, 'read_csv_chunks', None)
+    pd.testing.assert_frame_equal(metadata.load(), df)
+
+
+def test_load_filters_each_chunk(tmp_path):
+    rows = [(i, 'image03' if i % 2 else 'fmriresults01') for i in range(1, 11)]
+    path = write_metadata_file(tmp_path / 'metadata.txt', rows)
+    metadata = PackageMetadata(path, chunk_size=3)
+    chunk_sizes = []
+
+    def chunk_filter(chunk):
+        chunk_sizes.append(len(chunk))
+        return chunk[chunk['short_name'] == 'image03']
+
+    df = metadata.load(chunk_filter, regex=r'file[1-5]\.txt')
+    assert chunk_sizes == [3, 3, 3, 1]
+    assert list(df['package_file_id']) == [1, 3, 5]
+    assert df['short_name'].dtype == 'category'
+    assert metadata.load(lambda chunk: chunk[chunk['short_name'] == 'missing']).empty
+
+
+def test_load_from_column_cache(tmp_path, monkeypatch):
+    path = write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03'), (2, ''), (3, 'fmriresults01')])
+    from_csv = PackageMetadata(path, chunk_size=2).load()
+    assert os.path.isfile(path + '.columns/manifest.json')
+
+    # the second read comes from the cache, without parsing the csv
+    metadata = PackageMetadata(path, chunk_size=2)
+    monkeypatch.setattr(metadata, 'read_csv_chunks', None)
+    pd.testing.assert_frame_equal(metadata.load(), from_csv)
+    assert metadata.load(regex='image03')['package_file_id'].tolist() == [1]
+
+
+def test_column_cache_is_rebuilt_when_metadata_changes(tmp_path):
+    path = write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03')])
+    PackageMetadata(path).load()
+    write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03'), (2, 'image03')])
+    metadata = PackageMetadata(path)
+    assert not metadata.cache.is_valid()
+    assert metadata.load()['package_file_id'].tolist() == [1, 2]
+    assert metadata.cache.is_valid()
+
+
+def test_index_lookups(tmp_path, monkeypatch):
+    rows = [(i, 'image03' if i % 3 else 'fmriresults01') for i in range(1, 13)] + [(13, '')]
+    path = write_metadata_file(tmp_path / 'metadata.txt', rows)
+    PackageMetadata(path).load()
+    metadata = PackageMetadata(path)
+    # lookups only read the cache
+    monkeypatch.setattr(metadata, 'read_chunks', None)
+
+    df = metadata.find_by_s3_urls(['s3://nda-central/image03/file5.txt', 's3://nda-central/image03/file1.txt',
+                                   's3://nda-central/image03/file3.txt', 's3://nda-central/missing.txt'])
+    assert df['package_file_id'].tolist() == [1, 5]
+    assert df['download_alias'].tolist() == ['image03/file1.txt', 'image03/file5.txt']
+    assert metadata.find_by_short_name('fmriresults01')['package_file_id'].tolist() == [3, 6, 9, 12]
+    assert metadata.find_by_short_name('fmriresults01', regex=r'file1')['package_file_id'].tolist() == [12]
+    assert metadata.find_by_short_name('missing').empty
+    assert metadata.load(regex=r'^image03/file1\d?\.txt$')['package_file_id'].tolist() == [1, 10, 11]
+
+
+def test_lookups_build_the_cache(tmp_path):
+    path = write_metadata_file(tmp_path / 'metadata.txt', [(1, 'image03'), (2, 'fmriresults01')])
+    metadata = PackageMetadata(path)
+    assert metadata.find_by_short_name('image03')['package_file_id'].tolist() == [1]
+    assert metadata.cache.is_valid()
+
+
+def test_get_regex_literal_prefix():
+    assert get_regex_literal_prefix('^image03/sub') == 'image03/sub'
+    assert get_regex_literal_prefix(r'^image03/.*\.nii') == 'image03/'
+    assert get_regex_literal_prefix('^image03s?/') == 'image03'
+    assert get_regex_literal_prefix('image03/') is None
+    assert get_regex_literal_prefix('^image03|^fmri') is None
+    assert get_regex_literal_prefix('^.*') is None
+
+
+def test_write_from_truncated_stream(tmp_path):
+    source = write_metadata_file(tmp_path / 'source.txt', [(i, 'image03') for i in range(1, 1001)])
+    with open(source, 'rb') as f:
+        compressed = gzip.compress(f.read())
+    path = str(tmp_path / 'metadata.txt')
+    with pytest.raises(EOFError):
+        PackageMetadata(path, chunk_size=100).write(GzipStreamReader(io.BytesIO(compressed[:-100]), read_size=1024))
+    # nothing is left behind, so the file is downloaded again next time
+    assert os.listdir(tmp_path) == ['source.txt']
@@ -0,0 +1,75 @@
+import email.utils
+import threading
+import time
+
+import pytest
+
+from NDATools.Polling import Backoff, Poller, PollTimeoutError, RetryLater, parse_retry_after
+
+
+def countdown_check(polls_needed, result, calls):
+    def check():
+        calls.append((threading.current_thread().name, time.monotonic()))
+        if len(calls) < polls_needed:
+            return None
+        return result
+    return check
+
+
+def test_backoff_delays_grow_with_jitter():
+    backoff = Backoff(initial=1, maximum=10, multiplier=2, jitter=0.2)
+    for attempt, expected in [(0, 1), (1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        delay = backoff.get_delay(attempt)
+        assert expected * 0.8 <= delay <= expected
+
+
+def test_poller_multiplexes_jobs_on_one_thread():
+    poller = Poller()
+    backoff = Backoff(initial=0.01, maximum=0.05)
+    calls = [[] for _ in range(20)]
+    futures = [poller.submit(countdown_check(3, i, calls[i]), timeout_seconds=5, backoff=backoff) for i in range(20)]
+    assert [f.result(timeout=5) for f in futures] == list(range(20))
+    assert {name for job_calls in calls for name, _ in job_calls} == {poller.name}
+    assert all(len(job_calls) == 3 for job_calls in calls)
+    poller.shutdown()
+
+
+def test_poller_deadline():
+    poller = Poller()
+    calls = []
+    future = poller.submit(countdown_check(1000, 'done', calls), timeout_seconds=0.2,
+                           backoff=Backoff(initial=0.05, maximum=0.05))
+    with pytest.raises(PollTimeoutError):
+        future.result(timeout=5)
+    # the last check is made at the deadline
+    assert calls[-1][1] - calls[0][1] == pytest.approx(0.2, abs=0.1)
+    poller.shutdown()
+
+
+def test_poller_retry_after_and_errors():
+    poller = Poller()
+    calls = []
+
+    def throttled():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryLater(0.3)
+        return 'done'
+
+    assert poller.submit(throttled, backoff=Backoff(initial=0.01)).result(timeout=5) == 'done'
+    assert calls[1] - calls[0] >= 0.3
+
+    def failing():
+        raise SystemExit(1)
+
+    with pytest.raises(SystemExit):
+        poller.submit(failing).result(timeout=5)
+    poller.shutdown()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    retry_at = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert parse_retry_after(retry_at) == pytest.approx(60, abs=2)
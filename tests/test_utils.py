@@ -11,7 +11,8 @@ import pytest
 import NDATools
 from NDATools.Utils import parse_local_files, sanitize_file_path, check_read_permissions, \
     sanitize_windows_download_filename, deconstruct_s3_url, collect_directory_list, get_int_input, \
-    evaluate_yes_no_input, put_request, post_request, HttpErrorHandlingStrategy
+    evaluate_yes_no_input, put_request, post_request, HttpErrorHandlingStrategy, parse_byte_size, parse_shard, \
+    TokenBucket
 from tests.conftest import MockLogger
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s:%(levelname)s:%(message)s")
@@ -251,3 +252,51 @@ def test_exit_normal(monkeypatch):
         NDATools.exit_normal('Exiting normally')
         NDATools.logger.info.any_call_contains('Exiting normally')
         os._exit.call_count == 1
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('500000', 500000),
+    ('750K', 750 * 1024),
+    ('20MB', 20 * 1024 ** 2),
+    ('1.5g', int(1.5 * 1024 ** 3)),
+    ('10MiB/s', 10 * 1024 ** 2),
+    ('0', 0)
+])
+def test_parse_byte_size(value, expected):
+    assert parse_byte_size(value) == expected
+
+
+def test_parse_byte_size_invalid():
+    with pytest.raises(ValueError):
+        parse_byte_size('fast')
+
+
+def test_parse_shard():
+    assert parse_shard('2/8') == (2, 8)
+    assert parse_shard(' 1 / 1 ') == (1, 1)
+    for value in ['0/4', '5/4', '2', 'a/b']:
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_token_bucket(monkeypatch, tmp_path):
+    sleep = MagicMock()
+    monkeypatch.setattr(NDATools.Utils.time, 'sleep', sleep)
+    monkeypatch.setattr(NDATools.Utils.time, 'monotonic', lambda: 100.0)
+
+    bucket = TokenBucket()
+    bucket.consume(10 * 1024 ** 2)
+    sleep.assert_not_called()
+
+    bucket.set_rate(1024)
+    bucket.consume(2048)
+    sleep.assert_called_once_with(2.0)
+
+    # the limit is read from the control file
+    control_file = tmp_path / 'bandwidth'
+    control_file.write_text('0')
+    bucket.configure(control_file=str(control_file))
+    sleep.reset_mock()
+    bucket.consume(2048)
+    assert bucket.rate == 0
+    sleep.assert_not_called()